@@ -8,9 +8,11 @@
 #include <chrono>
 #include <cmath>
 #include <cstdint>
+#include <cstring>
 #include <filesystem>
 #include <fstream>
 #include <iostream>
+#include <iterator>
 #include <random>
 #include <span>
 #include <string_view>
@@ -70,6 +72,100 @@ double parseDouble(std::string_view sv) {
     return res;
 }
 //---------------------------------------------------------------------------
+// Positions of the features in the vector of the model
+// They are read from the layout file that is saved next to every model (see src/feature_layout.py)
+struct FeatureIndices {
+    uint64_t TableScan_Scan_const;
+    uint64_t TableScan_Scan_in_card;
+    uint64_t TableScan_Scan_out_percentage;
+    uint64_t TableScan_Scan_compare_percentage;
+    uint64_t TableScan_Scan_empty_output;
+
+    uint64_t HashJoin_Build_const;
+    uint64_t HashJoin_Build_out_card;
+    uint64_t HashJoin_Build_out_size;
+    uint64_t HashJoin_Build_in_percentage;
+
+    uint64_t HashJoin_Probe_const;
+    uint64_t HashJoin_Probe_in_card;
+    uint64_t HashJoin_Probe_right_percentage;
+    uint64_t HashJoin_Probe_out_percentage;
+
+    bool load(const fs::path& path, uint64_t nFeatures);
+};
+//---------------------------------------------------------------------------
+FeatureIndices featureIndices;
+//---------------------------------------------------------------------------
+bool FeatureIndices::load(const fs::path& path, uint64_t nFeatures) {
+    // magic "T3FL", uint32 format version, uint32 number of features, 16 byte signature,
+    // then an uint16 length and the name of each feature, everything little endian like the host
+    std::ifstream in(path, std::ios::binary);
+    if (!in) {
+        std::cout << "Could not open feature layout " << path << std::endl;
+        return false;
+    }
+    std::vector<char> buffer((std::istreambuf_iterator<char>(in)), std::istreambuf_iterator<char>());
+    uint64_t offset = 0;
+    auto read = [&](void* target, uint64_t size) {
+        if (offset + size > buffer.size())
+            return false;
+        std::memcpy(target, buffer.data() + offset, size);
+        offset += size;
+        return true;
+    };
+    char magic[4];
+    uint32_t version;
+    uint32_t count;
+    char signature[16];
+    if (!read(magic, 4) || std::string_view(magic, 4) != "T3FL" || !read(&version, 4) || !read(&count, 4) ||
+        !read(signature, 16)) {
+        std::cout << "Invalid feature layout " << path << std::endl;
+        return false;
+    }
+    if (version != 1) {
+        std::cout << "Unsupported feature layout format " << version << " in " << path << std::endl;
+        return false;
+    }
+    if (count != nFeatures) {
+        std::cout << "Feature layout " << path << " has " << count << " features, expected " << nFeatures << std::endl;
+        return false;
+    }
+    std::unordered_map<std::string_view, uint64_t> indices;
+    for (uint32_t i = 0; i < count; ++i) {
+        uint16_t length;
+        if (!read(&length, 2) || offset + length > buffer.size()) {
+            std::cout << "Invalid feature layout " << path << std::endl;
+            return false;
+        }
+        indices.emplace(std::string_view(buffer.data() + offset, length), i);
+        offset += length;
+    }
+    bool complete = true;
+    auto lookup = [&](std::string_view name, uint64_t& index) {
+        auto it = indices.find(name);
+        if (it == indices.end()) {
+            std::cout << "Feature " << name << " is missing in " << path << std::endl;
+            complete = false;
+            return;
+        }
+        index = it->second;
+    };
+    lookup("TableScan_Scan_const", TableScan_Scan_const);
+    lookup("TableScan_Scan_in_card", TableScan_Scan_in_card);
+    lookup("TableScan_Scan_out_percentage", TableScan_Scan_out_percentage);
+    lookup("TableScan_Scan_compare_percentage", TableScan_Scan_compare_percentage);
+    lookup("TableScan_Scan_empty_output", TableScan_Scan_empty_output);
+    lookup("HashJoin_Build_const", HashJoin_Build_const);
+    lookup("HashJoin_Build_out_card", HashJoin_Build_out_card);
+    lookup("HashJoin_Build_out_size", HashJoin_Build_out_size);
+    lookup("HashJoin_Build_in_percentage", HashJoin_Build_in_percentage);
+    lookup("HashJoin_Probe_const", HashJoin_Probe_const);
+    lookup("HashJoin_Probe_in_card", HashJoin_Probe_in_card);
+    lookup("HashJoin_Probe_right_percentage", HashJoin_Probe_right_percentage);
+    lookup("HashJoin_Probe_out_percentage", HashJoin_Probe_out_percentage);
+    return complete;
+}
+//---------------------------------------------------------------------------
 struct Features {
     double TableScan_Scan_const;
     double TableScan_Scan_in_card;
@@ -92,21 +188,22 @@ struct Features {
 };
 //---------------------------------------------------------------------------
 void Features::add_to_vector(std::span<double> vec) const {
-    vec[0] += TableScan_Scan_const;
-    vec[1] += TableScan_Scan_in_card;
-    vec[3] += TableScan_Scan_out_percentage;
-    vec[5] += 1.0; // TableScan_Scan_compare_percentage is always set to 1, so we have a plausible filter
-    vec[10] += TableScan_Scan_empty_output;
+    const FeatureIndices& f = featureIndices;
+    vec[f.TableScan_Scan_const] += TableScan_Scan_const;
+    vec[f.TableScan_Scan_in_card] += TableScan_Scan_in_card;
+    vec[f.TableScan_Scan_out_percentage] += TableScan_Scan_out_percentage;
+    vec[f.TableScan_Scan_compare_percentage] += 1.0; // TableScan_Scan_compare_percentage is always set to 1, so we have a plausible filter
+    vec[f.TableScan_Scan_empty_output] += TableScan_Scan_empty_output;
 
-    vec[39] += HashJoin_Build_const;
-    vec[40] += HashJoin_Build_out_card;
-    vec[41] += HashJoin_Build_out_size;
-    vec[42] += HashJoin_Build_in_percentage;
+    vec[f.HashJoin_Build_const] += HashJoin_Build_const;
+    vec[f.HashJoin_Build_out_card] += HashJoin_Build_out_card;
+    vec[f.HashJoin_Build_out_size] += HashJoin_Build_out_size;
+    vec[f.HashJoin_Build_in_percentage] += HashJoin_Build_in_percentage;
 
-    vec[43] += HashJoin_Probe_const;
-    vec[44] += HashJoin_Probe_in_card;
-    vec[45] += HashJoin_Probe_right_percentage;
-    vec[46] += HashJoin_Probe_out_percentage;
+    vec[f.HashJoin_Probe_const] += HashJoin_Probe_const;
+    vec[f.HashJoin_Probe_in_card] += HashJoin_Probe_in_card;
+    vec[f.HashJoin_Probe_right_percentage] += HashJoin_Probe_right_percentage;
+    vec[f.HashJoin_Probe_out_percentage] += HashJoin_Probe_out_percentage;
 }
 //---------------------------------------------------------------------------
 void Features::operator+=(const Features& o) {
@@ -185,7 +282,7 @@ void Model::predictMany() {
     // actually compute the correct output
     for (uint64_t i = 0; i < currentlyFilled; ++i) {
         // The running time in ms is exp(-y) * table_size
-        out[i] = std::exp(-out[i]) * data[i * nFeatures + 1];
+        out[i] = std::exp(-out[i]) * data[i * nFeatures + featureIndices.TableScan_Scan_in_card];
     }
     resetInput();
     currentlyFilled = 0;
@@ -214,7 +311,7 @@ void Model::predictManyST() {
     // actually compute the correct output
     for (uint64_t i = 0; i < currentlyFilled; ++i) {
         // The running time in ms is exp(-y) * table_size
-        out[i] = std::exp(-out[i]) * data[i * nFeatures + 1];
+        out[i] = std::exp(-out[i]) * data[i * nFeatures + featureIndices.TableScan_Scan_in_card];
     }
     resetInput();
     currentlyFilled = 0;
@@ -233,7 +330,7 @@ double Model::predict() {
     assert(outLen == currentlyFilled);
     // actually compute the correct output
     // The running time in ms is exp(-y) * table_size
-    out[0] = std::exp(-out[0]) * data[1];
+    out[0] = std::exp(-out[0]) * data[featureIndices.TableScan_Scan_in_card];
     resetInput();
     currentlyFilled = 0;
     ++callsToPredict;
@@ -242,7 +339,7 @@ double Model::predict() {
 //---------------------------------------------------------------------------
 double Model::predictCompiled() {
     forest_root(data.data(), out.data(), 0, 1);
-    out[0] = std::exp(-out[0]) * data[1];
+    out[0] = std::exp(-out[0]) * data[featureIndices.TableScan_Scan_in_card];
     resetInput();
     currentlyFilled = 0;
     ++callsToPredict;
@@ -253,14 +350,14 @@ void processChunk(std::vector<double>& data, std::vector<double>& out, uint64_t
     int nCurrent = static_cast<int>(end - start);
     forest_root(data.data(), out.data(), static_cast<int>(start), nCurrent);
     for (uint64_t i = start; i < end; ++i) {
-        out[i] = std::exp(-out[i]) * data[i * nFeatures + 1];
+        out[i] = std::exp(-out[i]) * data[i * nFeatures + featureIndices.TableScan_Scan_in_card];
     }
 }
 //---------------------------------------------------------------------------
 void Model::predictManyCompiled() {
     forest_root(data.data(), out.data(), 0, static_cast<int>(currentlyFilled));
     for (uint64_t i = 0; i < currentlyFilled; ++i) {
-        out[i] = std::exp(-out[i]) * data[i * nFeatures + 1];
+        out[i] = std::exp(-out[i]) * data[i * nFeatures + featureIndices.TableScan_Scan_in_card];
     }
     resetInput();
     currentlyFilled = 0;
@@ -857,6 +954,10 @@ void benchmarkModelLatencyScaling(const Model& model, const std::string& outFile
 int main() {
     Model model;
     model.loadModel(fs::path("model.txt"));
+    if (!featureIndices.load(fs::path("model.layout"), Model::nFeatures)) {
+        std::cout << "Refusing model.txt, its feature layout does not match" << std::endl;
+        return 1;
+    }
     model.resize(1);
     model.prepare();
 
@@ -5,35 +5,25 @@ import tarfile
 from pathlib import Path
 
 import lz4.frame
-from lleaves import lleaves
 
-from dp.BenchmarkDPResult import benchmark_dp_queries
-from dp.dp_to_sql import convert_all_dp_results_to_sql
 from src.benchmark_runner import benchmark
 from src.benchmark_setup import download_csvs, create_tpc_data, download_t3_file, load_csvs_to_db
-from src.evaluation import QueryEstimationCache
-from src.figures.acc_comparison import comparison_plot
-from src.figures.acc_comparison_zero_shot import comparison_zero_shot_plot
-from src.figures.accuracy_table import write_accuracy_table
-from src.figures.cardinality_degradation import make_card_degen_figure
-from src.figures.clean_benchmarks import clean_benchmark_figure
-from src.figures.error_by_query_type import get_error_by_query_hist
-from src.figures.error_histogram import get_error_histogram
-from src.figures.est_card_acc import eval_card_est
-from src.figures.infra import get_figure_path, set_figure_path, set_figure_format, set_use_latex
-from src.figures.latency_accuracy import latency_acc_figure
-from src.figures.latency_scaling import latency_scaling_figure
-from src.figures.per_database_acc import create_per_db_figure
-from src.figures.per_tuple import per_tuple_prediction_figure
-from src.figures.query_runtimes import get_benchmark_variance
+from src.feature_layout import save_model
 from src.server import start_webserver_new, kill_webserver_new
-from src.train import optimize_all
 from src.util import rm_rec
 
 
-def download_bench_data():
+def download_bench_data(packed: bool = False):
+    """
+    packed keeps the benchmark files of each database in one archive (src/plan_archive.py) instead of extracting them
+    """
     if not Path("data").exists():
         download_t3_file("benchdata.tar.lz4")
+        if packed:
+            from src.plan_archive import pack_tar
+
+            pack_tar(Path("downloaded_data/benchdata.tar.lz4"))
+            return
         data_path = "downloaded_data/benchdata.tar"
         with open("downloaded_data/benchdata.tar.lz4", "rb") as data:
             decompressed_data = lz4.frame.decompress(data.read())
@@ -88,11 +78,16 @@ def extract_lightGBM():
 
 
 def run_join_order_experiment(model, benchmark_results: bool):
+    from lleaves import lleaves
+
+    from dp.BenchmarkDPResult import benchmark_dp_queries
+    from dp.dp_to_sql import convert_all_dp_results_to_sql
+
     print("Downloading join order experiment data")
     download_join_order_data()
 
     print("Compiling the tree model")
-    model.tree.save_model("model.txt")
+    save_model(model.tree, Path("model.txt"))
     llvm_tree = lleaves.Model(model_file="model.txt")
     Path("./lleaves.o").unlink(missing_ok=True)
     llvm_tree.compile(cache="./lleaves.o")
@@ -141,6 +136,8 @@ def reset():
         Path("./dp/query_names.txt"),
         Path("./webserver"),
         Path("./lleaves.o"),
+        Path("./lleaves_cache"),
+        Path("./model_registry"),
         Path("./model.txt"),
     ]:
         rm_rec(path)
@@ -161,6 +158,18 @@ def main():
         action="store_true",
         help="Reproduce the benchmarks. (This is not portable, can take hours, and requires the download of over 20GB of data)",
     )
+    parser.add_argument(
+        "--packed",
+        "-p",
+        action="store_true",
+        help="Keep the downloaded benchmark data in one archive per database instead of extracting all files",
+    )
+    parser.add_argument(
+        "--feature-store",
+        "-f",
+        action="store_true",
+        help="Train from the featurized benchmarks stored under data/feature_cache instead of parsing all plans",
+    )
     parser.add_argument(
         "--reset",
         "-r",
@@ -174,6 +183,8 @@ def main():
     run_bench: bool = args.runbench
     benchmark_job: bool = args.benchjob
     do_reset: bool = args.reset
+    packed_data: bool = args.packed
+    use_feature_store: bool = args.feature_store
 
     if do_reset:
         reset()
@@ -187,16 +198,24 @@ def main():
         reproduce_bench_data()
     else:
         print("Downloading benchmark data")
-        download_bench_data()
+        download_bench_data(packed_data)
+
+    # training, evaluation and every figure pull in lightgbm, sklearn or matplotlib, each is imported where it is used
+    from src.train import optimize_all
 
     print("Training models for exact and predicted cardinalities")
-    exact_model = optimize_all(False)
-    pred_model = optimize_all(True)
+    exact_model = optimize_all(False, use_feature_store)
+    pred_model = optimize_all(True, use_feature_store)
+
+    from src.evaluation import QueryEstimationCache
+
     print("Evaluating models")
     exact_exact_eval = QueryEstimationCache(exact_model, False)
     exact_pred_eval = QueryEstimationCache(exact_model, True)
     pred_pred_eval = QueryEstimationCache(pred_model, True)
 
+    from src.figures.infra import get_figure_path, set_figure_path, set_figure_format, set_use_latex
+
     set_figure_path("./figure_output")
     set_figure_format("pdf")
     set_use_latex(False)
@@ -204,34 +223,60 @@ def main():
     print(f"Storing figures in {get_figure_path().absolute()}")
 
     print("Creating latency accuracy overview")
+    from src.figures.latency_accuracy import latency_acc_figure
+
     latency_acc_figure(pred_pred_eval)
     print("Creating query runtime figure")
+    from src.figures.query_runtimes import get_benchmark_variance
+
     get_benchmark_variance()
     print("Creating accuracy table")
+    from src.figures.accuracy_table import write_accuracy_table
+
     write_accuracy_table(exact_exact_eval)
     print("Creating accuracy histogram")
+    from src.figures.error_histogram import get_error_histogram
+
     get_error_histogram(exact_exact_eval)
     print("Creating per query accuracy figure")
+    from src.figures.error_by_query_type import get_error_by_query_hist
+
     get_error_by_query_hist(exact_exact_eval)
     print("Creating per database instance accuracy figure (requires re-training)")
+    from src.figures.per_database_acc import create_per_db_figure
+
     create_per_db_figure()
     print("Creating cardinality comparison figure")
+    from src.figures.est_card_acc import eval_card_est
+
     eval_card_est([exact_exact_eval, exact_pred_eval, pred_pred_eval])
     print("Creating accuracy comparison figure")
+    from src.figures.acc_comparison import comparison_plot
+
     comparison_plot(pred_pred_eval)
     print("Creating accuracy comparison to zero shot figure (requires re-training)")
+    from src.figures.acc_comparison_zero_shot import comparison_zero_shot_plot
+
     comparison_zero_shot_plot()
     print("Creating ablation study figure (requires re-training)")
+    from src.figures.per_tuple import per_tuple_prediction_figure
+
     per_tuple_prediction_figure()
     print("Creating clean benchmark figure (requires re-training)")
+    from src.figures.clean_benchmarks import clean_benchmark_figure
+
     clean_benchmark_figure()
     print("Creating cardinality degradation figure (might take a while)")
+    from src.figures.cardinality_degradation import make_card_degen_figure
+
     make_card_degen_figure()
 
     if run_cpp:
         print("Running join order microbenchmark")
         run_join_order_experiment(exact_model, benchmark_job)
         print("Creating latency scaling figure")
+        from src.figures.latency_scaling import latency_scaling_figure
+
         latency_scaling_figure()
 
 
@@ -1,15 +1,23 @@
 import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Optional
 
 import numpy as np
 
 from src.database import Database
+from src.feature_store import FeatureStore, get_source_files, get_source_fingerprint
+from src.features import FeatureMapper, get_feature_signature
+from src.json_decoding import get_benchmark_decoder
+from src.memo_cache import memo_cache
 from src.metrics import q_error
 from src.optimizer import BenchmarkedQuery, QueryCategory
+from src.plan_archive import PlanArchive, get_current_plan_archive
 from src.query_plan import QueryPlan
-from src.util import fifo_cache
+from src.util import paused_gc
 
 
 def arg_median(a):
@@ -22,21 +30,78 @@ def arg_median(a):
         return np.where(a == left)[0][0]  # , np.where(a == right)[0][0]
 
 
+# database and archive of the plans parsed by a loader process, set once per process by the pool initializer
+WORKER_DATABASE: Optional[Database] = None
+WORKER_ARCHIVE: Optional[PlanArchive] = None
+
+
+def init_load_worker(db: Database, archive: Optional[Path]):
+    global WORKER_DATABASE, WORKER_ARCHIVE
+    WORKER_DATABASE = db
+    WORKER_ARCHIVE = PlanArchive(archive) if archive is not None else None
+
+
+def load_benchmark_files(files: list[Path], predicted_cardinalities: bool) -> list[BenchmarkedQuery]:
+    """
+    parse a chunk of benchmark files in a loader process
+    the plans are sent back without their database, otherwise the whole schema would be pickled with every plan
+    """
+    with paused_gc():
+        result = DataCollector.read_benchmark_files(files, WORKER_DATABASE, predicted_cardinalities, WORKER_ARCHIVE)
+    for benchmark in result:
+        benchmark.query_plan.db = None
+    return result
+
+
+def get_benchmark_fingerprint(db: Database, predicted_cardinalities: bool) -> str:
+    """
+    the inputs of DataCollector.collect_db_benchmark_runs, its disk tier is only read while they are unchanged
+    """
+    return f"{get_source_fingerprint(get_source_files(db))}:{get_feature_signature(FeatureMapper.get_names())}"
+
+
 class DataCollector:
+    # processes parsing the benchmark files of a database, 1 reads them in this process
+    # unpickling the parsed plans here costs about a third of parsing them, the pool only pays off from 4 cores on
+    load_workers = os.cpu_count() if (os.cpu_count() or 1) >= 4 else 1
+    # files per task of a loader process, larger chunks pickle fewer tasks and results
+    load_chunk_size = 64
+
     @staticmethod
     def read_runtime(file: Path) -> float:
-        with open(file, "r") as benchmark_json:
-            benchmark_json = json.load(benchmark_json)
+        benchmark_json = get_benchmark_decoder().load_file(file)
+        return DataCollector.get_runtime(benchmark_json)
+
+    @staticmethod
+    def get_runtime(benchmark_json: dict) -> float:
         runtimes = [b["executionTime"] for b in benchmark_json["benchmarks"]]
         return np.median(runtimes)
 
     @staticmethod
     def read_query(file: Path) -> str:
-        with open(file, "r") as benchmark_json:
-            benchmark_json = json.load(benchmark_json)
+        benchmark_json = get_benchmark_decoder().load_file(file)
         query = benchmark_json["plan"]["query_text"]
         return query
 
+    @staticmethod
+    def read_benchmark_jsons(db: Database) -> dict[str, list[dict]]:
+        """
+        the benchmark json of every benchmark of the database by category (sub directory of data/<db>/), sorted by
+        file name, read from the plan archive of the database if there is one
+        """
+        result = {}
+        archive = get_current_plan_archive(db)
+        if archive is not None:
+            with PlanArchive(archive) as plan_archive:
+                for name in sorted(Path(name) for name in plan_archive.get_names()):
+                    result.setdefault(name.parts[0], []).append(plan_archive.read(name.as_posix()))
+            return result
+        for dir in sorted(d for d in Path(f"data/{db.get_path()}").iterdir() if d.is_dir()):
+            files = [f for f in dir.rglob("*.json")]
+            files.sort()
+            result[dir.name] = [get_benchmark_decoder().load_file(f) for f in files]
+        return result
+
     @staticmethod
     def get_type(file: Path) -> QueryCategory:
         name = str(file.parent.name)
@@ -44,8 +109,23 @@ class DataCollector:
 
     @staticmethod
     def read_analyzed_plan(file: Path, db: Database, predicted_cardinalities: bool) -> BenchmarkedQuery:
-        with open(file, "r") as benchmark_json:
-            benchmark_json = json.load(benchmark_json)
+        benchmark_json = get_benchmark_decoder().load_file(file)
+        return DataCollector.parse_analyzed_plan(benchmark_json, file, db, predicted_cardinalities)
+
+    @staticmethod
+    def read_archived_plan(
+        archive: PlanArchive, file: Path, db: Database, predicted_cardinalities: bool
+    ) -> BenchmarkedQuery:
+        """
+        read_analyzed_plan for the record of data/<db>/<file> in the plan archive of the database
+        """
+        benchmark_json = archive.read(file.as_posix())
+        return DataCollector.parse_analyzed_plan(benchmark_json, file, db, predicted_cardinalities)
+
+    @staticmethod
+    def parse_analyzed_plan(
+        benchmark_json: dict, file: Path, db: Database, predicted_cardinalities: bool
+    ) -> BenchmarkedQuery:
         plan = QueryPlan(benchmark_json["plan"]["plan"], db, predicted_cardinalities)
         plan.build_pipelines(benchmark_json["plan"]["plan"]["analyzePlanPipelines"])
         runtimes = [b["executionTime"] for b in benchmark_json["benchmarks"]]
@@ -79,13 +159,64 @@ class DataCollector:
         return result
 
     @staticmethod
-    @fifo_cache
-    def collect_db_benchmark_runs(db: Database, predicted_cardinalities) -> list[BenchmarkedQuery]:
-        result = []
-        files = [f for f in Path(f"data/{db.get_path()}").rglob("*.json")]
+    def get_benchmark_files(db: Database) -> tuple[list[Path], Optional[Path]]:
+        """
+        the sorted benchmark files of data/<db>/, or the paths of the records in the plan archive of the database and
+        the archive if there is one
+        """
+        archive = get_current_plan_archive(db)
+        if archive is not None:
+            with PlanArchive(archive) as plan_archive:
+                files = [Path(name) for name in plan_archive.get_names()]
+        else:
+            files = [f for f in Path(f"data/{db.get_path()}").rglob("*.json")]
         files.sort()
-        for file in files:
-            result.append(DataCollector.read_analyzed_plan(file, db, predicted_cardinalities))
+        return files, archive
+
+    @staticmethod
+    def read_benchmark_files(
+        files: list[Path], db: Database, predicted_cardinalities: bool, archive: Optional[PlanArchive] = None
+    ) -> list[BenchmarkedQuery]:
+        if archive is None:
+            return [DataCollector.read_analyzed_plan(f, db, predicted_cardinalities) for f in files]
+        return [DataCollector.read_archived_plan(archive, f, db, predicted_cardinalities) for f in files]
+
+    @staticmethod
+    def read_analyzed_plans(
+        files: list[Path],
+        db: Database,
+        predicted_cardinalities: bool,
+        n_workers: int = 1,
+        archive: Optional[Path] = None,
+    ) -> list[BenchmarkedQuery]:
+        """
+        read_analyzed_plan for all files, in order, with an archive the files are paths of its records
+        with n_workers > 1 the files are parsed in chunks by a pool of processes, the parsed plans are pickled back
+        """
+        chunk_size = DataCollector.load_chunk_size
+        n_chunks = (len(files) + chunk_size - 1) // chunk_size
+        n_workers = min(n_workers, n_chunks)
+        if n_workers <= 1:
+            with paused_gc(), PlanArchive(archive) if archive is not None else nullcontext() as plan_archive:
+                return DataCollector.read_benchmark_files(files, db, predicted_cardinalities, plan_archive)
+        chunks = [files[i : i + chunk_size] for i in range(0, len(files), chunk_size)]
+        result = []
+        # unpickling the plans in this process is the part that does not scale with the workers
+        with paused_gc(), ProcessPoolExecutor(n_workers, initializer=init_load_worker, initargs=(db, archive)) as pool:
+            for chunk in pool.map(load_benchmark_files, chunks, [predicted_cardinalities] * len(chunks)):
+                for benchmark in chunk:
+                    benchmark.query_plan.db = db
+                result += chunk
+        return result
+
+    @staticmethod
+    @memo_cache(max_entries=100, fingerprint=get_benchmark_fingerprint)
+    def collect_db_benchmark_runs(db: Database, predicted_cardinalities) -> list[BenchmarkedQuery]:
+        files, archive = DataCollector.get_benchmark_files(db)
+        result = DataCollector.read_analyzed_plans(
+            files, db, predicted_cardinalities, DataCollector.load_workers, archive
+        )
+        FeatureStore().attach_features(db, predicted_cardinalities, result)
         return result
 
     @staticmethod
@@ -245,16 +376,13 @@ class DataCollector:
         per_db_runtimes = {}
         all_runtimes = []
         for db in dbs:
-            subdirs = [d for d in Path(f"data/{db.get_path()}").iterdir() if d.is_dir()]
-            for dir in subdirs:
-                print(dir)
-                files = [f for f in dir.rglob("*.json")]
-                files.sort()
-                runtimes = [DataCollector.read_runtime(f) for f in files]
+            for category, benchmark_jsons in DataCollector.read_benchmark_jsons(db).items():
+                print(f"data/{db.get_path()}/{category}")
+                runtimes = [DataCollector.get_runtime(b) for b in benchmark_jsons]
                 if len(runtimes) > 0:
-                    if dir.name not in per_type_runtimes:
-                        per_type_runtimes[dir.name] = []
-                    per_type_runtimes[dir.name] += runtimes
+                    if category not in per_type_runtimes:
+                        per_type_runtimes[category] = []
+                    per_type_runtimes[category] += runtimes
                     if db.schema.name not in per_db_runtimes:
                         per_db_runtimes[db.schema.name] = []
                     per_db_runtimes[db.schema.name] += runtimes
@@ -284,14 +412,11 @@ class DataCollector:
     def save_queries(dbs: list[Database], file: Path, filter: Optional[str] = None):
         per_db_queries = {}
         for db in dbs:
-            subdirs = [d for d in Path(f"data/{db.get_path()}").iterdir() if d.is_dir()]
-            for dir in subdirs:
-                if filter is not None and dir.name != filter:
+            for category, benchmark_jsons in DataCollector.read_benchmark_jsons(db).items():
+                if filter is not None and category != filter:
                     continue
-                print(dir)
-                files = [f for f in dir.rglob("*.json")]
-                files.sort()
-                queries = [DataCollector.read_query(f) for f in files]
+                print(f"data/{db.get_path()}/{category}")
+                queries = [b["plan"]["query_text"] for b in benchmark_jsons]
                 if len(queries) > 0:
                     if db.schema.name not in per_db_queries:
                         per_db_queries[db.schema.name] = []
@@ -4,7 +4,6 @@ from pathlib import Path
 from typing import Optional
 
 import jsonpickle
-import requests
 
 from src.schemata import Schema, Type, load_schema
 
@@ -12,6 +11,14 @@ from src.schemata import Schema, Type, load_schema
 COLUMN_SAMPLE_SIZE = 100
 
 
+def post_query(url: str, query_text: str) -> dict:
+    # requests is only needed to talk to the database server, plan consumers do not pay for importing it
+    import requests
+
+    response = requests.post(url, query_text)
+    return json.loads(response.text)
+
+
 @dataclass
 class FixedQueries:
     # location of query files
@@ -38,8 +45,7 @@ class Database:
                     f"select count(*)\n"
                     f"from {table_name};"
                 )
-                response = requests.post(url, query_text)
-                result = json.loads(response.text)
+                result = post_query(url, query_text)
                 result = result["results"][0]["result"][0][0]
                 table.size = result
         self.write_to_cache()
@@ -59,8 +65,7 @@ class Database:
                         f"select avg(length({column.name}))\n"
                         f"from {table.table_name};"
                     )
-                    response = requests.post(url, query_text)
-                    result = json.loads(response.text)
+                    result = post_query(url, query_text)
                     result = result["results"][0]["result"][0][0]
                     if result is None:
                         result = 0
@@ -76,8 +81,7 @@ class Database:
             f"  max({column_name}) "
             f"from {table_name}"
         )
-        response = requests.post(url, query_text)
-        result = json.loads(response.text)
+        result = post_query(url, query_text)
         result = result["results"][0]["result"]
         result = [r[0] for r in result]
         return result
@@ -89,8 +93,7 @@ class Database:
             f"select count(distinct {column_name}) "
             f"from {table_name}"
         )
-        response = requests.post(url, query_text)
-        result = json.loads(response.text)
+        result = post_query(url, query_text)
         result = result["results"][0]["result"]
         result = [r[0] for r in result]
         return result
@@ -104,8 +107,7 @@ class Database:
             f"order by RANDOM() "
             f"limit {COLUMN_SAMPLE_SIZE}"
         )
-        response = requests.post(url, query_text)
-        result = json.loads(response.text)
+        result = post_query(url, query_text)
         result = result["results"][0]["result"]
         result = result[0]
         return result
@@ -22,10 +22,9 @@ class QueryEstimationCache:
         print("evaluating model on all queries... ", end="")
         benchmarks = DataCollector.collect_benchmarks(DatabaseManager.get_all_databases(), predicted_cardinalities)
         self.queries: dict[str, EstimatedQuery] = {}
-        for b in benchmarks:
-            estimate = model.estimate_runtime(b)
-            pipeline_estimate = model.estimate_pipeline_runtime(b)
-            self.queries[b.name] = EstimatedQuery(b, estimate, pipeline_estimate)
+        estimates, pipeline_estimates = model.estimate_batch(benchmarks)
+        for b, estimate, pipeline_estimate in zip(benchmarks, estimates, pipeline_estimates):
+            self.queries[b.name] = EstimatedQuery(b, float(estimate), pipeline_estimate.tolist())
         print("done")
 
 
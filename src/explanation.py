@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from src.features import FeatureMapper
+from src.query_plan import QueryPlan
+
+
+@dataclass
+class PipelineExplanation:
+    """
+    SHAP contributions of the features of one pipeline to the tree output, the negative log of the time per tuple
+    (see get_per_tuple_target). bias + sum(contributions) is the tree output, so a contribution c multiplies the
+    estimate of the pipeline by exp(-c): positive contributions make the pipeline faster, negative ones slower.
+    """
+
+    estimate: float  # seconds, 0 for pipelines without features
+    scan_size: float
+    bias: float
+    contributions: np.ndarray  # per feature, in the order of FeatureMapper.get_names()
+    # contribution of each execution phase ("HashJoin:Probe #3"), features filled by several phases are split by value
+    operators: list[tuple[str, float]]
+    # contributions of features that are 0 in this pipeline, the absence of an operator also moves the prediction
+    unattributed: float
+
+    def get_top_features(self, n: int = 5) -> list[tuple[str, float]]:
+        names = FeatureMapper.get_names()
+        order = np.argsort(-np.abs(self.contributions), kind="stable")[:n]
+        return [(names[i], float(self.contributions[i])) for i in order if self.contributions[i] != 0]
+
+    def to_dict(self, n_features: int = 5) -> dict:
+        operators = {}
+        for phase, contribution in self.operators:
+            # an operator can be listed twice in a pipeline, the contributions of the same phase are summed
+            operators[phase] = operators.get(phase, 0.0) + contribution
+        return {
+            "estimate": self.estimate,
+            "scan_size": self.scan_size,
+            "bias": self.bias,
+            "features": dict(self.get_top_features(n_features)),
+            "operators": operators,
+            "unattributed": self.unattributed,
+        }
+
+
+@dataclass
+class QueryExplanation:
+    name: str
+    estimate: float  # seconds
+    pipelines: list[PipelineExplanation]
+
+    def get_contribution_matrix(self) -> np.ndarray:
+        """
+        (n_pipelines, n_features) contributions, e.g. for FeatureMapper.explain_features
+        """
+        return np.array([p.contributions for p in self.pipelines]).reshape(len(self.pipelines), -1)
+
+    def to_dict(self, n_features: int = 5) -> dict:
+        return {
+            "name": self.name,
+            "estimate": self.estimate,
+            "pipelines": [p.to_dict(n_features) for p in self.pipelines],
+        }
+
+
+def get_operator_contributions(
+    feature_mapper: FeatureMapper, query_plan: QueryPlan, contributions: np.ndarray
+) -> list[tuple[list[tuple[str, float]], float]]:
+    """
+    map the (n_pipelines, n_features) contributions of a plan to the execution phases of its pipelines
+    a feature is shared by all phases of the same operator type and stage in a pipeline, its contribution is split in
+    proportion to the values the phases added to it
+    """
+    result = []
+    for pipeline, phase_matrix, pipeline_contributions in zip(
+        query_plan.pipelines, feature_mapper.get_pipeline_estimation_matrices(query_plan), contributions
+    ):
+        totals = phase_matrix.sum(axis=0)
+        shares = np.divide(phase_matrix, totals, out=np.zeros_like(phase_matrix), where=totals != 0)
+        phase_contributions = shares @ pipeline_contributions
+        operators = [
+            (f"{phase} #{phase.operator.op_id}", float(c)) for phase, c in zip(pipeline.operators, phase_contributions)
+        ]
+        result.append((operators, float(pipeline_contributions[totals == 0].sum())))
+    return result
+
+
+def build_query_explanations(
+    queries: list["BenchmarkedQuery"],
+    feature_mapper: FeatureMapper,
+    contributions: np.ndarray,
+    estimates: np.ndarray,
+    scan_sizes: np.ndarray,
+    offsets: np.ndarray,
+) -> list[QueryExplanation]:
+    """
+    split the pred_contrib output of the stacked pipelines of all queries (one row per pipeline, the features followed
+    by the bias) into one explanation per query
+    """
+    result = []
+    for i, query in enumerate(queries):
+        start, end = offsets[i], offsets[i + 1]
+        query_contributions = contributions[start:end, :-1]
+        operators = get_operator_contributions(feature_mapper, query.query_plan, query_contributions)
+        pipelines = [
+            PipelineExplanation(
+                float(estimates[row]),
+                float(scan_sizes[row]),
+                float(contributions[row, -1]),
+                contributions[row, :-1],
+                pipeline_operators,
+                unattributed,
+            )
+            for row, (pipeline_operators, unattributed) in zip(range(start, end), operators)
+        ]
+        result.append(QueryExplanation(query.name, float(estimates[start:end].sum()), pipelines))
+    return result
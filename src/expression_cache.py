@@ -0,0 +1,156 @@
+import dataclasses
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
+
+from src.operators import Expressions
+
+EXPRESSION_CACHE_PATH = Path("data/expression_cache.sqlite")
+
+# bump when the expression featurization changes, entries of other versions are never read
+EXPRESSION_CACHE_VERSION = 1
+
+
+def get_expression_shape(expression: dict) -> tuple:
+    """
+    canonical form of an expression subtree: the fields _featurize_expression and _get_expression_selectivity read
+    (mode, expression, direction, estimatedSelectivity) followed by the shapes of the subtrees they descend into
+    operands and constants are left out, so predicates that only differ in their literals share the same shape
+    """
+    mode = expression.get("mode")
+    kind = expression.get("expression")
+    shape = (mode, kind, expression.get("direction"), expression.get("estimatedSelectivity"))
+    if mode == "filter":
+        shape += (get_expression_shape(expression["value"]),)
+    if kind == "not":
+        shape += (get_expression_shape(expression["input"]),)
+    elif kind == "and" or kind == "or":
+        shape += tuple(map(get_expression_shape, expression["input"]))
+    return shape
+
+
+def get_expression_key(shape: tuple) -> bytes:
+    """
+    hash of a shape that is stable across processes, the key of the disk tier
+    """
+    return hashlib.blake2b(repr(shape).encode(), digest_size=16).digest()
+
+
+class ExpressionCache:
+    """
+    Memoizes the Expressions of the restrictions and residuals of table scans by the shape of their expressions,
+    generated workloads repeat the same predicates in many plans. Bounded LRU in memory, with an optional sqlite file
+    as second tier that is shared by all processes using the same path (e.g. the training and the serving process).
+    Whole scans are cached because the selectivities of a scan are sums over all its expressions, caching the single
+    expressions would change the order of the additions and with it the last bits of the features.
+    """
+
+    def __init__(self, max_entries: int = 100_000, path: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries: OrderedDict[tuple, Expressions] = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # the connection is shared by the threads of this process, the lock serializes its use
+            self._connection = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS expressions (version INTEGER, key BLOB, value TEXT, PRIMARY KEY (version, key))"
+            )
+            self._connection.commit()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _read_disk(self, key: bytes) -> Optional[Expressions]:
+        row = self._connection.execute(
+            "SELECT value FROM expressions WHERE version = ? AND key = ?", (EXPRESSION_CACHE_VERSION, key)
+        ).fetchone()
+        return Expressions(**json.loads(row[0])) if row is not None else None
+
+    def _write_disk(self, key: bytes, expressions: Expressions):
+        # floats survive the json round trip exactly
+        self._connection.execute(
+            "INSERT OR IGNORE INTO expressions VALUES (?, ?, ?)",
+            (EXPRESSION_CACHE_VERSION, key, json.dumps(dataclasses.asdict(expressions))),
+        )
+        self._connection.commit()
+
+    def _put(self, shape: tuple, expressions: Expressions):
+        self._entries[shape] = expressions
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, expressions: list[dict], featurize: Callable[[], Expressions]) -> Expressions:
+        """
+        the cached Expressions of the restrictions and residuals of a scan, featurize computes them on a miss
+        plans with the same predicates share the returned object, it must not be modified
+        """
+        shape = tuple(map(get_expression_shape, expressions))
+        with self._lock:
+            result = self._entries.get(shape)
+            if result is not None:
+                self._entries.move_to_end(shape)
+                self.hits += 1
+                return result
+            if self._connection is not None:
+                result = self._read_disk(get_expression_key(shape))
+                if result is not None:
+                    self._put(shape, result)
+                    self.disk_hits += 1
+                    return result
+        result = featurize()
+        with self._lock:
+            self.misses += 1
+            self._put(shape, result)
+            if self._connection is not None:
+                self._write_disk(get_expression_key(shape), result)
+        return result
+
+    def clear(self):
+        """
+        drops the entries in memory, the disk tier is kept
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+EXPRESSION_CACHE: Optional[ExpressionCache] = ExpressionCache()
+
+
+def get_expression_cache() -> Optional[ExpressionCache]:
+    return EXPRESSION_CACHE
+
+
+def set_expression_cache(cache: Optional[ExpressionCache]):
+    """
+    replace the cache used by all plan parsers, None featurizes every expression again
+    """
+    global EXPRESSION_CACHE
+    EXPRESSION_CACHE = cache
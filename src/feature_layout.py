@@ -0,0 +1,132 @@
+import struct
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
+
+from src.features import FeatureMapper, get_feature_signature
+
+if TYPE_CHECKING:
+    import lightgbm as lgb
+
+# bump when the binary format changes, the layout itself is identified by its names and signature
+FEATURE_LAYOUT_VERSION = 1
+FEATURE_LAYOUT_MAGIC = b"T3FL"
+
+# magic, format version, number of features, signature (16 hex characters)
+HEADER = struct.Struct("<4sII16s")
+NAME_LENGTH = struct.Struct("<H")
+
+
+class FeatureLayoutMismatch(Exception):
+    pass
+
+
+class FeatureLayout:
+    """
+    Names of the feature vector entries in order, as written next to every saved model (model.txt -> model.layout).
+    Binary format, little endian:
+      4 bytes magic "T3FL", uint32 format version, uint32 number of features, 16 bytes signature (ascii hex),
+      then for each feature an uint16 length and the utf-8 name (<OperatorType>_<OperatorStage>_<Feature>)
+    Consumers build their index maps from the names at startup instead of hardcoding vector positions.
+    """
+
+    def __init__(self, names: list[str]):
+        self.names = list(names)
+        self.signature = get_feature_signature(self.names)
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    @staticmethod
+    def current() -> "FeatureLayout":
+        return FeatureLayout(FeatureMapper.get_names())
+
+    def __eq__(self, other: "FeatureLayout") -> bool:
+        return isinstance(other, FeatureLayout) and self.names == other.names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get_index(self, name: str) -> int:
+        return self._index[name]
+
+    def to_bytes(self) -> bytes:
+        result = [HEADER.pack(FEATURE_LAYOUT_MAGIC, FEATURE_LAYOUT_VERSION, len(self.names), self.signature.encode())]
+        for name in self.names:
+            encoded = name.encode()
+            result.append(NAME_LENGTH.pack(len(encoded)))
+            result.append(encoded)
+        return b"".join(result)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "FeatureLayout":
+        if len(data) < HEADER.size:
+            raise FeatureLayoutMismatch("truncated feature layout")
+        magic, version, n_features, signature = HEADER.unpack_from(data)
+        if magic != FEATURE_LAYOUT_MAGIC:
+            raise FeatureLayoutMismatch("not a feature layout file")
+        if version != FEATURE_LAYOUT_VERSION:
+            raise FeatureLayoutMismatch(f"feature layout format {version}, expected {FEATURE_LAYOUT_VERSION}")
+        names = []
+        offset = HEADER.size
+        for _ in range(n_features):
+            if offset + NAME_LENGTH.size > len(data):
+                raise FeatureLayoutMismatch("truncated feature layout")
+            (length,) = NAME_LENGTH.unpack_from(data, offset)
+            offset += NAME_LENGTH.size
+            names.append(data[offset : offset + length].decode())
+            offset += length
+        layout = FeatureLayout(names)
+        if offset != len(data) or layout.signature != signature.decode():
+            raise FeatureLayoutMismatch("corrupt feature layout")
+        return layout
+
+    def save(self, path: Path):
+        with open(path, "wb") as fd:
+            fd.write(self.to_bytes())
+
+    @staticmethod
+    def load(path: Path) -> "FeatureLayout":
+        with open(path, "rb") as fd:
+            return FeatureLayout.from_bytes(fd.read())
+
+    def check(self, expected: Optional["FeatureLayout"] = None, source: str = "model"):
+        """
+        models trained on a different feature layout would silently produce garbage predictions
+        """
+        expected = expected if expected is not None else FeatureLayout.current()
+        if self != expected:
+            mismatches = [f"{i}: {a} != {b}" for i, (a, b) in enumerate(zip(self.names, expected.names)) if a != b][:5]
+            raise FeatureLayoutMismatch(
+                f"{source} has {len(self)} features, expected {len(expected)} "
+                f"(signature {self.signature} != {expected.signature}) {', '.join(mismatches)}"
+            )
+
+
+def get_feature_layout_path(model_file: Path) -> Path:
+    return Path(model_file).with_suffix(".layout")
+
+
+def check_feature_layout(booster: "lgb.Booster"):
+    FeatureLayout(booster.feature_name()).check()
+
+
+def save_model(booster: "lgb.Booster", model_file: Path):
+    """
+    save the booster together with the feature layout it was trained on
+    """
+    layout = FeatureLayout(booster.feature_name())
+    booster.save_model(str(model_file))
+    layout.save(get_feature_layout_path(model_file))
+
+
+def load_model(model_file: Path) -> "lgb.Booster":
+    """
+    load a booster and refuse it if its feature layout does not match the current one
+    the layout file is checked if present (older models only have the feature names of the booster)
+    """
+    import lightgbm as lgb
+
+    layout_file = get_feature_layout_path(model_file)
+    if layout_file.exists():
+        FeatureLayout.load(layout_file).check(source=str(layout_file))
+    booster = lgb.Booster(model_file=str(model_file))
+    check_feature_layout(booster)
+    return booster
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from src.database import Database
+from src.features import FeatureMapper, get_feature_signature
+from src.optimizer import BenchmarkedQuery, QueryCategory, get_per_tuple_target
+from src.plan_archive import get_current_plan_archive
+
+FEATURE_CACHE_PATH = Path("data/feature_cache")
+
+# bump when the stored arrays or their meaning change
+FEATURE_STORE_VERSION = 1
+
+ARRAYS = ("x", "scan_sizes", "pipeline_runtimes", "offsets", "total_runtimes", "categories")
+
+
+@dataclass
+class FeatureTable:
+    """
+    Featurized benchmark runs of one database, column oriented
+    the pipelines of query i are the rows offsets[i] to offsets[i + 1] of x, scan_sizes and pipeline_runtimes
+    """
+
+    x: np.ndarray
+    scan_sizes: np.ndarray
+    pipeline_runtimes: np.ndarray  # in seconds
+    offsets: np.ndarray
+    total_runtimes: np.ndarray  # median runtime per query in seconds
+    categories: np.ndarray  # QueryCategory values
+    names: list[str]
+
+    @staticmethod
+    def from_benchmarks(benchmarks: list[BenchmarkedQuery], dtype: np.dtype = np.float64) -> "FeatureTable":
+        feature_mapper = FeatureMapper(dtype)
+        matrices = [b.get_feature_matrix(feature_mapper) for b in benchmarks]
+        offsets = np.zeros(len(benchmarks) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(m) for m in matrices])
+        return FeatureTable(
+            np.vstack(matrices) if matrices else np.empty((0, feature_mapper.n_features), dtype=feature_mapper.dtype),
+            np.concatenate([feature_mapper.get_pipeline_scan_sizes(b.query_plan) for b in benchmarks] + [[]]),
+            np.concatenate([b.get_pipeline_runtimes() for b in benchmarks] + [[]]),
+            offsets,
+            np.array([b.get_total_runtime() for b in benchmarks], dtype=np.float64),
+            np.array([b.query_category.value for b in benchmarks], dtype=np.int64),
+            [b.name for b in benchmarks],
+        )
+
+    def get_query_features(self, i: int) -> np.ndarray:
+        return self.x[self.offsets[i] : self.offsets[i + 1]]
+
+    def get_pipeline_categories(self) -> np.ndarray:
+        return np.repeat(self.categories, np.diff(self.offsets))
+
+    def get_per_tuple_training_data(
+        self, exclude_query_category: list[QueryCategory] = []
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        same rows and targets as optimizer.get_per_tuple_training_data
+        """
+        keep = self.x.any(axis=1)
+        if len(exclude_query_category) != 0:
+            keep &= ~np.isin(self.get_pipeline_categories(), [c.value for c in exclude_query_category])
+        scan_sizes = self.scan_sizes[keep]
+        runtimes = self.pipeline_runtimes[keep]
+        per_tuple = np.where(scan_sizes == 0, runtimes, runtimes / np.where(scan_sizes == 0, 1, scan_sizes))
+        return np.asarray(self.x[keep]), get_per_tuple_target(per_tuple)
+
+
+def get_source_files(db: Database) -> list[Path]:
+    """
+    the files DataCollector reads the benchmarks of the database from, its plan archive if there is one
+    """
+    archive = get_current_plan_archive(db)
+    if archive is not None:
+        return [archive]
+    files = [f for f in Path(f"data/{db.get_path()}").rglob("*.json")]
+    files.sort()
+    return files
+
+
+def get_source_fingerprint(files: list[Path]) -> str:
+    """
+    changes whenever a benchmark file is added, removed or rewritten, only needs a stat per file
+    """
+    fingerprint = hashlib.sha256()
+    for file in files:
+        stat = file.stat()
+        fingerprint.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return fingerprint.hexdigest()[:16]
+
+
+class FeatureStore:
+    """
+    On disk cache of the featurized benchmarks of each database, one directory of .npy files per database and
+    cardinality mode. Entries are valid as long as the benchmark files and the feature layout did not change and are
+    loaded memory mapped, so training data is available without parsing a single plan.
+    The feature matrices are stored in the precision of the store, float32 stores are kept in their own directories.
+    """
+
+    def __init__(self, path: Path = FEATURE_CACHE_PATH, dtype: np.dtype = np.float64):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+
+    def _get_entry_path(self, db: Database, predicted_cardinalities: bool) -> Path:
+        mode = "predicted" if predicted_cardinalities else "exact"
+        precision = "" if self.dtype == np.float64 else f"_{self.dtype.name}"
+        return self.path / f"{db.get_path()}_{mode}{precision}"
+
+    def _get_meta(self, files: list[Path]) -> dict:
+        return {
+            "version": FEATURE_STORE_VERSION,
+            "sources": get_source_fingerprint(files),
+            "features": get_feature_signature(FeatureMapper.get_names()),
+        }
+
+    def load(self, db: Database, predicted_cardinalities: bool) -> Optional[FeatureTable]:
+        """
+        the stored table, or None if there is none or it is outdated
+        """
+        entry = self._get_entry_path(db, predicted_cardinalities)
+        meta_file = entry / "meta.json"
+        if not meta_file.exists():
+            return None
+        with open(meta_file, "r") as fd:
+            meta = json.load(fd)
+        if {k: meta.get(k) for k in ("version", "sources", "features")} != self._get_meta(get_source_files(db)):
+            return None
+        arrays = {name: np.load(entry / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        return FeatureTable(**arrays, names=meta["names"])
+
+    def save(self, db: Database, predicted_cardinalities: bool, table: FeatureTable, files: list[Path]):
+        entry = self._get_entry_path(db, predicted_cardinalities)
+        tmp_entry = entry.with_name(entry.name + ".tmp")
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tmp_entry.mkdir(parents=True)
+        for name in ARRAYS:
+            np.save(tmp_entry / f"{name}.npy", np.ascontiguousarray(getattr(table, name)))
+        with open(tmp_entry / "meta.json", "w") as fd:
+            json.dump({**self._get_meta(files), "names": table.names}, fd)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_entry, entry)
+
+    def get_table(self, db: Database, predicted_cardinalities: bool) -> FeatureTable:
+        """
+        load the table of the database, featurizing (and storing) its benchmarks if necessary
+        """
+        table = self.load(db, predicted_cardinalities)
+        if table is None:
+            # data_collection attaches stored features to the queries it reads, so it imports this module
+            from src.data_collection import DataCollector
+
+            # fingerprint before reading, a file rewritten meanwhile invalidates the entry on the next load
+            files = get_source_files(db)
+            benchmarks = DataCollector.collect_db_benchmark_runs(db, predicted_cardinalities)
+            table = FeatureTable.from_benchmarks(benchmarks, self.dtype)
+            self.save(db, predicted_cardinalities, table, files)
+        return table
+
+    def attach_features(self, db: Database, predicted_cardinalities: bool, benchmarks: list[BenchmarkedQuery]):
+        """
+        set the feature matrices of freshly read benchmarks from the store, so they are not featurized again
+        """
+        table = self.load(db, predicted_cardinalities)
+        if table is None or table.names != [b.name for b in benchmarks]:
+            return
+        for i, benchmark in enumerate(benchmarks):
+            benchmark.feature_matrix = table.get_query_features(i)
+
+    def get_per_tuple_training_data(
+        self, dbs: list[Database], predicted_cardinalities: bool, exclude_query_category: list[QueryCategory] = []
+    ) -> tuple[np.ndarray, np.ndarray]:
+        tables = [self.get_table(db, predicted_cardinalities) for db in dbs]
+        data = [t.get_per_tuple_training_data(exclude_query_category) for t in tables]
+        return np.vstack([x for x, _ in data]), np.concatenate([y for _, y in data])
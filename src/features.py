@@ -1,13 +1,19 @@
+import hashlib
 import json
-from typing import Optional
+import sys
+from typing import Optional, TYPE_CHECKING
 
 import numpy as np
 
-from src.operator_stages import OperatorStage, ExecutionPhase
-from src.operators import OperatorType
+from src.operator_stages import OperatorStage, ExecutionPhase, Pipeline
+from src.operators import OperatorType, Expressions
 from src.query_plan import QueryPlan
 from src.util import AutoNumber
 
+if TYPE_CHECKING:
+    # scipy is only imported when sparse matrices are requested
+    from scipy.sparse import csr_matrix
+
 
 class Feature(AutoNumber):
     # Features that we have for each operator
@@ -178,7 +184,7 @@ class QualifiedFeature:
     @staticmethod
     def get_feature_index_lookup() -> dict["QualifiedFeature", int]:
         result = {}
-        for i, f in enumerate(QualifiedFeature.enumerate_features()):
+        for i, f in enumerate(FEATURES):
             result[f] = i
         return result
 
@@ -186,7 +192,7 @@ class QualifiedFeature:
     def get_feature_lookup() -> dict[OperatorType, dict[OperatorStage, list["QualifiedFeature"]]]:
         """ """
         result = {}
-        for feature in QualifiedFeature.enumerate_features():
+        for feature in FEATURES:
             if feature.operator_type not in result:
                 result[feature.operator_type] = {}
             if feature.operator_stage not in result[feature.operator_type]:
@@ -212,12 +218,61 @@ class QualifiedFeature:
         return hash((self.operator_type, self.operator_stage, self.feature))
 
 
+# the layout only depends on QualifiedFeature.pipeline_time_features, it is enumerated once at import and frozen
+FEATURES: tuple[QualifiedFeature, ...] = tuple(QualifiedFeature.enumerate_features())
+FEATURE_NAMES: tuple[str, ...] = tuple(
+    f"Global_{f.feature.name}" if f.operator_type is None else f.get_name() for f in FEATURES
+)
+
+
+# precisions of the feature matrices, sums of phase values are always computed in float64
+FEATURE_DTYPES = (np.dtype(np.float64), np.dtype(np.float32))
+
+
+def get_feature_signature(names: list[str]) -> str:
+    return hashlib.sha256("\n".join(names).encode()).hexdigest()[:16]
+
+
+def is_sparse(x) -> bool:
+    # there are no sparse matrices as long as scipy.sparse was not imported, so the check never imports it
+    sparse = sys.modules.get("scipy.sparse")
+    return sparse is not None and sparse.issparse(x)
+
+
+def to_sparse(matrix: np.ndarray) -> "csr_matrix":
+    from scipy.sparse import csr_matrix
+
+    return csr_matrix(matrix)
+
+
 class FeatureMapper:
     _lookup = QualifiedFeature.get_feature_lookup()
     _index_lookup = QualifiedFeature.get_feature_index_lookup()
-    _features = QualifiedFeature.enumerate_features()
+    _features = list(FEATURES)
     n_features = len(_features)
 
+    def __init__(self, dtype: np.dtype = np.float64):
+        """
+        float32 halves the memory of large feature matrices, LightGBM compares them against its float64 thresholds
+        """
+        assert np.dtype(dtype) in FEATURE_DTYPES, f"unsupported feature dtype {dtype}"
+        self.dtype = np.dtype(dtype)
+
+    @staticmethod
+    def get_scatter_lookup() -> dict[tuple[OperatorType, OperatorStage], tuple[np.ndarray, np.ndarray]]:
+        """
+        for each operator type and stage: which entries of the phase values (indexed by Feature.value) go to which
+        index of the feature vector
+        """
+        result = {}
+        for index, f in enumerate(FEATURES):
+            sources, targets = result.setdefault((f.operator_type, f.operator_stage), ([], []))
+            sources.append(f.feature.value)
+            targets.append(index)
+        return {k: (np.array(sources), np.array(targets)) for k, (sources, targets) in result.items()}
+
+    _scatter_lookup = get_scatter_lookup()
+
     @staticmethod
     def get_features(op: OperatorType, stage: OperatorStage) -> list[QualifiedFeature]:
         if stage not in FeatureMapper._lookup[op]:
@@ -225,125 +280,191 @@ class FeatureMapper:
         return FeatureMapper._lookup[op][stage]
 
     def get_empty_feature_vector(self) -> np.ndarray:
-        return np.zeros(self.n_features, dtype=float)
+        return np.zeros(self.n_features, dtype=self.dtype)
 
-    def get_estimation_vector(self, phase: ExecutionPhase) -> np.ndarray:
-        output_cardinality = phase.get_output_cardinality()
-        input_cardinality = phase.get_input_cardinality()
-        right_input_cardinality = phase.get_right_input_cardinality()
-        output_size = phase.operator.output_tuple_size
-        input_size = phase.operator.input_op.output_tuple_size if phase.operator.input_op is not None else 0
-        input_percentage = phase.get_input_percentage()
-        output_percentage = phase.get_output_percentage()
-        right_percentage = phase.get_right_percentage()
+    @staticmethod
+    def get_phase_values(phase: ExecutionPhase) -> list[float]:
+        """
+        values of all operator features of the phase, indexed by Feature.value (global features are 0)
+        """
+        return FeatureMapper.get_operator_values(
+            phase.operator.type,
+            phase.stage,
+            phase.get_input_cardinality(),
+            phase.operator.input_op.output_tuple_size if phase.operator.input_op is not None else 0,
+            phase.get_output_cardinality(),
+            phase.operator.output_tuple_size,
+            phase.get_right_input_cardinality(),
+            phase.get_input_percentage(),
+            phase.get_output_percentage(),
+            phase.get_right_percentage(),
+            phase.operator.expressions,
+        )
 
+    @staticmethod
+    def get_operator_values(
+        operator_type: OperatorType,
+        stage: OperatorStage,
+        input_cardinality: float,
+        input_size: float,
+        output_cardinality: float,
+        output_size: float,
+        right_input_cardinality: float,
+        input_percentage: float,
+        output_percentage: float,
+        right_percentage: Optional[float],
+        expressions: Expressions,
+    ) -> list[float]:
+        """
+        get_phase_values from the cardinalities of the phase, for featurizers that do not build execution phases
+        """
         assert float(output_cardinality) or True
         assert float(input_cardinality) or True
         assert float(right_input_cardinality) or True
-        if phase.operator.type == OperatorType.HashJoin:
-            if phase.stage == OperatorStage.Build:
+        if operator_type == OperatorType.HashJoin:
+            if stage == OperatorStage.Build:
                 output_cardinality = input_cardinality
                 output_size = input_size
                 output_percentage = input_percentage
 
-        expressions = phase.operator.expressions
-
-        features = {
-            Feature.out_card: output_cardinality,
-            Feature.in_card: input_cardinality,
-            Feature.out_size: output_size,
-            Feature.in_size: input_size,
-            Feature.const: 1,
-            Feature.in_percentage: input_percentage,
-            Feature.out_percentage: output_percentage,
-            Feature.right_percentage: right_percentage,
-            Feature.right_card: right_input_cardinality,
-            Feature.like_count: expressions.like_count,
-            Feature.like_percentage: expressions.like_selectivity,
-            Feature.compare_count: expressions.compare_count,
-            Feature.compare_percentage: expressions.compare_selectivity,
-            Feature.in_expression_count: expressions.in_expression_count,
-            Feature.in_expression_percentage: expressions.in_expression_selectivity,
-            Feature.between_count: expressions.between_count,
-            Feature.between_percentage: expressions.between_selectivity,
-            Feature.or_exp_count: expressions.or_expression_count,
-            Feature.or_exp_percentage: expressions.or_selectivity,
-            Feature.starts_with_count: expressions.starts_with_count,
-            Feature.starts_with_percentage: expressions.starts_with_selectivity,
-            Feature.join_filter_count: expressions.join_filter_count,
-            Feature.false_count: expressions.false_count,
-            Feature.empty_output: 1 if output_cardinality == 0 else 0,
-        }
-        assert len(Feature) == len(features) + len(Feature.get_global_features())
+        # same order as the Feature enum
+        values = [
+            input_cardinality,  # in_card
+            input_size,  # in_size
+            output_cardinality,  # out_card
+            output_size,  # out_size
+            1 if output_cardinality == 0 else 0,  # empty_output
+            0,  # pipeline_scan_card
+            0,  # pipeline_sink_card
+            1,  # const
+            input_percentage,  # in_percentage
+            right_percentage,  # right_percentage
+            output_percentage,  # out_percentage
+            right_input_cardinality,  # right_card
+            expressions.like_count,
+            expressions.like_selectivity,
+            expressions.compare_count,
+            expressions.compare_selectivity,
+            expressions.in_expression_count,
+            expressions.in_expression_selectivity,
+            expressions.between_count,
+            expressions.between_selectivity,
+            expressions.or_expression_count,
+            expressions.or_selectivity,
+            expressions.starts_with_count,
+            expressions.starts_with_selectivity,
+            expressions.join_filter_count,
+            expressions.false_count,
+        ]
+        assert len(values) == len(Feature)
+        return values
 
-        result = self.get_empty_feature_vector()
-        assert (
-            len(self.get_features(phase.operator.type, phase.stage)) > 0
-        ), f"no features for {phase.operator.type.name} - {phase.stage.name}"
-        for f in self.get_features(phase.operator.type, phase.stage):
-            value = features[f.feature]
-            index = self._index_lookup[f]
-            result[index] = value
+    def _get_scatter_indices(self, phase: ExecutionPhase) -> tuple[np.ndarray, np.ndarray]:
+        return self.get_scatter_indices(phase.operator.type, phase.stage)
 
+    def get_scatter_indices(self, operator_type: OperatorType, stage: OperatorStage) -> tuple[np.ndarray, np.ndarray]:
+        indices = self._scatter_lookup.get((operator_type, stage))
+        assert indices is not None, f"no features for {operator_type.name} - {stage.name}"
+        return indices
+
+    def get_estimation_vector(self, phase: ExecutionPhase) -> np.ndarray:
+        sources, targets = self._get_scatter_indices(phase)
+        result = self.get_empty_feature_vector()
+        result[targets] = np.array(self.get_phase_values(phase), dtype=float)[sources]
         return result
 
+    def get_phases_matrix(
+        self, phases: list[ExecutionPhase], rows: list[int], n_rows: int, as_sparse: bool = False
+    ) -> "np.ndarray | csr_matrix":
+        """
+        sum the feature vectors of the phases into the given rows of a (n_rows, n_features) matrix
+        the values of all phases are gathered into one array and scattered into the matrix with a single bincount,
+        which adds up the entries of a row in phase order just like summing the single vectors
+        """
+        values = [self.get_phase_values(phase) for phase in phases]
+        indices = [self._get_scatter_indices(phase) for phase in phases]
+        return self.scatter_phase_values(values, indices, rows, n_rows, as_sparse)
+
+    def scatter_phase_values(
+        self,
+        values: list[list[float]],
+        indices: list[tuple[np.ndarray, np.ndarray]],
+        rows: list[int],
+        n_rows: int,
+        as_sparse: bool = False,
+    ) -> "np.ndarray | csr_matrix":
+        """
+        the scatter of get_phases_matrix for phase values (get_phase_values) and scatter indices computed elsewhere
+        """
+        if len(values) == 0:
+            result = np.zeros((n_rows, self.n_features), dtype=self.dtype)
+            return to_sparse(result) if as_sparse else result
+        values = np.array(values, dtype=float)
+        counts = [len(sources) for sources, _ in indices]
+        sources = np.concatenate([sources for sources, _ in indices])
+        sources += np.repeat(np.arange(len(values)) * len(Feature), counts)
+        targets = np.concatenate([targets for _, targets in indices])
+        targets += np.repeat(np.array(rows) * self.n_features, counts)
+        result = np.bincount(targets, weights=values.ravel()[sources], minlength=n_rows * self.n_features)
+        result = result.reshape(n_rows, self.n_features).astype(self.dtype, copy=False)
+        # pipelines fill less than 15 of the features, the sparse matrix keeps only those
+        return to_sparse(result) if as_sparse else result
+
     def get_estimation_matrix(self, query_plan: QueryPlan) -> np.ndarray:
         """
         get a feature vector for each operator in the query plan
         """
-        row_vectors: list[np.ndarray] = []
-        for pipeline in query_plan.pipelines:
-            for op in pipeline.operators:
-                row_vectors.append(self.get_estimation_vector(op))
-        return np.vstack(row_vectors)
+        phases = [op for pipeline in query_plan.pipelines for op in pipeline.operators]
+        return self.get_phases_matrix(phases, list(range(len(phases))), len(phases))
 
-    def get_pipeline_estimation_matrix(self, query_plan: QueryPlan) -> np.ndarray:
+    def get_pipeline_estimation_matrix(self, query_plan: QueryPlan, as_sparse: bool = False) -> "np.ndarray | csr_matrix":
         """
         get a feature vector for each pipeline in the query plan
         """
-        result = []
-        for pipeline in query_plan.pipelines:
-            row_vectors: list[np.ndarray] = [self.get_empty_feature_vector()]
-            for op in pipeline.operators:
-                row_vectors.append(self.get_estimation_vector(op))
-            pipeline_vector = np.sum(np.vstack(row_vectors), axis=0)
-            result.append(pipeline_vector)
-        return np.vstack(result)
+        phases = []
+        rows = []
+        for i, pipeline in enumerate(query_plan.pipelines):
+            phases += pipeline.operators
+            rows += [i] * len(pipeline.operators)
+        return self.get_phases_matrix(phases, rows, len(query_plan.pipelines), as_sparse)
 
     def get_pipeline_estimation_matrices(self, query_plan: QueryPlan) -> list[np.ndarray]:
         """
         get a feature vector for each operator in each pipeline
         build matrices by pipelines
         """
-        result = []
-        for pipeline in query_plan.pipelines:
-            row_vectors: list[np.ndarray] = []
-            for op in pipeline.operators:
-                row_vectors.append(self.get_estimation_vector(op))
-            pipeline_matrix = np.vstack(row_vectors)
-            result.append(pipeline_matrix)
-        return result
-
-    def explain_features(self, query_plan: QueryPlan, pipeline: Optional[int] = None, verbose: bool = False):
+        matrix = self.get_estimation_matrix(query_plan)
+        offsets = np.cumsum([len(pipeline.operators) for pipeline in query_plan.pipelines])
+        return np.split(matrix, offsets[:-1])
+
+    def explain_features(
+        self,
+        query_plan: QueryPlan,
+        pipeline: Optional[int] = None,
+        verbose: bool = False,
+        contributions: Optional[np.ndarray] = None,
+    ):
+        """
+        print the features of each pipeline
+        contributions (n_pipelines, n_features), e.g. QueryExplanation.get_contribution_matrix, are printed next to
+        the values, features that are 0 but moved the prediction are printed as well
+        """
         for i, pipeline_vector in enumerate(self.get_pipeline_estimation_matrix(query_plan)):
             if pipeline is None or i == pipeline:
                 print(f" Pipeline{i} (scan: {query_plan.pipelines[i].get_pipeline_scan_cardinality()} tuples)")
-                for n, v in zip(self.get_names(), pipeline_vector):
-                    if verbose or v > 0.0:
-                        print(f"  {n}: {v}")
+                for j, (n, v) in enumerate(zip(self.get_names(), pipeline_vector)):
+                    if contributions is None:
+                        if verbose or v > 0.0:
+                            print(f"  {n}: {v}")
+                    elif verbose or v > 0.0 or contributions[i, j] != 0.0:
+                        print(f"  {n}: {v} (contribution: {contributions[i, j]:+.4f})")
 
     def get_single_estimation_vector(self, query_plan: QueryPlan):
         return np.sum(self.get_estimation_matrix(query_plan), axis=0)
 
     @staticmethod
     def get_names() -> list[str]:
-        res = []
-        for f in QualifiedFeature.enumerate_features():
-            if f.operator_type is None:
-                res.append(f"Global_{f.feature.name}")
-            else:
-                res.append(f"{f.operator_type.name}_{f.operator_stage.name}_{f.feature.name}")
-        return res
+        return list(FEATURE_NAMES)
 
     @staticmethod
     def get_pipeline_scan_sizes(query_plan: QueryPlan) -> np.ndarray:
@@ -353,7 +474,7 @@ class FeatureMapper:
     @staticmethod
     def get_portable_feature_encoding():
         result = {}
-        for i, f in enumerate(QualifiedFeature.enumerate_features()):
+        for i, f in enumerate(FEATURES):
             if f.operator_type.name not in result:
                 result[f.operator_type.name] = {}
             if f.operator_stage.name not in result[f.operator_type.name]:
@@ -364,6 +485,138 @@ class FeatureMapper:
         print(result)
 
 
+class PlanSkeleton:
+    """
+    The structure of a query plan compiled for featurization: operator stages, pipeline membership and the feature
+    slots of each execution phase. What-if scenarios only change cardinalities, so the pipeline feature matrix and the
+    scan sizes are recomputed from a cardinality array with array math instead of copying and walking the plan.
+    The cardinality array has one row per operator (in the order of query_plan.operators) with the input, output and
+    right input cardinality, the latter is NaN for operators without a right input.
+    """
+
+    INPUT = 0
+    OUTPUT = 1
+    RIGHT = 2
+
+    def __init__(self, query_plan: QueryPlan, feature_mapper: Optional[FeatureMapper] = None):
+        feature_mapper = feature_mapper if feature_mapper is not None else FeatureMapper()
+        operators = list(query_plan.operators.values())
+        op_index = {op.op_id: i for i, op in enumerate(operators)}
+        self.n_features = feature_mapper.n_features
+        self.dtype = feature_mapper.dtype
+        self.n_pipelines = len(query_plan.pipelines)
+        self.operator_types = [op.type for op in operators]
+        self.cardinalities = np.array(
+            [
+                (
+                    op.input_cardinality,
+                    op.output_cardinality,
+                    op.right_input_cardinality if op.right_input_cardinality is not None else np.nan,
+                )
+                for op in operators
+            ],
+            dtype=float,
+        ).reshape(len(operators), 3)
+
+        def get_scan_source(pipeline: Pipeline) -> tuple[int, int]:
+            """operator and cardinality column of Pipeline.get_pipeline_scan_cardinality, -1 for empty pipelines"""
+            if len(pipeline.operators) == 0:
+                return -1, self.INPUT
+            first = pipeline.operators[0].operator
+            scan_output = first.type in (OperatorType.GroupBy, OperatorType.Sort, OperatorType.Temp)
+            return op_index[first.op_id], self.OUTPUT if scan_output else self.INPUT
+
+        self.pipeline_scan = np.array([get_scan_source(p) for p in query_plan.pipelines], dtype=np.intp)
+        self.pipeline_scan = self.pipeline_scan.reshape(self.n_pipelines, 2)
+
+        phases = []
+        rows = []
+        for i, pipeline in enumerate(query_plan.pipelines):
+            phases += pipeline.operators
+            rows += [i] * len(pipeline.operators)
+        self.n_phases = len(phases)
+        self.phase_ops = np.array([op_index[p.operator.op_id] for p in phases], dtype=np.intp)
+        self.phase_scan = np.array([get_scan_source(p.pipeline) for p in phases], dtype=np.intp).reshape(-1, 2)
+        self.fraction = np.array([p.fraction for p in phases], dtype=float)
+        self.is_probe = np.array([p.stage == OperatorStage.Probe for p in phases], dtype=bool)
+        self.is_pipeline_end = np.array([p.pipeline.operators[-1] == p for p in phases], dtype=bool)
+        self.is_hash_build = np.array(
+            [p.operator.type == OperatorType.HashJoin and p.stage == OperatorStage.Build for p in phases], dtype=bool
+        )
+        # sizes, constants and expressions do not depend on cardinalities
+        self.values = np.array([feature_mapper.get_phase_values(p) for p in phases], dtype=float)
+        self.values = self.values.reshape(self.n_phases, len(Feature))
+
+        # the scatter of FeatureMapper.get_phases_matrix, flattened once
+        indices = [feature_mapper._get_scatter_indices(p) for p in phases]
+        counts = [len(sources) for sources, _ in indices]
+        self.sources = np.concatenate([sources for sources, _ in indices] + [np.zeros(0, dtype=np.intp)])
+        self.sources += np.repeat(np.arange(self.n_phases) * len(Feature), counts)
+        self.targets = np.concatenate([targets for _, targets in indices] + [np.zeros(0, dtype=np.intp)])
+        self.targets += np.repeat(np.array(rows, dtype=np.intp) * self.n_features, counts)
+
+    def get_cardinalities(self) -> np.ndarray:
+        """
+        the cardinalities of the compiled plan, a copy that can be modified
+        """
+        return self.cardinalities.copy()
+
+    @staticmethod
+    def _get_scan_cardinalities(cardinalities: np.ndarray, scan: np.ndarray) -> np.ndarray:
+        if len(scan) == 0:
+            return np.zeros(0)
+        return np.where(scan[:, 0] >= 0, cardinalities[scan[:, 0], scan[:, 1]], 0.0)
+
+    def get_scan_sizes(self, cardinalities: np.ndarray) -> np.ndarray:
+        """
+        same as FeatureMapper.get_pipeline_scan_sizes for the plan with the given cardinalities
+        """
+        return self._get_scan_cardinalities(np.asarray(cardinalities, dtype=float), self.pipeline_scan)
+
+    def get_phase_values(self, cardinalities: np.ndarray) -> np.ndarray:
+        """
+        FeatureMapper.get_phase_values of all phases for the plan with the given cardinalities
+        """
+        cardinalities = np.asarray(cardinalities, dtype=float)
+        input_card, output_card, right_card = cardinalities[self.phase_ops].T
+        scan = self._get_scan_cardinalities(cardinalities, self.phase_scan)
+        has_scan = scan != 0
+        scan = np.where(has_scan, scan, 1.0)
+        has_right = ~np.isnan(right_card)
+
+        input_cardinality = np.where(self.is_probe, input_card, input_card * self.fraction)
+        output_cardinality = np.where(self.is_pipeline_end, output_card, output_card * self.fraction)
+        right_input_cardinality = np.where(
+            has_right, np.where(self.is_probe, right_card * self.fraction, right_card), 0.0
+        )
+        input_percentage = np.where(has_scan, input_card * self.fraction / scan, 0.0)
+        output_percentage = np.where(has_scan, output_card * self.fraction / scan, 0.0)
+        right_percentage = np.where(has_scan, right_card * self.fraction / scan, np.where(has_right, 0.0, np.nan))
+        output_cardinality = np.where(self.is_hash_build, input_cardinality, output_cardinality)
+        output_percentage = np.where(self.is_hash_build, input_percentage, output_percentage)
+
+        values = self.values.copy()
+        values[:, Feature.in_card.value] = input_cardinality
+        values[:, Feature.out_card.value] = output_cardinality
+        values[:, Feature.empty_output.value] = output_cardinality == 0
+        values[:, Feature.in_percentage.value] = input_percentage
+        values[:, Feature.right_percentage.value] = right_percentage
+        values[:, Feature.out_percentage.value] = output_percentage
+        values[:, Feature.right_card.value] = right_input_cardinality
+        return values
+
+    def get_feature_matrix(self, cardinalities: np.ndarray, as_sparse: bool = False) -> "np.ndarray | csr_matrix":
+        """
+        same as FeatureMapper.get_pipeline_estimation_matrix for the plan with the given cardinalities
+        """
+        values = self.get_phase_values(cardinalities)
+        result = np.bincount(
+            self.targets, weights=values.ravel()[self.sources], minlength=self.n_pipelines * self.n_features
+        )
+        result = result.reshape(self.n_pipelines, self.n_features).astype(self.dtype, copy=False)
+        return to_sparse(result) if as_sparse else result
+
+
 def main():
     print("\n".join(f"{i} {n}" for i, n in enumerate(FeatureMapper.get_names())))
     FeatureMapper.get_portable_feature_encoding()
@@ -30,7 +30,7 @@ def get_test_numbers(predicted_cardinalities: bool):
 
     benchmarks = DataCollector.collect_benchmarks([job_db], predicted_cardinalities, query_category=[QueryCategory.fixed])
     runtimes = [b.get_total_runtime() for b in benchmarks]
-    estimates = [model.estimate_runtime(q) for q in benchmarks]
+    estimates, _ = model.estimate_batch(benchmarks)
     q_errors = [q_error(e, r) for e, r in zip(estimates, runtimes)]
     return {"Avg": np.average(q_errors), "p50": np.quantile(q_errors, 0.5), "p90": np.quantile(q_errors, 0.9)}
 
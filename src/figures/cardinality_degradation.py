@@ -1,5 +1,3 @@
-from copy import deepcopy
-
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy.ndimage import gaussian_filter1d
@@ -13,9 +11,11 @@ from src.figures.infra import (
     get_figure_path,
     get_figure_format,
 )
+from src.features import PlanSkeleton
 from src.metrics import q_error
+from src.model import split_pipeline_predictions
 from src.operators import OperatorType
-from src.optimizer import optimize_per_tuple_tree_model, BenchmarkedQuery, QueryCategory
+from src.optimizer import optimize_per_tuple_tree_model, QueryCategory
 
 ZERO_SHOT_CARD_DEGRADATION = {
     1.0: (1.3077527284622192, 2.2515373706817634, 1.6862062),
@@ -493,21 +493,22 @@ def split_databases(name: str) -> tuple[list[Database], list[Database]]:
     return train_databases, test_databases
 
 
-def get_card_error_tree(original_query: BenchmarkedQuery, expected_q_error: float):
-    query = deepcopy(original_query)
-    query.feature_matrix = None
+def get_card_error_tree(skeleton: PlanSkeleton, expected_q_error: float) -> np.ndarray:
+    """
+    cardinalities of the compiled plan with all estimates off by the expected q-error
+    """
+    cardinalities = skeleton.get_cardinalities()
     current_factor = expected_q_error
     if np.random.choice([True, False]):
         current_factor = 1 / current_factor
-    for _, op in query.query_plan.operators.items():
-        if op.type != OperatorType.TableScan:
-            op.input_cardinality *= current_factor
-        # Group bys which return a single tuple will always be estimated correctly
-        if op.type != OperatorType.GroupBy and op.output_cardinality != 1:
-            op.output_cardinality *= current_factor
-        if op.right_input_cardinality is not None:
-            op.right_input_cardinality *= current_factor
-    return query
+    operator_types = np.array([t.value for t in skeleton.operator_types], dtype=int)
+    cardinalities[operator_types != OperatorType.TableScan.value, PlanSkeleton.INPUT] *= current_factor
+    # Group bys which return a single tuple will always be estimated correctly
+    output = (operator_types != OperatorType.GroupBy.value) & (cardinalities[:, PlanSkeleton.OUTPUT] != 1)
+    cardinalities[output, PlanSkeleton.OUTPUT] *= current_factor
+    # operators without right input have NaN there
+    cardinalities[:, PlanSkeleton.RIGHT] *= current_factor
+    return cardinalities
 
 
 def compute_card_degen():
@@ -531,14 +532,17 @@ def compute_card_degen():
             np.arange(1000, 10000, 100),
         ]
     )
+    # the plans only differ in their cardinalities, compile them once and refeaturize from the cardinalities
+    skeletons = [PlanSkeleton(q.query_plan, model.get_feature_mapper()) for q in test_benchmarks]
+    runtimes = [b.get_total_runtime() for b in test_benchmarks]
+    offsets = np.zeros(len(skeletons) + 1, dtype=int)
+    offsets[1:] = np.cumsum([s.n_pipelines for s in skeletons])
     print("Computing accuracy with degenerated cardinalities...")
     for q_err in errs:
-        err_queries = []
-        for q in test_benchmarks:
-            err_queries.append(get_card_error_tree(q, q_err))
-
-        runtimes = [b.get_total_runtime() for b in err_queries]
-        estimates = [model.estimate_runtime(b) for b in err_queries]
+        cardinalities = [get_card_error_tree(s, q_err) for s in skeletons]
+        x = np.vstack([s.get_feature_matrix(c) for s, c in zip(skeletons, cardinalities)])
+        scan_sizes = np.concatenate([s.get_scan_sizes(c) for s, c in zip(skeletons, cardinalities)])
+        estimates, _ = split_pipeline_predictions(np.maximum(0.0, model.predict(x, scan_sizes)), offsets)
         q_errors = [q_error(e, r) for e, r in zip(estimates, runtimes)]
         p50s.append(np.quantile(q_errors, 0.5))
         p90s.append(np.quantile(q_errors, 0.9))
@@ -9,7 +9,7 @@ from src.optimizer import optimize_per_tuple_tree_model, BenchmarkedQuery, Query
 
 
 def get_test_numbers(model, benchmarks, runtimes):
-    estimates = [model.estimate_runtime(b) for b in benchmarks]
+    estimates, _ = model.estimate_batch(benchmarks)
     q_errors = [q_error(e, r) for e, r in zip(estimates, runtimes)]
     return {"Avg": np.average(q_errors), "p50": np.quantile(q_errors, 0.5), "p90": np.quantile(q_errors, 0.9)}
 
@@ -45,7 +45,7 @@ def eval_dbs(dbs: list[tuple[Model, list[Database], str]]):
         names.append(name)
         benchmarks = DataCollector.collect_benchmarks(db, False)
         runtimes = [b.get_total_runtime() for b in benchmarks]
-        estimates = [model.estimate_runtime(b) for b in benchmarks]
+        estimates, _ = model.estimate_batch(benchmarks)
         q_errors = [q_error(e, r) for e, r in zip(estimates, runtimes)]
 
         p50s.append(np.quantile(q_errors, 0.5))
@@ -0,0 +1,143 @@
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import lightgbm as lgb
+
+# LightGBM treats values with an absolute value below this threshold as zero
+ZERO_THRESHOLD = 1e-35
+
+# objectives whose raw score is the prediction
+IDENTITY_OBJECTIVES = ("mape", "regression", "regression_l1", "l1", "l2", "huber", "fair", "quantile")
+
+MISSING_NONE = 0
+MISSING_ZERO = 1
+MISSING_NAN = 2
+
+ALL_LEAVES = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+class FlatForest:
+    """
+    All trees of a LightGBM booster flattened into contiguous arrays of split nodes and leaves.
+
+    Instead of walking the trees level by level (one round of array operations per level), every split of the forest
+    is evaluated at once. Leaves of a tree are numbered from left to right and each split stores the bitmask of leaves
+    that remain reachable when the split goes right. AND-ing the masks of all right-going splits of a tree leaves the
+    exit leaf as the lowest set bit (QuickScorer), so the cost in array operations does not depend on the tree depth.
+    """
+
+    # rows evaluated together, keeps the (rows, splits) intermediates cache sized
+    chunk_size = 32
+
+    def __init__(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        right_mask: np.ndarray,
+        missing_type: np.ndarray,
+        default_left: np.ndarray,
+        tree_offsets: np.ndarray,
+        leaf_offsets: np.ndarray,
+        leaf_values: np.ndarray,
+        constant: float,
+    ):
+        self.feature = feature
+        self.threshold = threshold
+        self.right_mask = right_mask
+        self.missing_type = missing_type
+        self.default_left = default_left
+        self.tree_offsets = tree_offsets  # first split of each tree
+        self.leaf_offsets = leaf_offsets  # first leaf of each tree
+        self.leaf_values = leaf_values
+        self.constant = constant  # sum of all trees without splits
+        # LightGBM maps NaN to zero for splits without missing value handling, we can do that once per batch
+        self.simple_missing = bool(np.all(missing_type == MISSING_NONE))
+
+    @staticmethod
+    def from_booster(tree: "lgb.Booster") -> "FlatForest":
+        model = tree.dump_model()
+        assert model["num_tree_per_iteration"] == 1, "only single output models are supported"
+        assert not model["average_output"], "random forest mode is not supported"
+        if model["objective"].split(" ")[0] not in IDENTITY_OBJECTIVES:
+            raise NotImplementedError(f"objective {model['objective']} needs an output transformation")
+
+        feature, threshold, right_mask, missing_type, default_left = [], [], [], [], []
+        tree_offsets, leaf_offsets, leaf_values = [], [], []
+        constant = 0.0
+
+        def add_node(node: dict, tree_leaves: list[float]) -> list[int]:
+            """returns the leaves of the subtree"""
+            if "leaf_value" in node:
+                tree_leaves.append(node["leaf_value"])
+                return [len(tree_leaves) - 1]
+            assert node["decision_type"] == "<=", "categorical splits are not supported"
+            index = len(feature)
+            feature.append(node["split_feature"])
+            threshold.append(node["threshold"])
+            right_mask.append(0)
+            missing_type.append({"None": MISSING_NONE, "Zero": MISSING_ZERO, "NaN": MISSING_NAN}[node["missing_type"]])
+            default_left.append(node["default_left"])
+            left_leaves = add_node(node["left_child"], tree_leaves)
+            right_leaves = add_node(node["right_child"], tree_leaves)
+            right_mask[index] = int(ALL_LEAVES) ^ sum(1 << leaf for leaf in left_leaves)
+            return left_leaves + right_leaves
+
+        for tree_info in model["tree_info"]:
+            root = tree_info["tree_structure"]
+            if "leaf_value" in root:
+                constant += root["leaf_value"]
+                continue
+            if tree_info["num_leaves"] > 64:
+                raise NotImplementedError("trees with more than 64 leaves are not supported")
+            tree_offsets.append(len(feature))
+            leaf_offsets.append(len(leaf_values))
+            tree_leaves = []
+            add_node(root, tree_leaves)
+            leaf_values += tree_leaves
+
+        return FlatForest(
+            np.array(feature, dtype=np.intp),
+            np.array(threshold, dtype=np.float64),
+            np.array(right_mask, dtype=np.uint64),
+            np.array(missing_type, dtype=np.int8),
+            np.array(default_left, dtype=bool),
+            np.array(tree_offsets, dtype=np.intp),
+            np.array(leaf_offsets, dtype=np.intp),
+            np.array(leaf_values, dtype=np.float64),
+            constant,
+        )
+
+    def _go_left(self, values: np.ndarray) -> np.ndarray:
+        if self.simple_missing:
+            return values <= self.threshold
+        nan = np.isnan(values)
+        values = np.where(nan & (self.missing_type == MISSING_NONE), 0.0, values)
+        missing = (nan & (self.missing_type == MISSING_NAN)) | (
+            (self.missing_type == MISSING_ZERO) & (nan | (np.abs(values) <= ZERO_THRESHOLD))
+        )
+        return np.where(missing, self.default_left, values <= self.threshold)
+
+    def _predict_chunk(self, x: np.ndarray) -> np.ndarray:
+        masks = np.where(self._go_left(x[:, self.feature]), ALL_LEAVES, self.right_mask)
+        reachable = np.bitwise_and.reduceat(masks, self.tree_offsets, axis=1)
+        lowest_bit = reachable & (~reachable + np.uint64(1))
+        # powers of two are exact in float64
+        leaf = np.log2(lowest_bit.astype(np.float64)).astype(np.intp)
+        return self.leaf_values[self.leaf_offsets + leaf].sum(axis=1) + self.constant
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        x = np.asarray(x)
+        # float32 rows are compared against the float64 thresholds as they are, without a float64 copy
+        if x.dtype != np.float32:
+            x = x.astype(np.float64, copy=False)
+        if self.simple_missing and np.isnan(x).any():
+            x = np.nan_to_num(x, nan=0.0)
+        if len(self.tree_offsets) == 0:
+            return np.full(len(x), self.constant)
+        if len(x) <= self.chunk_size:
+            return self._predict_chunk(x)
+        return np.concatenate(
+            [self._predict_chunk(x[i : i + self.chunk_size]) for i in range(0, len(x), self.chunk_size)]
+        )
@@ -0,0 +1,158 @@
+import json
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+# in order of preference, orjson and msgspec are optional
+JSON_DECODERS = ("orjson", "msgspec", "json")
+
+# the fields of the analyzed plan (benchmark_json["plan"]["plan"]) that QueryPlan reads
+PLAN_FIELDS = ("plan", "ius", "analyzePlanPipelines")
+
+
+def _get_orjson_decoder() -> tuple[Callable[[bytes], Any], tuple[type, ...]]:
+    import orjson
+
+    return orjson.loads, (orjson.JSONDecodeError,)
+
+
+def _get_msgspec_decoder() -> tuple[Callable[[bytes], Any], tuple[type, ...]]:
+    import msgspec
+
+    return msgspec.json.Decoder().decode, (msgspec.DecodeError,)
+
+
+def _get_stdlib_decoder() -> tuple[Callable[[bytes], Any], tuple[type, ...]]:
+    return json.loads, ()
+
+
+DECODER_FACTORIES = {"orjson": _get_orjson_decoder, "msgspec": _get_msgspec_decoder, "json": _get_stdlib_decoder}
+
+
+def get_available_decoders() -> list[str]:
+    result = []
+    for name in JSON_DECODERS:
+        try:
+            DECODER_FACTORIES[name]()
+        except ImportError:
+            continue
+        result.append(name)
+    return result
+
+
+def project_benchmark(benchmark: dict) -> dict:
+    """
+    the parts of a benchmark file that DataCollector reads: the analyzed plan (PLAN_FIELDS), the query text and the
+    executionTime of every run
+    """
+    result = {}
+    if "plan" in benchmark:
+        step = benchmark["plan"]
+        result["plan"] = {}
+        if "plan" in step:
+            result["plan"]["plan"] = {k: step["plan"][k] for k in PLAN_FIELDS if k in step["plan"]}
+        if "query_text" in step:
+            result["plan"]["query_text"] = step["query_text"]
+    if "benchmarks" in benchmark:
+        result["benchmarks"] = [{"executionTime": b["executionTime"]} for b in benchmark["benchmarks"]]
+    return result
+
+
+def _get_msgspec_projection() -> Callable[[bytes], dict]:
+    """
+    msgspec skips the fields that are not declared while decoding, the other decoders build the whole document
+    """
+    import msgspec
+
+    UNSET = msgspec.UNSET
+    # Any keeps the values exactly as the other decoders return them (e.g. integer execution times stay ints)
+    AnyField = Union[Any, msgspec.UnsetType]
+
+    class AnalyzedPlan(msgspec.Struct):
+        plan: AnyField = UNSET
+        ius: AnyField = UNSET
+        analyzePlanPipelines: AnyField = UNSET
+
+    class Step(msgspec.Struct):
+        plan: Union[AnalyzedPlan, msgspec.UnsetType] = UNSET
+        query_text: AnyField = UNSET
+
+    class Run(msgspec.Struct):
+        executionTime: Any
+
+    class Benchmark(msgspec.Struct):
+        plan: Union[Step, msgspec.UnsetType] = UNSET
+        benchmarks: Union[list[Run], msgspec.UnsetType] = UNSET
+
+    decode = msgspec.json.Decoder(Benchmark).decode
+
+    def to_dict(struct: msgspec.Struct) -> dict:
+        return {f: getattr(struct, f) for f in struct.__struct_fields__ if getattr(struct, f) is not UNSET}
+
+    def decode_projected(data: bytes) -> dict:
+        benchmark = decode(data)
+        result = {}
+        if benchmark.plan is not UNSET:
+            result["plan"] = to_dict(benchmark.plan)
+            if benchmark.plan.plan is not UNSET:
+                result["plan"]["plan"] = to_dict(benchmark.plan.plan)
+        if benchmark.benchmarks is not UNSET:
+            result["benchmarks"] = [{"executionTime": b.executionTime} for b in benchmark.benchmarks]
+        return result
+
+    return decode_projected
+
+
+class JsonDecoder:
+    """
+    Decodes benchmark files with the fastest available library (or the one given by name). Documents the library
+    rejects (integers beyond 64 bit, NaN) are decoded again with the json module, so all decoders return the same
+    objects. With projection only the fields of project_benchmark are kept, which keeps loaded corpora small.
+    """
+
+    def __init__(self, name: Optional[str] = None, projection: bool = False):
+        if name is None:
+            name = get_available_decoders()[0]
+        assert name in JSON_DECODERS, f"unknown json decoder {name}"
+        self.name = name
+        self.projection = projection
+        self._decode, self._errors = DECODER_FACTORIES[name]()
+        # what loads raises for documents that are not valid json (json.JSONDecodeError and invalid utf-8 are both
+        # ValueErrors), callers catch these instead of the exceptions of a particular library
+        self.errors: tuple[type, ...] = (ValueError,) + self._errors
+        self._decode_projected: Optional[Callable[[bytes], dict]] = None
+        if projection and name == "msgspec":
+            self._decode_projected = _get_msgspec_projection()
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            if self._decode_projected is not None:
+                return self._decode_projected(data)
+            result = self._decode(data)
+        except self._errors:
+            result = json.loads(data)
+        return project_benchmark(result) if self.projection else result
+
+    def load_file(self, file: Path) -> Any:
+        with open(file, "rb") as fd:
+            return self.loads(fd.read())
+
+
+BENCHMARK_DECODER: Optional[JsonDecoder] = None
+
+
+def get_benchmark_decoder() -> JsonDecoder:
+    """
+    the projecting decoder DataCollector reads benchmark files with, created on first use
+    """
+    global BENCHMARK_DECODER
+    if BENCHMARK_DECODER is None:
+        BENCHMARK_DECODER = JsonDecoder(projection=True)
+    return BENCHMARK_DECODER
+
+
+def set_benchmark_decoder(decoder: Optional[JsonDecoder]):
+    """
+    replace the decoder of all benchmark file reads, None picks the default again
+    """
+    global BENCHMARK_DECODER
+    BENCHMARK_DECODER = decoder
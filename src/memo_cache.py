@@ -0,0 +1,264 @@
+import copyreg
+import functools
+import gc
+import hashlib
+import io
+import os
+import pickle
+import sys
+import threading
+import types
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Hashable, Optional
+
+from src.database import Database
+from src.util import paused_gc
+
+MEMO_CACHE_PATH = Path("data/memo_cache")
+
+# bump when pickled results of memoized functions change their meaning, entries of other versions are never read
+MEMO_CACHE_VERSION = 3
+
+# shared objects that are not part of a cached result
+_UNSIZED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+SIZE_SAMPLES = 64
+
+
+def get_argument_key(value: Any) -> Hashable:
+    """
+    in memory key of an argument: databases by identity (their schemata are large and compared field by field with
+    ==), containers by their elements, other unhashable objects by identity and everything else by value
+    """
+    if isinstance(value, Database):
+        return Database, id(value)
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(map(get_argument_key, value))
+    if isinstance(value, dict):
+        return dict, frozenset((k, get_argument_key(v)) for k, v in value.items())
+    try:
+        hash(value)
+    except TypeError:
+        return type(value), id(value)
+    return value
+
+
+def get_disk_key(value: Any) -> str:
+    """
+    key of an argument that is stable across processes: databases by name, everything else by repr
+    """
+    if isinstance(value, Database):
+        return f"Database({value.get_path()})"
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}({', '.join(map(get_disk_key, value))})"
+    if isinstance(value, dict):
+        return f"dict({', '.join(sorted(f'{k!r}: {get_disk_key(v)}' for k, v in value.items()))})"
+    return repr(value)
+
+
+def get_deep_size(value: Any, exclude: tuple = ()) -> int:
+    """
+    bytes of all objects reachable from value, the objects in exclude (and everything only reachable through them)
+    are not counted, e.g. the database a parsed plan references
+    the size of long lists (e.g. of parsed plans) is extrapolated from SIZE_SAMPLES of their elements, walking all of
+    them takes about as long as parsing them
+    """
+    seen = {id(e) for e in exclude}
+    size = 0
+    if isinstance(value, list) and len(value) > SIZE_SAMPLES:
+        size += sys.getsizeof(value)
+        step = len(value) / SIZE_SAMPLES
+        samples = [value[int(i * step)] for i in range(SIZE_SAMPLES)]
+        return size + int(_get_reachable_size(samples, seen) * len(value) / SIZE_SAMPLES)
+    return _get_reachable_size([value], seen)
+
+
+def _get_reachable_size(stack: list, seen: set[int]) -> int:
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _UNSIZED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack += gc.get_referents(obj)
+    return size
+
+
+class _ArgumentPickler(pickle.Pickler):
+    """
+    stores the arguments referenced by a result (e.g. the database of every query plan) as references into the
+    arguments of the call instead of copies, the unpickler attaches the arguments of the call that reads the entry
+    only the types of the arguments go through the dispatch table, persistent_id would be called for every object
+    """
+
+    def __init__(self, file, arguments: tuple):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        indices = {id(a): i for i, a in enumerate(arguments)}
+
+        def reduce_argument(obj):
+            if id(obj) in indices:
+                return _get_argument, (indices[id(obj)],)
+            return obj.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        for argument in arguments:
+            if type(argument).__module__ != "builtins":
+                self.dispatch_table[type(argument)] = reduce_argument
+
+
+def _get_argument(index: int):
+    raise RuntimeError("memo cache entries are only read by _ArgumentUnpickler")
+
+
+class _ArgumentUnpickler(pickle.Unpickler):
+    def __init__(self, file, arguments: tuple):
+        super().__init__(file)
+        self._arguments = arguments
+
+    def find_class(self, module, name):
+        if module == __name__ and name == _get_argument.__name__:
+            return self._arguments.__getitem__
+        return super().find_class(module, name)
+
+
+class MemoCache:
+    """
+    Bounded LRU of the results of a function by its arguments, with an optional directory of pickles as second tier
+    that survives the process. Keys are hashed, databases are compared by identity (see get_argument_key).
+    The memory tier is limited by max_entries and, if set, by max_bytes of the results (get_deep_size, only estimated
+    when there is a byte limit), the latest result is kept even if it exceeds max_bytes on its own. The disk tier is keyed by get_disk_key of the arguments and the fingerprint of the
+    inputs the function reads (e.g. the benchmark files), so stale entries are never read.
+    Cached results are shared by all callers and must not be modified.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: Optional[int] = 128,
+        max_bytes: Optional[int] = None,
+        path: Optional[Path] = None,
+        fingerprint: Optional[Callable[..., str]] = None,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.fingerprint = fingerprint
+        # key -> (arguments, result, size), the arguments keep the objects whose ids are part of the key alive
+        self._entries: OrderedDict[Hashable, tuple[tuple, Any, int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_disk_file(self, arguments: tuple) -> Path:
+        key = f"{MEMO_CACHE_VERSION}:{self.name}:{get_disk_key(arguments)}"
+        if self.fingerprint is not None:
+            key += f":{self.fingerprint(*arguments)}"
+        return self.path / f"{self.name}-{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.pkl"
+
+    def _read_disk(self, arguments: tuple) -> Optional[tuple[Any]]:
+        file = self._get_disk_file(arguments)
+        if not file.exists():
+            return None
+        with open(file, "rb") as fd, paused_gc():
+            return (_ArgumentUnpickler(fd, arguments).load(),)
+
+    def _write_disk(self, arguments: tuple, result: Any):
+        file = self._get_disk_file(arguments)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        buffer = io.BytesIO()
+        with paused_gc():
+            _ArgumentPickler(buffer, arguments).dump(result)
+        # written next to the entry and renamed, concurrent readers never see a partial pickle
+        tmp_file = file.with_name(f"{file.name}.{os.getpid()}.tmp")
+        tmp_file.write_bytes(buffer.getvalue())
+        os.replace(tmp_file, file)
+
+    def _put(self, key: Hashable, arguments: tuple, result: Any):
+        size = get_deep_size(result, arguments) if self.max_bytes is not None else 0
+        self._entries[key] = (arguments, result, size)
+        self._bytes += size
+        while len(self._entries) > 1 and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, arguments: tuple, compute: Callable[[], Any]) -> Any:
+        """
+        the cached result for the (positional) arguments, compute produces it on a miss
+        """
+        key = get_argument_key(arguments)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        if self.path is not None:
+            disk_entry = self._read_disk(arguments)
+            if disk_entry is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put(key, arguments, disk_entry[0])
+                return disk_entry[0]
+        # computed outside the lock, concurrent misses of the same key compute it twice and keep the last result
+        result = compute()
+        with self._lock:
+            self.misses += 1
+            self._put(key, arguments, result)
+        if self.path is not None:
+            self._write_disk(arguments, result)
+        return result
+
+    def clear(self):
+        """
+        drops the entries in memory, the disk tier is kept
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self._bytes if self.max_bytes is not None else None,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+def memo_cache(
+    max_entries: Optional[int] = 128,
+    max_bytes: Optional[int] = None,
+    path: Optional[Path] = None,
+    fingerprint: Optional[Callable[..., str]] = None,
+):
+    """
+    memoize a function with positional arguments in a MemoCache, the cache is the cache attribute of the wrapper
+    (e.g. to set its limits, enable the disk tier or read its stats)
+    """
+
+    def decorator(func):
+        cache = MemoCache(func.__qualname__, max_entries, max_bytes, path, fingerprint)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return cache.get(args, lambda: func(*args))
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
@@ -1,14 +1,28 @@
+import ctypes
+import hashlib
+import math
+import threading
+import warnings
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, TYPE_CHECKING
 
-import lightgbm as lgb
 import numpy as np
 
-from src.features import FeatureMapper
+from src.explanation import QueryExplanation, build_query_explanations
+from src.feature_layout import load_model
+from src.features import FeatureMapper, is_sparse
+from src.forest import FlatForest
 from src.query_plan import QueryPlan
 
+if TYPE_CHECKING:
+    # boosters are created by training or feature_layout.load_model, importing the models does not need lightgbm
+    import lightgbm as lgb
+
 
 class Model(ABC):
-    tree: lgb.Booster
+    tree: "lgb.Booster"
 
     @abstractmethod
     def estimate_runtime(self, query: "BenchmarkedQuery") -> float:
@@ -18,11 +32,54 @@ class Model(ABC):
     def estimate_pipeline_runtime(self, query: "BenchmarkedQuery") -> list[float]:
         pass
 
+    @abstractmethod
+    def estimate_batch(self, queries: list["BenchmarkedQuery"]) -> tuple[np.ndarray, list[np.ndarray]]:
+        """
+        estimate all queries with a single prediction call
+        returns the total estimate per query and the pipeline estimates of each query
+        """
+        pass
+
     @abstractmethod
     def get_feature_mapper(self) -> FeatureMapper:
         pass
 
 
+def stack_feature_matrices(
+    queries: list["BenchmarkedQuery"], feature_mapper: FeatureMapper
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    stack the pipeline feature matrices of all queries
+    the pipelines of query i are the rows offsets[i] to offsets[i + 1]
+    """
+    matrices = [q.get_feature_matrix(feature_mapper) for q in queries]
+    offsets = np.zeros(len(matrices) + 1, dtype=int)
+    offsets[1:] = np.cumsum([len(m) for m in matrices])
+    if len(matrices) == 0:
+        return np.empty((0, feature_mapper.n_features), dtype=feature_mapper.dtype), offsets
+    return np.vstack(matrices), offsets
+
+
+def sum_segments(x: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    sum of the rows offsets[i] to offsets[i + 1] of x for each query, 0 for queries without pipelines
+    np.add.reduceat returns the row at the offset for empty segments (and fails if it is past the end), so only the
+    non-empty segments are reduced
+    """
+    sums = np.zeros((len(offsets) - 1,) + x.shape[1:], dtype=np.result_type(x.dtype, np.float64))
+    non_empty = np.diff(offsets) > 0
+    if non_empty.any():
+        sums[non_empty] = np.add.reduceat(x, offsets[:-1][non_empty], axis=0)
+    return sums
+
+
+def split_pipeline_predictions(pred: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, list[np.ndarray]]:
+    """
+    sum up the pipeline predictions per query and split them back into one array per query
+    """
+    return sum_segments(pred, offsets), np.split(pred, offsets[1:-1])
+
+
 class TreeModel(Model):
     """
     Predicts execution time of whole pipeline
@@ -30,7 +87,7 @@ class TreeModel(Model):
 
     def __init__(self, tree):
         super().__init__()
-        self.tree: lgb.Booster = tree
+        self.tree: "lgb.Booster" = tree
         self._feature_mapper = FeatureMapper()
 
     def estimate_runtime(self, query: "BenchmarkedQuery") -> float:
@@ -45,6 +102,13 @@ class TreeModel(Model):
         pred = self.tree.predict(np.array(x)).flatten()
         return [max(1e-6, float(e)) for e in pred]
 
+    def estimate_batch(self, queries: list["BenchmarkedQuery"]) -> tuple[np.ndarray, list[np.ndarray]]:
+        x, offsets = stack_feature_matrices(queries, self._feature_mapper)
+        pred = self.tree.predict(x).flatten() if len(x) > 0 else np.zeros(0)
+        totals, _ = split_pipeline_predictions(pred, offsets)
+        _, per_pipeline = split_pipeline_predictions(np.maximum(1e-6, pred), offsets)
+        return np.maximum(1e-6, totals), per_pipeline
+
     def get_feature_mapper(self) -> FeatureMapper:
         return self._feature_mapper
 
@@ -56,7 +120,7 @@ class FlatTreeModel:
 
     def __init__(self, tree):
         # super().__init__()
-        self.tree: lgb.Booster = tree
+        self.tree: "lgb.Booster" = tree
         self._feature_mapper = FeatureMapper()
 
     def estimate_runtime(self, query: "BenchmarkedQuery") -> float:
@@ -66,19 +130,61 @@ class FlatTreeModel:
         pred = float(pred)
         return max(1e-6, pred)
 
+    def estimate_batch(self, queries: list["BenchmarkedQuery"]) -> tuple[np.ndarray, list[np.ndarray]]:
+        """
+        the flat model has no pipeline estimates, the query estimate is the only entry per query
+        """
+        x, offsets = stack_feature_matrices(queries, self._feature_mapper)
+        if len(queries) == 0:
+            return np.zeros(0), []
+        x = sum_segments(x, offsets)
+        pred = np.maximum(1e-6, self.tree.predict(x).flatten())
+        return pred, np.split(pred, np.arange(1, len(pred)))
+
     def get_feature_mapper(self) -> FeatureMapper:
         return self._feature_mapper
 
 
+class PredictionBuffers(threading.local):
+    """
+    per thread output buffer of the low latency prediction path, grows to the largest plan seen
+    """
+
+    def __init__(self):
+        self.pred = np.empty(64)
+
+    def get(self, n: int) -> np.ndarray:
+        if len(self.pred) < n:
+            self.pred = np.empty(max(n, 2 * len(self.pred)))
+        return self.pred[:n]
+
+
 class PerTupleTreeModel(Model):
     """
     Predicts execution time of a single tuple in a pipeline
     """
 
-    def __init__(self, tree):
+    # up to this many pipelines the per pipeline arithmetic is cheaper on python floats than with numpy calls
+    scalar_pipeline_limit = 16
+    # smaller shards cost more in thread hand over than they gain from running in parallel
+    min_rows_per_thread = 2048
+    # LightGBM predicts on csr matrices directly, the other backends need dense rows
+    accepts_sparse = True
+    # LightGBM and the numpy forest read float32 rows as they are, lleaves needs float64
+    accepts_float32 = True
+
+    def __init__(self, tree, feature_dtype: np.dtype = np.float64):
         super().__init__()
-        self.tree: lgb.Booster = tree
-        self._feature_mapper = FeatureMapper()
+        self.tree: "lgb.Booster" = tree
+        # float32 features are opt-in, they halve the memory of large batches
+        self._feature_mapper = FeatureMapper(feature_dtype)
+        self._buffers = PredictionBuffers()
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        # worker count of _thread_pool, ThreadPoolExecutor only keeps it in a private attribute
+        self._thread_pool_size = 0
+        self._thread_pool_lock = threading.Lock()
+        # per tuple models trained on runtime quantiles, keyed by quantile (e.g. 0.9 for p90)
+        self.quantile_models: dict[float, "PerTupleTreeModel"] = {}
 
     def estimate_runtime(self, query: "BenchmarkedQuery") -> float:
         return sum(self.estimate_pipeline_runtime(query))
@@ -88,25 +194,89 @@ class PerTupleTreeModel(Model):
         query: "BenchmarkedQuery",
     ) -> list[float]:
         x = query.get_feature_matrix(self._feature_mapper)
-        scan_sizes = self._feature_mapper.get_pipeline_scan_sizes(query.query_plan)
-        pred = self.predict(x, scan_sizes)
-        return [max(0.0, float(e)) for e in pred]
+        scan_sizes = [p.get_pipeline_scan_cardinality() for p in query.query_plan.pipelines]
+        return self.predict_pipelines(x, scan_sizes)
+
+    def predict_tree(self, x: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        raw tree output (negative log of the time per tuple) for each row of x
+        backends may write the result into out (an array of len(x)) instead of allocating
+        """
+        return self.tree.predict(x).flatten()
+
+    def _predict_tree_shard(self, x: np.ndarray, out: np.ndarray, start: int, end: int):
+        """
+        write the tree output of the rows start to end of x into out, called concurrently from the thread pool
+        """
+        # every shard already runs on its own thread, LightGBM must not spawn another set of threads per shard
+        out[start:end] = self.tree.predict(x[start:end], num_threads=1)
+
+    def _get_tree_dtype(self, x: np.ndarray) -> np.dtype:
+        return np.dtype(np.float32) if x.dtype == np.float32 and self.accepts_float32 else np.dtype(np.float64)
+
+    def _get_thread_pool(self, n_threads: int) -> ThreadPoolExecutor:
+        with self._thread_pool_lock:
+            if self._thread_pool is None or self._thread_pool_size != n_threads:
+                if self._thread_pool is not None:
+                    self._thread_pool.shutdown(wait=False)
+                self._thread_pool = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="t3-predict")
+                self._thread_pool_size = n_threads
+            return self._thread_pool
+
+    def predict_tree_parallel(self, x: np.ndarray, n_threads: int) -> np.ndarray:
+        """
+        shard the rows of x across n_threads threads, all backends release the GIL while evaluating the trees
+        """
+        n_shards = min(n_threads, x.shape[0] // self.min_rows_per_thread)
+        if n_shards <= 1:
+            return self.predict_tree(x)
+        if not is_sparse(x):
+            x = np.ascontiguousarray(x, dtype=self._get_tree_dtype(x))
+        out = np.empty(x.shape[0])
+        bounds = np.linspace(0, x.shape[0], n_shards + 1).astype(int)
+        pool = self._get_thread_pool(n_threads)
+        shards = [pool.submit(self._predict_tree_shard, x, out, bounds[i], bounds[i + 1]) for i in range(n_shards)]
+        for shard in shards:
+            shard.result()
+        return out
 
     def predict(
         self,
         x,
         scan_sizes,
+        n_threads: int = 1,
     ) -> np.ndarray:
-        mask = np.any(x != 0, axis=1)
-        pred = self.tree.predict(x).flatten()
-        pred = np.exp(-pred)
-        scan_sizes[scan_sizes < 1] = 1
-        pred = pred * scan_sizes
+        if is_sparse(x):
+            x = x.tocsr()
+            mask = (x != 0).getnnz(axis=1) > 0
+            if not self.accepts_sparse:
+                x = x.toarray()
+        else:
+            mask = x.any(axis=1)
+        pred = self.predict_tree(x) if n_threads <= 1 else self.predict_tree_parallel(x, n_threads)
+        np.negative(pred, out=pred)
+        np.exp(pred, out=pred)
+        pred *= np.maximum(scan_sizes, 1)
         pred *= mask
         pred[pred < 0] = 0.0
         return pred
 
-    def estimate_many(self, queries: list[QueryPlan]) -> list[float]:
+    def predict_pipelines(self, x: np.ndarray, scan_sizes: list[float]) -> list[float]:
+        """
+        low latency path for a single query, the tree output goes into a per thread buffer
+        """
+        if len(x) > self.scalar_pipeline_limit:
+            return self.predict(x, np.asarray(scan_sizes, dtype=float)).tolist()
+        pred = self.predict_tree(x, self._buffers.get(len(x))).tolist()
+        non_empty = x.any(axis=1).tolist()
+        return [
+            math.exp(-p) * max(s, 1.0) if pipeline_non_empty else 0.0
+            for p, s, pipeline_non_empty in zip(pred, scan_sizes, non_empty)
+        ]
+
+    def estimate_many(self, queries: list[QueryPlan], n_threads: int = 1, as_sparse: bool = False) -> list[float]:
+        if as_sparse:
+            return self._estimate_many_sparse(queries, n_threads)
         labels = []
         scan_sizes = []
         pipeline_vectors = []
@@ -119,9 +289,201 @@ class PerTupleTreeModel(Model):
         scan_sizes = np.array(scan_sizes)
         pipeline_vectors = np.array(pipeline_vectors)
         labels = np.array(labels)
-        pred = self.predict(pipeline_vectors, scan_sizes)
+        pred = self.predict(pipeline_vectors, scan_sizes, n_threads)
         query_preds = np.bincount(labels, weights=pred)
         return query_preds
 
+    def _estimate_many_sparse(self, queries: list[QueryPlan], n_threads: int) -> list[float]:
+        """
+        stacks the pipelines of all plans as csr matrix, large what-if batches then only store the non-zero features
+        """
+        from scipy.sparse import vstack as sparse_vstack
+
+        matrices = [self._feature_mapper.get_pipeline_estimation_matrix(q, as_sparse=True) for q in queries]
+        scan_sizes = np.concatenate([self._feature_mapper.get_pipeline_scan_sizes(q) for q in queries])
+        labels = np.repeat(np.arange(len(queries)), [m.shape[0] for m in matrices])
+        pred = self.predict(sparse_vstack(matrices, format="csr"), scan_sizes, n_threads)
+        return np.bincount(labels, weights=pred, minlength=len(queries))
+
+    def _stack_batch(self, queries: list["BenchmarkedQuery"]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        x, offsets = stack_feature_matrices(queries, self._feature_mapper)
+        if len(x) == 0:
+            return x, np.zeros(0), offsets
+        scan_sizes = np.concatenate(
+            [self._feature_mapper.get_pipeline_scan_sizes(q.query_plan) for q in queries]
+        ).astype(float)
+        return x, scan_sizes, offsets
+
+    def estimate_batch(
+        self, queries: list["BenchmarkedQuery"], n_threads: int = 1
+    ) -> tuple[np.ndarray, list[np.ndarray]]:
+        x, scan_sizes, offsets = self._stack_batch(queries)
+        if len(x) == 0:
+            return split_pipeline_predictions(np.zeros(0), offsets)
+        pred = np.maximum(0.0, self.predict(x, scan_sizes, n_threads))
+        return split_pipeline_predictions(pred, offsets)
+
+    def predict_interval(
+        self, queries: list["BenchmarkedQuery"], n_threads: int = 1
+    ) -> tuple[np.ndarray, dict[float, np.ndarray]]:
+        """
+        point estimate and the estimate of every quantile model for each query
+        the feature matrix is built once and evaluated by all boosters, query quantiles are the sums of the pipeline
+        quantiles (exact for single pipeline queries, conservative for the upper quantiles otherwise)
+        """
+        x, scan_sizes, offsets = self._stack_batch(queries)
+        if len(x) == 0:
+            return np.zeros(len(queries)), {q: np.zeros(len(queries)) for q in self.quantile_models}
+        totals, _ = split_pipeline_predictions(np.maximum(0.0, self.predict(x, scan_sizes, n_threads)), offsets)
+        quantile_totals = {}
+        previous = None
+        for quantile, model in sorted(self.quantile_models.items()):
+            pred = np.maximum(0.0, model.predict(x, scan_sizes, n_threads))
+            quantile_totals[quantile], _ = split_pipeline_predictions(pred, offsets)
+            # the quantile boosters are trained independently and may cross
+            if previous is not None:
+                np.maximum(quantile_totals[quantile], previous, out=quantile_totals[quantile])
+            previous = quantile_totals[quantile]
+        return totals, quantile_totals
+
+    def explain(self, queries: list["BenchmarkedQuery"]) -> list[QueryExplanation]:
+        """
+        per feature and per operator contributions (SHAP values of LightGBM's pred_contrib) to the estimate of each
+        pipeline, the pipelines of all queries are explained in one booster call
+        the contributions always come from the LightGBM booster, the estimates from the backend of this model
+        """
+        x, scan_sizes, offsets = self._stack_batch(queries)
+        if len(x) == 0:
+            return build_query_explanations(
+                queries, self._feature_mapper, np.zeros((0, x.shape[1] + 1)), np.zeros(0), scan_sizes, offsets
+            )
+        contributions = self.tree.predict(x, pred_contrib=True)
+        estimates = np.maximum(0.0, self.predict(x, scan_sizes))
+        return build_query_explanations(queries, self._feature_mapper, contributions, estimates, scan_sizes, offsets)
+
     def get_feature_mapper(self) -> FeatureMapper:
         return self._feature_mapper
+
+
+LLEAVES_CACHE_PATH = Path("lleaves_cache")
+
+
+def get_model_hash(tree: "lgb.Booster") -> str:
+    return hashlib.sha256(tree.model_to_string().encode()).hexdigest()[:16]
+
+
+def compile_tree(tree: "lgb.Booster", cache_path: Path = LLEAVES_CACHE_PATH):
+    """
+    compile the booster with lleaves, the object file is cached by model hash so every model is compiled only once
+    """
+    from lleaves import lleaves
+
+    cache_path.mkdir(parents=True, exist_ok=True)
+    model_hash = get_model_hash(tree)
+    model_file = cache_path / f"{model_hash}.txt"
+    if not model_file.exists():
+        tree.save_model(str(model_file))
+    compiled_tree = lleaves.Model(model_file=str(model_file))
+    compiled_tree.compile(cache=str(cache_path / f"{model_hash}.o"))
+    return compiled_tree
+
+
+class CompiledPerTupleTreeModel(PerTupleTreeModel):
+    """
+    Per tuple model that evaluates the lleaves compiled trees instead of calling into LightGBM
+    """
+
+    accepts_sparse = False
+    accepts_float32 = False
+
+    def __init__(self, tree, cache_path: Path = LLEAVES_CACHE_PATH, feature_dtype: np.dtype = np.float64):
+        super().__init__(tree, feature_dtype)
+        self._compiled_tree = compile_tree(tree, cache_path)
+        # lleaves.Model.predict validates and copies its input and allocates the output on every call, which costs more
+        # than evaluating a handful of pipelines, so we call the compiled forest_root(data, out, start, end) directly
+        # the execution engine is private to lleaves (pinned in requirements.txt), without it we go through predict
+        self._forest_root = None
+        try:
+            address = self._compiled_tree._execution_engine.get_function_address("forest_root")
+        except AttributeError:
+            warnings.warn("lleaves does not expose the compiled forest, using lleaves.Model.predict", RuntimeWarning)
+        else:
+            self._forest_root = ctypes.CFUNCTYPE(
+                None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int32, ctypes.c_int32
+            )(address)
+
+    def predict_tree(self, x: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        if self._forest_root is None:
+            return self._compiled_tree.predict(x, n_jobs=1)
+        if not (x.dtype == np.float64 and x.flags.c_contiguous):
+            x = np.ascontiguousarray(x, dtype=np.float64)
+        if out is None:
+            out = np.empty(len(x))
+        self._forest_root(x.ctypes.data, out.ctypes.data, 0, len(x))
+        return out
+
+    def _predict_tree_shard(self, x: np.ndarray, out: np.ndarray, start: int, end: int):
+        if self._forest_root is None:
+            out[start:end] = self._compiled_tree.predict(x[start:end], n_jobs=1)
+            return
+        # forest_root evaluates a row range itself, ctypes drops the GIL for the duration of the call
+        self._forest_root(x.ctypes.data, out.ctypes.data, start, end)
+
+
+class NumpyPerTupleTreeModel(PerTupleTreeModel):
+    """
+    Per tuple model that walks a flattened copy of the trees with NumPy, needs neither LLVM nor LightGBM calls
+    """
+
+    accepts_sparse = False
+
+    def __init__(self, tree, feature_dtype: np.dtype = np.float64):
+        super().__init__(tree, feature_dtype)
+        self._forest = FlatForest.from_booster(tree)
+
+    def predict_tree(self, x: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        return self._forest.predict(x)
+
+    def _predict_tree_shard(self, x: np.ndarray, out: np.ndarray, start: int, end: int):
+        out[start:end] = self._forest.predict(x[start:end])
+
+
+PER_TUPLE_BACKENDS = ("lightgbm", "lleaves", "numpy")
+
+
+def get_quantile_model_path(model_file: Path, quantile: float) -> Path:
+    """
+    model.txt -> model_q90.txt for the p90 booster
+    """
+    return model_file.with_name(f"{model_file.stem}_q{round(quantile * 100)}{model_file.suffix}")
+
+
+def build_per_tuple_tree_model(
+    tree: "lgb.Booster", backend: str = "lightgbm", feature_dtype: np.dtype = np.float64
+) -> PerTupleTreeModel:
+    """
+    lleaves needs LLVM at runtime, without it we fall back to LightGBM (the numpy backend is slower than LightGBM at
+    every batch size, see testing/benchmark_backends.py)
+    """
+    assert backend in PER_TUPLE_BACKENDS, f"unknown backend {backend}"
+    if backend == "lleaves":
+        try:
+            return CompiledPerTupleTreeModel(tree, feature_dtype=feature_dtype)
+        except ImportError:
+            warnings.warn("lleaves is not available, using the lightgbm backend", RuntimeWarning)
+            return PerTupleTreeModel(tree, feature_dtype)
+    if backend == "numpy":
+        return NumpyPerTupleTreeModel(tree, feature_dtype)
+    return PerTupleTreeModel(tree, feature_dtype)
+
+
+def load_quantile_models(
+    model: PerTupleTreeModel, model_file: Path, quantiles: list[float], backend: str = "lightgbm"
+) -> PerTupleTreeModel:
+    """
+    attach the quantile boosters saved next to model_file (see get_quantile_model_path)
+    """
+    for quantile in quantiles:
+        tree = load_model(get_quantile_model_path(model_file, quantile))
+        model.quantile_models[quantile] = build_per_tuple_tree_model(tree, backend, model.get_feature_mapper().dtype)
+    return model
@@ -76,30 +76,48 @@ class ExecutionPhase:
             return right_input_cardinality
 
 
+def get_scan_cardinality(phases: list) -> float:
+    """
+    the tuples the first operator of a pipeline produces, phases are ExecutionPhases or PlanPhases
+    """
+    if len(phases) == 0:
+        return 0
+    if phases[0].operator.type in (OperatorType.GroupBy, OperatorType.Sort, OperatorType.Temp):
+        return phases[0].operator.output_cardinality
+    return phases[0].operator.input_cardinality
+
+
 @dataclass
 class Pipeline:
     operators: list[ExecutionPhase]
-    operator_mapping: dict[Operator, ExecutionPhase]
     start: float
     stop: float
 
     def __init__(self, execution_phases: list[ExecutionPhase], start: float, stop: float):
         self.operators = execution_phases
-        self.operator_mapping = {e.operator: e for e in self.operators}
         self.start = start
         self.stop = stop
-
-    def get_execution_phase(self, op_id: int) -> ExecutionPhase:
-        for op in self.operators:
-            if op.operator.op_id == op_id:
-                return op
+        # phases by op id, built by index_operators once the operators are final
+        self._phases_by_op_id: Optional[dict[int, ExecutionPhase]] = None
+
+    def index_operators(self):
+        """
+        index the phases by operator id for get_execution_phase, QueryPlan.build_pipelines calls it after
+        fix_union_all, code that changes the operators of a pipeline afterwards has to call it again
+        """
+        self._phases_by_op_id = {}
+        for phase in self.operators:
+            self._phases_by_op_id.setdefault(phase.operator.op_id, phase)
+
+    def get_execution_phase(self, op_id: int) -> Optional[ExecutionPhase]:
+        """
+        the first phase of the operator in the pipeline
+        """
+        assert self._phases_by_op_id is not None, "pipeline operators are not indexed, call index_operators"
+        return self._phases_by_op_id.get(op_id)
 
     def get_pipeline_scan_cardinality(self) -> float:
-        if len(self.operators) == 0:
-            return 0
-        if self.operators[0].operator.type in (OperatorType.GroupBy, OperatorType.Sort, OperatorType.Temp):
-            return self.operators[0].operator.output_cardinality
-        return self.operators[0].operator.input_cardinality
+        return get_scan_cardinality(self.operators)
 
     def get_pipeline_sink_cardinality(self) -> float:
         if self.operators[-1].operator.type == OperatorType.GroupBy:
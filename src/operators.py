@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from string import digits
-from typing import Optional
+from typing import Iterable, Optional
 
 from src.util import AutoNumber
 
@@ -28,7 +28,8 @@ class OperatorType(AutoNumber):
     AnalyzePlan = ()
 
     def is_join_type(self):
-        return self in {OperatorType.HashJoin, OperatorType.IndexNLJoin, OperatorType.GroupJoin}
+        # identity checks, hashing enum members is slow and this is called for every operator of every plan
+        return self is OperatorType.HashJoin or self is OperatorType.IndexNLJoin or self is OperatorType.GroupJoin
 
 
 @dataclass
@@ -83,6 +84,28 @@ class Operator:
         return 1
 
 
+OPERATOR_NAMES = {
+    "fileoutput": OperatorType.FileOutput,
+    "csvwriter": OperatorType.CsvWriter,
+    "sort": OperatorType.Sort,
+    "window": OperatorType.Window,
+    "select": OperatorType.Select,
+    "groupby": OperatorType.GroupBy,
+    "groupjoin": OperatorType.GroupJoin,
+    "multiwayjoin": OperatorType.MultiWayJoin,
+    "tablescan": OperatorType.TableScan,
+    "inlinetable": OperatorType.InlineTable,
+    "map": OperatorType.Map,
+    "earlyexecution": OperatorType.EarlyExecution,
+    "pipelinebreakerscan": OperatorType.PipelineBreakerScan,
+    "temp": OperatorType.Temp,
+    "setoperation": OperatorType.SetOperation,
+    "assertsingle": OperatorType.AssertSingle,
+    "earlyprobe": OperatorType.EarlyProbe,
+    "analyzeplan": OperatorType.AnalyzePlan,
+}
+
+
 def parse_operator_type(op: dict) -> OperatorType:
     name = op["operator"]
     name = name.rstrip(digits)
@@ -92,25 +115,30 @@ def parse_operator_type(op: dict) -> OperatorType:
         elif op["physicalOperator"] == "indexnljoin":
             return OperatorType.IndexNLJoin
 
-    name_map = {
-        "fileoutput": OperatorType.FileOutput,
-        "csvwriter": OperatorType.CsvWriter,
-        "sort": OperatorType.Sort,
-        "window": OperatorType.Window,
-        "select": OperatorType.Select,
-        "groupby": OperatorType.GroupBy,
-        "groupjoin": OperatorType.GroupJoin,
-        "multiwayjoin": OperatorType.MultiWayJoin,
-        "tablescan": OperatorType.TableScan,
-        "inlinetable": OperatorType.InlineTable,
-        "map": OperatorType.Map,
-        "earlyexecution": OperatorType.EarlyExecution,
-        "pipelinebreakerscan": OperatorType.PipelineBreakerScan,
-        "temp": OperatorType.Temp,
-        "setoperation": OperatorType.SetOperation,
-        "assertsingle": OperatorType.AssertSingle,
-        "earlyprobe": OperatorType.EarlyProbe,
-        "analyzeplan": OperatorType.AnalyzePlan,
-    }
-    assert name in name_map, f"{name} missing in operator name map {name_map}"
-    return name_map[name]
+    assert name in OPERATOR_NAMES, f"{name} missing in operator name map {OPERATOR_NAMES}"
+    return OPERATOR_NAMES[name]
+
+
+def get_topological_order(operators: Iterable) -> dict[int, int]:
+    """
+    position of every operator (by id()) in an order of the whole plan with producers before consumers, computed once
+    per plan in linear time from the parents of the operators (Operator or PlanOperator)
+    sorting the operators of a pipeline by it gives the order of the transitive precedes comparison
+    """
+    operators = list(operators)
+    # inputs of each operator that are not placed yet
+    pending = {id(op): 0 for op in operators}
+    for op in operators:
+        for parent in op.parents:
+            pending[id(parent)] += 1
+    ready = [op for op in operators if pending[id(op)] == 0]
+    order: dict[int, int] = {}
+    while ready:
+        op = ready.pop()
+        order[id(op)] = len(order)
+        for parent in op.parents:
+            pending[id(parent)] -= 1
+            if pending[id(parent)] == 0:
+                ready.append(parent)
+    assert len(order) == len(operators), "operators do not form a dag"
+    return order
@@ -1,17 +1,21 @@
 from dataclasses import dataclass
-
-from typing import Tuple, Optional
+from pathlib import Path
+from typing import Tuple, Optional, TYPE_CHECKING
 
 import numpy as np
-import lightgbm as lgb
-from sklearn.model_selection import train_test_split
 
+from src.feature_layout import save_model
 from src.metrics import q_error
-from src.model import FeatureMapper, TreeModel, PerTupleTreeModel, FlatTreeModel
+from src.model import FeatureMapper, TreeModel, PerTupleTreeModel, FlatTreeModel, get_quantile_model_path
 from src.operators import OperatorType
 from src.query_plan import QueryPlan
 from src.util import AutoNumber
 
+if TYPE_CHECKING:
+    # lightgbm, scipy and sklearn are imported by the training functions, reading benchmarks does not need them
+    import lightgbm as lgb
+    from scipy.sparse import csr_matrix
+
 
 class QueryCategory(AutoNumber):
     fixed = ()  # queries that are part of a benchmark and not generated
@@ -148,12 +152,17 @@ class BenchmarkedQuery:
         return list((f, t) for f, t in zip(features, targets))
 
     def get_feature_matrix(self, feature_mapper: FeatureMapper) -> np.ndarray:
-        if self.feature_matrix is None:
+        # the matrix may have been computed (or loaded from the feature store) in another precision. a lower precision
+        # one is computed again, a higher precision one is cast down (which is how float32 features are computed)
+        if self.feature_matrix is None or self.feature_matrix.dtype.itemsize < feature_mapper.dtype.itemsize:
             self.feature_matrix = feature_mapper.get_pipeline_estimation_matrix(self.query_plan)
-        return self.feature_matrix
+        return self.feature_matrix.astype(feature_mapper.dtype, copy=False)
 
 
 def optimize_tree_model(queries: list[BenchmarkedQuery], verbose: bool = False) -> TreeModel:
+    import lightgbm as lgb
+    from sklearn.model_selection import train_test_split
+
     feature_mapper = FeatureMapper()
     x_vectors = []
     y_values = []
@@ -178,7 +187,7 @@ def optimize_tree_model(queries: list[BenchmarkedQuery], verbose: bool = False)
             print(bst.eval_train(), bst.eval_valid())
     if verbose:
         print(bst.eval_train(), bst.eval_valid())
-    bst.save_model("model.txt")
+    save_model(bst, Path("model.txt"))
     if verbose:
         for bench, y_true, y_pred in list(zip(queries, y, bst.predict(x))):
             print(f"{bench.name}: estimated time: {y_pred:.3f}, true time: {y_true:.3f}")
@@ -186,6 +195,9 @@ def optimize_tree_model(queries: list[BenchmarkedQuery], verbose: bool = False)
 
 
 def optimize_flat_tree_model(queries: list[BenchmarkedQuery], verbose: bool = False) -> FlatTreeModel:
+    import lightgbm as lgb
+    from sklearn.model_selection import train_test_split
+
     feature_mapper = FeatureMapper()
     x_vectors = []
     y_values = []
@@ -214,27 +226,107 @@ def optimize_flat_tree_model(queries: list[BenchmarkedQuery], verbose: bool = Fa
             print(bst.eval_train(), bst.eval_valid())
     if verbose:
         print(bst.eval_train(), bst.eval_valid())
-    bst.save_model("model.txt")
+    save_model(bst, Path("model.txt"))
     if verbose:
         for bench, y_true, y_pred in list(zip(queries, y, bst.predict(x))):
             print(f"{bench.name}: estimated time: {y_pred:.3f}, true time: {y_true:.3f}")
     return FlatTreeModel(bst)
 
 
-def optimize_per_tuple_tree_model(queries: list[BenchmarkedQuery], verbose: bool = False) -> PerTupleTreeModel:
+def train_quantile_boosters(
+    x_train: np.ndarray, y_train: np.ndarray, quantiles: list[float], verbose: bool = False
+) -> dict[float, "lgb.Booster"]:
+    """
+    y is the negative log time per tuple, so its (1 - q) quantile is the q quantile of the runtime
+    """
+    import lightgbm as lgb
+
+    result = {}
+    for quantile in quantiles:
+        assert 0 < quantile < 1, f"invalid quantile {quantile}"
+        param = {"objective": "quantile", "alpha": 1 - quantile, "verbose": 2 if verbose else -1}
+        train_data = lgb.Dataset(x_train, label=y_train, feature_name=FeatureMapper.get_names(), params=param)
+        bst = lgb.Booster(param, train_data)
+        for _ in range(200):
+            bst.update()
+        if verbose:
+            print(f"p{round(quantile * 100)}", bst.eval_train())
+        result[quantile] = bst
+    return result
+
+
+def get_sparse_per_tuple_training_data(queries: list[BenchmarkedQuery]) -> tuple["csr_matrix", np.ndarray]:
+    from scipy.sparse import csr_matrix, vstack as sparse_vstack
+
     feature_mapper = FeatureMapper()
-    x_vectors = []
+    matrices = []
     y_values = []
     for query in queries:
-        for x, y in query.get_per_tuple_pipeline_runtime_data(feature_mapper):
-            if np.any(x != 0):
-                x_vectors.append(x)
-                y_values.append(y)
-    x = np.vstack(x_vectors)
-    y = np.array(y_values)
+        if query.feature_matrix is not None:
+            matrix = csr_matrix(query.feature_matrix)
+        else:
+            matrix = feature_mapper.get_pipeline_estimation_matrix(query.query_plan, as_sparse=True)
+        non_empty = np.diff(matrix.indptr) > 0
+        matrices.append(matrix[non_empty])
+        y_values += [y for y, keep in zip(query.get_per_tuple_pipeline_runtimes(), non_empty) if keep]
+    x = sparse_vstack(matrices, format="csr") if matrices else csr_matrix((0, feature_mapper.n_features))
+    return x, np.array(y_values)
+
+
+def get_per_tuple_training_data(
+    queries: list[BenchmarkedQuery], as_sparse: bool = False
+) -> tuple["np.ndarray | csr_matrix", np.ndarray]:
+    """
+    feature vectors of all non-empty pipelines and their negative log time per tuple
+    with as_sparse the vectors are returned as csr matrix, LightGBM trains on it directly
+    """
+    if as_sparse:
+        x, y = get_sparse_per_tuple_training_data(queries)
+    else:
+        feature_mapper = FeatureMapper()
+        x_vectors = []
+        y_values = []
+        for query in queries:
+            for x, y in query.get_per_tuple_pipeline_runtime_data(feature_mapper):
+                if np.any(x != 0):
+                    x_vectors.append(x)
+                    y_values.append(y)
+        if len(x_vectors) == 0:
+            return np.empty((0, feature_mapper.n_features)), np.empty(0)
+        x = np.vstack(x_vectors)
+        y = np.array(y_values)
+    return x, get_per_tuple_target(y)
+
+
+def get_per_tuple_target(per_tuple_runtimes: np.ndarray) -> np.ndarray:
     # log scale improves training
-    y = np.maximum(y, 1e-15)
-    y = -np.log(y)
+    y = np.maximum(per_tuple_runtimes, 1e-15)
+    return -np.log(y)
+
+
+def optimize_per_tuple_tree_model(
+    queries: list[BenchmarkedQuery],
+    verbose: bool = False,
+    quantiles: Optional[list[float]] = None,
+    as_sparse: bool = False,
+) -> PerTupleTreeModel:
+    x, y = get_per_tuple_training_data(queries, as_sparse)
+    model = train_per_tuple_tree_model(x, y, verbose, quantiles)
+    if verbose:
+        for bench, y_true, y_pred in list(zip(queries, y, model.tree.predict(x))):
+            print(f"{bench.name}: estimated time: {y_pred:.3f}, true time: {y_true:.3f}")
+    return model
+
+
+def train_per_tuple_tree_model(
+    x: "np.ndarray | csr_matrix", y: np.ndarray, verbose: bool = False, quantiles: Optional[list[float]] = None
+) -> PerTupleTreeModel:
+    """
+    train on pipeline feature vectors and their negative log time per tuple (see get_per_tuple_training_data)
+    """
+    import lightgbm as lgb
+    from sklearn.model_selection import train_test_split
+
     seed = 21
     param = {"objective": "mape", "verbose": 2 if verbose else -1}
     x_train, x_val, y_train, y_val = train_test_split(x, y, test_size=0.2, random_state=seed)
@@ -250,8 +342,55 @@ def optimize_per_tuple_tree_model(queries: list[BenchmarkedQuery], verbose: bool
             print(i + 1, bst.eval_train(), bst.eval_valid())
     if verbose:
         print(bst.eval_train(), bst.eval_valid())
-    bst.save_model("model.txt")
+    save_model(bst, Path("model.txt"))
+    model = PerTupleTreeModel(bst)
+    for quantile, quantile_bst in train_quantile_boosters(x_train, y_train, quantiles or [], verbose).items():
+        save_model(quantile_bst, get_quantile_model_path(Path("model.txt"), quantile))
+        model.quantile_models[quantile] = PerTupleTreeModel(quantile_bst)
+    return model
+
+
+def refresh_per_tuple_tree_model(
+    model: PerTupleTreeModel,
+    new_queries: list[BenchmarkedQuery],
+    replay_queries: Optional[list[BenchmarkedQuery]] = None,
+    replay_ratio: float = 1.0,
+    rounds: int = 50,
+    seed: int = 21,
+    verbose: bool = False,
+    as_sparse: bool = False,
+) -> PerTupleTreeModel:
+    """
+    continue boosting the existing booster on the pipelines of newly benchmarked queries instead of retraining
+    a random sample of replay_ratio * (new pipelines) pipelines of replay_queries is mixed in, so the added trees adapt
+    to the new measurements without forgetting the rest of the workload
+    the quantile boosters of the model are refreshed on the same pipelines with their quantile objective
+    """
+    import lightgbm as lgb
+    from scipy.sparse import vstack as sparse_vstack
+
+    x, y = get_per_tuple_training_data(new_queries, as_sparse)
+    if len(y) == 0:
+        raise ValueError("new queries contain no non-empty pipelines")
+    if replay_queries:
+        x_replay, y_replay = get_per_tuple_training_data(replay_queries, as_sparse)
+        n_replay = min(len(y_replay), int(replay_ratio * len(y)))
+        sample = np.random.default_rng(seed).choice(len(y_replay), n_replay, replace=False)
+        x = sparse_vstack([x, x_replay[sample]], format="csr") if as_sparse else np.vstack([x, x_replay[sample]])
+        y = np.concatenate([y, y_replay[sample]])
+    param = {"objective": "mape", "verbose": 2 if verbose else -1}
+    train_data = lgb.Dataset(x, label=y, feature_name=FeatureMapper.get_names(), params=param)
+    bst = lgb.train(param, train_data, num_boost_round=rounds, init_model=model.tree, keep_training_booster=True)
     if verbose:
-        for bench, y_true, y_pred in list(zip(queries, y, bst.predict(x))):
-            print(f"{bench.name}: estimated time: {y_pred:.3f}, true time: {y_true:.3f}")
-    return PerTupleTreeModel(bst)
+        print(f"refreshed on {len(y)} pipelines:", bst.eval_train())
+    refreshed = PerTupleTreeModel(bst)
+    for quantile, quantile_model in model.quantile_models.items():
+        param = {"objective": "quantile", "alpha": 1 - quantile, "verbose": 2 if verbose else -1}
+        train_data = lgb.Dataset(x, label=y, feature_name=FeatureMapper.get_names(), params=param)
+        quantile_bst = lgb.train(
+            param, train_data, num_boost_round=rounds, init_model=quantile_model.tree, keep_training_booster=True
+        )
+        if verbose:
+            print(f"p{round(quantile * 100)}", quantile_bst.eval_train())
+        refreshed.quantile_models[quantile] = PerTupleTreeModel(quantile_bst)
+    return refreshed
@@ -0,0 +1,260 @@
+"""
+Packed benchmark corpus: one archive per database instead of one json file per benchmarked query.
+
+An archive starts with a header (magic, version, offset and length of the index), followed by the records and the
+index. Every record is the projected benchmark json (json_decoding.project_benchmark) compressed with lz4 and prefixed
+with its length, the index maps the path of the benchmark file relative to data/<db>/ (e.g. "fixed/q1.json") to the
+offset and length of its record. Archives are memory mapped, reading a query only touches its own record.
+
+Usage (from T3 project root):
+  python -m src.plan_archive pack                      # data/<db>/**/*.json -> data/archives/<db>.t3pa
+  python -m src.plan_archive pack --dbs tpchSf1 job
+  python -m src.plan_archive pack-tar downloaded_data/benchdata.tar.lz4  # archives straight from the download
+  python -m src.plan_archive list data/archives/job.t3pa
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import tarfile
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+import lz4.frame
+
+from src.database import Database
+from src.json_decoding import JsonDecoder, get_benchmark_decoder, project_benchmark
+
+PLAN_ARCHIVE_DIR = Path("data/archives")
+PLAN_ARCHIVE_SUFFIX = ".t3pa"
+PLAN_ARCHIVE_MAGIC = b"T3PA"
+# bump when the layout or the projection of the records changes, archives of other versions are rejected
+PLAN_ARCHIVE_VERSION = 1
+
+# magic, version, index offset, index length
+HEADER = struct.Struct("<4sIQQ")
+RECORD_LENGTH = struct.Struct("<I")
+
+
+class PlanArchiveError(Exception):
+    pass
+
+
+def get_plan_archive_path(db: Database, archive_dir: Path = PLAN_ARCHIVE_DIR) -> Path:
+    return archive_dir / f"{db.get_path()}{PLAN_ARCHIVE_SUFFIX}"
+
+
+class PlanArchiveWriter:
+    """
+    Appends benchmark files to a new archive, the index is written by close
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # written next to the target and renamed by close, readers never see a partial archive
+        self._tmp_path = path.with_name(path.name + ".tmp")
+        self._fd: BinaryIO = open(self._tmp_path, "wb")
+        self._fd.write(HEADER.pack(PLAN_ARCHIVE_MAGIC, PLAN_ARCHIVE_VERSION, 0, 0))
+        self._index: dict[str, tuple[int, int]] = {}
+
+    def add(self, name: str, benchmark: dict):
+        """
+        add the benchmark json of data/<db>/<name>
+        """
+        assert name not in self._index, f"{name} is already in {self.path}"
+        record = lz4.frame.compress(json.dumps(project_benchmark(benchmark)).encode())
+        self._fd.write(RECORD_LENGTH.pack(len(record)))
+        self._index[name] = (self._fd.tell(), len(record))
+        self._fd.write(record)
+
+    def close(self):
+        index_offset = self._fd.tell()
+        index = json.dumps(sorted([name, offset, length] for name, (offset, length) in self._index.items())).encode()
+        self._fd.write(index)
+        self._fd.seek(0)
+        self._fd.write(HEADER.pack(PLAN_ARCHIVE_MAGIC, PLAN_ARCHIVE_VERSION, index_offset, len(index)))
+        self._fd.close()
+        self._tmp_path.replace(self.path)
+
+    def abort(self):
+        """
+        drop the partially written archive, an existing archive at the path is kept
+        """
+        self._fd.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "PlanArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PlanArchive:
+    """
+    Read only, memory mapped view of an archive
+    """
+
+    def __init__(self, path: Path, decoder: Optional[JsonDecoder] = None):
+        self.path = path
+        # the records are projected already
+        self.decoder = decoder if decoder is not None else JsonDecoder(get_benchmark_decoder().name)
+        with open(path, "rb") as fd:
+            if os.fstat(fd.fileno()).st_size < HEADER.size:
+                raise PlanArchiveError(f"{path} is not a plan archive")
+            self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, index_length = HEADER.unpack_from(self._data, 0)
+        if magic != PLAN_ARCHIVE_MAGIC:
+            raise PlanArchiveError(f"{path} is not a plan archive")
+        if version != PLAN_ARCHIVE_VERSION:
+            raise PlanArchiveError(f"{path} has version {version}, expected {PLAN_ARCHIVE_VERSION}, pack it again")
+        index = json.loads(self._data[index_offset : index_offset + index_length])
+        self._index: dict[str, tuple[int, int]] = {name: (offset, length) for name, offset, length in index}
+
+    def get_names(self) -> list[str]:
+        """
+        the relative paths of all benchmark files, sorted
+        """
+        return list(self._index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def read(self, name: str) -> dict:
+        """
+        the projected benchmark json of data/<db>/<name>
+        """
+        offset, length = self._index[name]
+        return self.decoder.loads(lz4.frame.decompress(self._data[offset : offset + length]))
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self) -> "PlanArchive":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_current_plan_archive(
+    db: Database, data_dir: Path = Path("data"), archive_dir: Path = PLAN_ARCHIVE_DIR
+) -> Optional[Path]:
+    """
+    the plan archive of the database, None if there is none
+    an archive is read instead of data/<db>/, so it is rejected if that directory (or a benchmark file in it) was
+    changed after the archive was written or holds a different number of benchmark files, both only cost a stat per
+    file when data/<db>/ exists next to the archive
+    """
+    path = get_plan_archive_path(db, archive_dir)
+    if not path.exists():
+        return None
+    source = data_dir / db.get_path()
+    if not source.is_dir():
+        return path
+    files = list(source.rglob("*.json"))
+    entries = [source, *(d for d in source.rglob("*") if d.is_dir()), *files]
+    newest = max(e.stat().st_mtime_ns for e in entries)
+    with PlanArchive(path) as archive:
+        n_records = len(archive)
+    if newest > path.stat().st_mtime_ns or len(files) != n_records:
+        raise PlanArchiveError(
+            f"{source} ({len(files)} files) changed after {path} ({n_records} files) was packed, pack it again with "
+            f"python -m src.plan_archive pack --dbs {db.get_path()} or remove one of them"
+        )
+    return path
+
+
+def pack_database(db: Database, data_dir: Path = Path("data"), archive_dir: Path = PLAN_ARCHIVE_DIR) -> Optional[Path]:
+    """
+    pack data/<db>/**/*.json into one archive, None if the database has no benchmark files
+    """
+    source = data_dir / db.get_path()
+    files = sorted(source.rglob("*.json"))
+    if len(files) == 0:
+        return None
+    path = get_plan_archive_path(db, archive_dir)
+    decoder = JsonDecoder()
+    with PlanArchiveWriter(path) as writer:
+        for file in files:
+            writer.add(file.relative_to(source).as_posix(), decoder.load_file(file))
+    return path
+
+
+def iter_tar_benchmarks(tar_file: Path) -> Iterator[tuple[tarfile.TarFile, tarfile.TarInfo]]:
+    """
+    stream the members of a (lz4 compressed) tar archive without unpacking it
+    """
+    fileobj = lz4.frame.open(tar_file, "rb") if tar_file.suffix == ".lz4" else open(tar_file, "rb")
+    with fileobj, tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            yield tar, member
+
+
+def pack_tar(tar_file: Path, archive_dir: Path = PLAN_ARCHIVE_DIR, extract_dir: Path = Path(".")) -> list[Path]:
+    """
+    build the archives of all databases from the benchmark data download (benchdata.tar.lz4) in one pass
+    data/<db>/<category>/*.json members go into the archive of <db>, everything else is extracted to extract_dir
+    """
+    writers: dict[str, PlanArchiveWriter] = {}
+    decoder = JsonDecoder()
+    try:
+        for tar, member in iter_tar_benchmarks(tar_file):
+            parts = Path(member.name).parts
+            if member.isfile() and len(parts) >= 4 and parts[0] == "data" and member.name.endswith(".json"):
+                db_path = parts[1]
+                if db_path not in writers:
+                    writers[db_path] = PlanArchiveWriter(archive_dir / f"{db_path}{PLAN_ARCHIVE_SUFFIX}")
+                writers[db_path].add("/".join(parts[2:]), decoder.loads(tar.extractfile(member).read()))
+            elif not member.isdir():
+                tar.extract(member, extract_dir)
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    for writer in writers.values():
+        writer.close()
+    return sorted(writer.path for writer in writers.values())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pack the benchmark corpus into one archive per database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Pack data/<db>/**/*.json")
+    pack_parser.add_argument("--dbs", nargs="+", metavar="DB", help="Databases to pack (default: all)")
+    pack_parser.add_argument("--out", type=Path, default=PLAN_ARCHIVE_DIR, help="Archive directory")
+    tar_parser = subparsers.add_parser("pack-tar", help="Pack the benchmark files of a downloaded tar(.lz4)")
+    tar_parser.add_argument("tar", type=Path)
+    tar_parser.add_argument("--out", type=Path, default=PLAN_ARCHIVE_DIR, help="Archive directory")
+    list_parser = subparsers.add_parser("list", help="List the benchmark files of an archive")
+    list_parser.add_argument("archive", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        from src.database_manager import DatabaseManager
+
+        dbs = DatabaseManager.get_databases(args.dbs) if args.dbs else DatabaseManager.get_all_databases()
+        for db in dbs:
+            path = pack_database(db, archive_dir=args.out)
+            if path is not None:
+                print(f"Packed {db.get_path()} into {path} ({path.stat().st_size / 2**20:.1f} MB)")
+    elif args.command == "pack-tar":
+        for path in pack_tar(args.tar, args.out):
+            print(f"Packed {path} ({path.stat().st_size / 2**20:.1f} MB)")
+    else:
+        with PlanArchive(args.archive) as archive:
+            for name in archive.get_names():
+                print(name)
+
+
+if __name__ == "__main__":
+    main()
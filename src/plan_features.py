@@ -0,0 +1,171 @@
+from typing import Optional
+
+import numpy as np
+
+# get_operator_stage is looked up on the module at every call, the postgres patches replace it
+import src.operator_stages as operator_stages
+from src.database import Database
+from src.features import FeatureMapper
+from src.operator_stages import OperatorStage
+from src.operators import Expressions, OperatorType
+from src.query_plan import PlanParser
+
+
+class PlanOperator:
+    """
+    The properties of an operator that its features depend on, get_operator_stage only reads type, json and parents.
+    """
+
+    __slots__ = (
+        "type",
+        "op_id",
+        "json",
+        "parents",
+        "input_op",
+        "right_input_op",
+        "output_cardinality",
+        "input_cardinality",
+        "right_input_cardinality",
+        "output_tuple_size",
+        "expressions",
+    )
+
+    def __init__(
+        self,
+        operator_type: OperatorType,
+        json: dict,
+        parents: list["PlanOperator"],
+        output_cardinality: float,
+        input_cardinality: float,
+        right_input_cardinality: Optional[float],
+        output_tuple_size: float,
+        expressions: Expressions,
+    ):
+        self.type = operator_type
+        self.op_id = json["operatorId"]
+        self.json = json
+        self.parents = parents
+        self.input_op: Optional[PlanOperator] = None
+        self.right_input_op: Optional[PlanOperator] = None
+        self.output_cardinality = output_cardinality
+        self.input_cardinality = input_cardinality
+        self.right_input_cardinality = right_input_cardinality
+        self.output_tuple_size = output_tuple_size
+        self.expressions = expressions
+
+
+class PlanPhase:
+    __slots__ = ("operator", "stage", "fraction")
+
+    def __init__(self, operator: PlanOperator, stage: OperatorStage, fraction: float = 1.0):
+        self.operator = operator
+        self.stage = stage
+        self.fraction = fraction
+
+
+class PlanFeatureExtractor(PlanParser):
+    """
+    Pipeline features of an Umbra plan (the json with "plan", "ius" and "analyzePlanPipelines") in a single walk over
+    the json, without building the Operator, ExecutionPhase and Pipeline objects of a QueryPlan.
+    The results are identical to FeatureMapper.get_pipeline_estimation_matrix and get_pipeline_scan_sizes of the
+    QueryPlan of the same json, testing/check_plan_features.py verifies this on the benchmark files.
+    """
+
+    def __init__(
+        self,
+        plan: dict,
+        db: Database,
+        predicted_cardinalities: bool,
+        feature_mapper: Optional[FeatureMapper] = None,
+    ):
+        super().__init__(plan, db, predicted_cardinalities)
+        self.feature_mapper = feature_mapper if feature_mapper is not None else FeatureMapper()
+        self.operators: dict[int, PlanOperator] = {}
+        self._parse_operator(plan["plan"], None)
+        self.pipelines = self._build_pipelines(plan["analyzePlanPipelines"])
+        self.scan_sizes = [operator_stages.get_scan_cardinality(pipeline) for pipeline in self.pipelines]
+
+    def _create_operator(self, op: dict, operator_type: OperatorType, parents: list[PlanOperator]) -> PlanOperator:
+        return PlanOperator(
+            operator_type,
+            op,
+            parents,
+            self._get_output_cardinality(op, self.predicted_cardinalities),
+            self._get_input_cardinality(op, operator_type, self.predicted_cardinalities),
+            self._get_right_cardinality(op, operator_type, self.predicted_cardinalities),
+            self._get_tuple_size(op),
+            self._parse_expressions(op, operator_type),
+        )
+
+    def _build_pipelines(self, pipelines: list[dict]) -> list[list[PlanPhase]]:
+        result = [
+            [PlanPhase(op, operator_stages.get_operator_stage(i, op, ops)) for i, op in enumerate(ops)]
+            for ops in self._get_pipeline_operators(pipelines)
+        ]
+        self._fix_union_all(
+            result, lambda phase, fraction, _: PlanPhase(phase.operator, phase.stage, phase.fraction * fraction)
+        )
+        return result
+
+    @staticmethod
+    def _get_phase_values(phase: PlanPhase, last: PlanPhase, scan: float) -> list[float]:
+        """
+        FeatureMapper.get_phase_values with the cardinality methods of ExecutionPhase inlined
+        """
+        op = phase.operator
+        fraction = phase.fraction
+        is_probe = phase.stage == OperatorStage.Probe
+        # ExecutionPhase compares by value, the last phase is only repeated for operators listed twice in a pipeline
+        is_last = phase is last or (op is last.operator and phase.stage == last.stage and fraction == last.fraction)
+        right_input_cardinality = op.right_input_cardinality if op.right_input_cardinality is not None else 0
+        if op.right_input_cardinality is None:
+            right_percentage = None
+        else:
+            right_percentage = 0 if scan == 0 else op.right_input_cardinality * fraction / scan
+        return FeatureMapper.get_operator_values(
+            op.type,
+            phase.stage,
+            op.input_cardinality if is_probe else op.input_cardinality * fraction,
+            op.input_op.output_tuple_size if op.input_op is not None else 0,
+            op.output_cardinality if is_last else op.output_cardinality * fraction,
+            op.output_tuple_size,
+            right_input_cardinality * fraction if is_probe else right_input_cardinality,
+            0 if scan == 0 else op.input_cardinality * fraction / scan,
+            0 if scan == 0 else op.output_cardinality * fraction / scan,
+            right_percentage,
+            op.expressions,
+        )
+
+    def get_feature_matrix(self, as_sparse: bool = False):
+        """
+        same as FeatureMapper.get_pipeline_estimation_matrix
+        """
+        values = []
+        indices = []
+        rows = []
+        for i, (pipeline, scan) in enumerate(zip(self.pipelines, self.scan_sizes)):
+            for phase in pipeline:
+                values.append(self._get_phase_values(phase, pipeline[-1], scan))
+                indices.append(self.feature_mapper.get_scatter_indices(phase.operator.type, phase.stage))
+                rows.append(i)
+        return self.feature_mapper.scatter_phase_values(values, indices, rows, len(self.pipelines), as_sparse)
+
+    def get_scan_sizes(self) -> np.ndarray:
+        """
+        same as FeatureMapper.get_pipeline_scan_sizes
+        """
+        return np.array(self.scan_sizes)
+
+
+def extract_pipeline_features(
+    plan: dict,
+    db: Database,
+    predicted_cardinalities: bool,
+    feature_mapper: Optional[FeatureMapper] = None,
+    as_sparse: bool = False,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    pipeline feature matrix and scan sizes of an Umbra plan json
+    """
+    extractor = PlanFeatureExtractor(plan, db, predicted_cardinalities, feature_mapper)
+    return extractor.get_feature_matrix(as_sparse), extractor.get_scan_sizes()
@@ -25,9 +25,8 @@ if str(repo) not in sys.path:
 from src.postgres import pg_patches
 pg_patches.apply_patches()
 
-import lightgbm as lgb
-
 from src.database_manager import DatabaseManager
+from src.feature_layout import load_model
 from src.metrics import q_error
 from src.model import PerTupleTreeModel
 from src.optimizer import BenchmarkedQuery, QueryCategory
@@ -87,7 +86,7 @@ def predict_from_pg_json(
     if not Path(model_path).exists():
         raise FileNotFoundError(f"Model file not found: {model_path}. Run training first (e.g. python -m src.postgres.training).")
 
-    booster = lgb.Booster(model_file=str(model_path))
+    booster = load_model(Path(model_path))
     model = PerTupleTreeModel(booster)
 
     total = model.estimate_runtime(b)
@@ -11,6 +11,7 @@ Requires: lightgbm, sklearn, and project deps (see requirements.txt). JOB schema
 Usage (from T3 project root):
   python -m src.postgres.training
   python -m src.postgres.training --out model_custom.txt --no-eval
+  python -m src.postgres.training --quantiles 0.5 0.9  # also writes model_pg_q50.txt and model_pg_q90.txt
 """
 
 from __future__ import annotations
@@ -34,8 +35,9 @@ import lightgbm as lgb
 from sklearn.model_selection import train_test_split
 
 from src.database_manager import DatabaseManager
-from src.model import FeatureMapper, PerTupleTreeModel
-from src.optimizer import BenchmarkedQuery, QueryCategory
+from src.feature_layout import save_model
+from src.model import FeatureMapper, PerTupleTreeModel, get_quantile_model_path
+from src.optimizer import BenchmarkedQuery, QueryCategory, train_quantile_boosters
 from src.postgres.pg_to_umbra import load_pg_json, pg_explain_to_umbra
 from src.query_plan import QueryPlan
 
@@ -118,6 +120,7 @@ def train_per_tuple_model(
     queries: list[BenchmarkedQuery],
     seed: int = TRAIN_TEST_SEED,
     verbose: bool = True,
+    quantiles: list[float] | None = None,
 ) -> PerTupleTreeModel:
     """Same logic as optimizer.optimize_per_tuple_tree_model but with configurable seed."""
     feature_mapper = FeatureMapper()
@@ -152,7 +155,10 @@ def train_per_tuple_model(
             print(i + 1, bst.eval_train(), bst.eval_valid())
     if verbose:
         print("Final:", bst.eval_train(), bst.eval_valid())
-    return PerTupleTreeModel(bst), bst
+    model = PerTupleTreeModel(bst)
+    for quantile, quantile_bst in train_quantile_boosters(x_train, y_train, quantiles or [], verbose).items():
+        model.quantile_models[quantile] = PerTupleTreeModel(quantile_bst)
+    return model, bst
 
 
 def main() -> None:
@@ -187,6 +193,13 @@ def main() -> None:
         action="store_true",
         help="Less training output",
     )
+    parser.add_argument(
+        "--quantiles",
+        type=float,
+        nargs="*",
+        default=[],
+        help="Also train runtime quantile models (e.g. 0.5 0.9), saved next to the output model",
+    )
     args = parser.parse_args()
 
     data_dir = args.data.resolve()
@@ -211,22 +224,31 @@ def main() -> None:
     print(f"Loaded {len(train_queries)} train benchmarks")
 
     model, bst = train_per_tuple_model(
-        train_queries, seed=args.seed, verbose=not args.quiet
+        train_queries, seed=args.seed, verbose=not args.quiet, quantiles=args.quantiles
     )
     out_path = args.out if args.out.is_absolute() else _repo / args.out
-    bst.save_model(str(out_path))
+    save_model(bst, out_path)
     print(f"Saved model to {out_path}")
+    for quantile, quantile_model in model.quantile_models.items():
+        quantile_path = get_quantile_model_path(out_path, quantile)
+        save_model(quantile_model.tree, quantile_path)
+        print(f"Saved p{round(quantile * 100)} model to {quantile_path}")
 
     if not args.no_eval and test_paths:
         test_queries = load_benchmarked_queries(test_paths)
         if test_queries:
             from src.metrics import q_error
             errors = []
-            for b in test_queries:
-                pred = model.estimate_runtime(b)
+            preds, _ = model.estimate_batch(test_queries)
+            for b, pred in zip(test_queries, preds):
                 actual = b.get_total_runtime()
                 errors.append(q_error(actual, pred))
             print(f"Test set ({len(test_queries)} queries): q-error min={min(errors):.4f} median={np.median(errors):.4f} max={max(errors):.4f}")
+            if model.quantile_models:
+                _, quantile_preds = model.predict_interval(test_queries)
+                actual = np.array([b.get_total_runtime() for b in test_queries])
+                for quantile, pred in quantile_preds.items():
+                    print(f"p{round(quantile * 100)}: {np.mean(actual <= pred):.1%} of test queries at or below the estimate")
 
 
 if __name__ == "__main__":
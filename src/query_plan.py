@@ -1,30 +1,29 @@
 import math
-from functools import cmp_to_key
-from typing import Tuple, Optional
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Tuple, Optional
 
 from src.database import Database
+from src.expression_cache import get_expression_cache
 from src.operator_stages import ExecutionPhase, build_pipeline, OperatorStage
 from src.operator_stages import Pipeline
 from src.operators import Operator, Expressions
 from src.operators import OperatorType
-from src.operators import parse_operator_type
+from src.operators import get_topological_order, parse_operator_type
 
 
-class QueryPlan:
-    operators: dict[int, Operator]
-    execution_phases: list[ExecutionPhase]
-    pipelines: list[Pipeline]
+class PlanParser(ABC):
+    """
+    Reads the operator properties (cardinalities, tuple sizes, expressions) from the json of an Umbra plan.
+    """
+
     db: Database
     ius: dict[str, float]  # maps from iu name to estimated size
     predicted_cardinalities: bool
 
     def __init__(self, plan: dict, db: Database, predicted_cardinalities: bool):
-        self.json_plan = plan["plan"]
-        self.operators = {}
         self.db = db
         self.predicted_cardinalities = predicted_cardinalities
         self.ius = self._parse_ius(plan["ius"])
-        self._parse_operator(self.json_plan, [])
 
     @staticmethod
     def _parse_ius(ius: list[dict]) -> dict[str, float]:
@@ -92,7 +91,7 @@ class QueryPlan:
         if operator_type == OperatorType.IndexNLJoin:
             return self._get_input_cardinality(op["right"], parse_operator_type(op["right"]), predicted_cardinalities)
         if operator_type.is_join_type():
-            return QueryPlan._get_output_cardinality(op["right"], predicted_cardinalities)
+            return PlanParser._get_output_cardinality(op["right"], predicted_cardinalities)
             # return op["right"]["cardinality"]
         else:
             return None
@@ -106,34 +105,12 @@ class QueryPlan:
                 iu_sizes.append(iu["estimatedSize"])
         return sum(iu_sizes)
 
-    @staticmethod
-    def _annotate_child(parent: Operator, child: Operator):
-        if parent.type.is_join_type():
-            if parent.json["left"] == child.json:
-                parent.input_op = child
-            elif parent.json["right"] == child.json:
-                parent.right_input_op = child
-            else:
-                assert False, "unhandeld join child"
-        elif parent.type == OperatorType.SetOperation:
-            parent.input_op = child
-        elif parent.type == OperatorType.PipelineBreakerScan:
-            if "pipelineBreaker" in parent.json:
-                assert parent.json["pipelineBreaker"] == child.json
-            parent.input_op = child
-        elif parent.type == OperatorType.MultiWayJoin:
-            parent.input_op = child
-        elif "input" in parent.json and parent.json["input"] == child.json:
-            parent.input_op = child
-        else:
-            assert False, "unknown child"
-
     @staticmethod
     def _featurize_expression(
         expression: dict, result: Expressions, incoming_selectivity: float, expression_selectivity: float
     ):
         if "mode" in expression and expression["mode"] == "filter":
-            QueryPlan._featurize_expression(expression["value"], result, incoming_selectivity, expression_selectivity)
+            PlanParser._featurize_expression(expression["value"], result, incoming_selectivity, expression_selectivity)
         elif "mode" in expression and expression["mode"] == "joinfilter":
             result.join_filter_count += 1
         elif ("mode" in expression and expression["mode"] in ("<", "<=", ">", ">=", "=", "!=", "isnotnull", "is")) or (
@@ -143,7 +120,7 @@ class QueryPlan:
             result.compare_count += 1
             result.compare_selectivity += incoming_selectivity
         elif "expression" in expression and expression["expression"] == "not":
-            QueryPlan._featurize_expression(expression["input"], result, incoming_selectivity, expression_selectivity)
+            PlanParser._featurize_expression(expression["input"], result, incoming_selectivity, expression_selectivity)
         elif "expression" in expression and expression["expression"] == "or":
             result.or_expression_count += 1
             result.or_selectivity += incoming_selectivity
@@ -153,7 +130,7 @@ class QueryPlan:
             single_expression_sel = (incoming_selectivity - outgoing_sel) / n_expressions
             for i, input in enumerate(expression["input"]):
                 current_incoming_sel = incoming_selectivity - i * single_expression_sel
-                QueryPlan._featurize_expression(input, result, current_incoming_sel, single_expression_sel)
+                PlanParser._featurize_expression(input, result, current_incoming_sel, single_expression_sel)
         elif "expression" in expression and expression["expression"] == "and":
             n_expressions = len(expression["input"])
             outgoing_sel = incoming_selectivity * expression_selectivity
@@ -161,7 +138,7 @@ class QueryPlan:
             single_expression_sel = (incoming_selectivity - outgoing_sel) / n_expressions
             for i, input in enumerate(expression["input"]):
                 current_incoming_sel = incoming_selectivity - i * single_expression_sel
-                QueryPlan._featurize_expression(input, result, current_incoming_sel, single_expression_sel)
+                PlanParser._featurize_expression(input, result, current_incoming_sel, single_expression_sel)
         elif "expression" in expression and expression["expression"] == "in":
             result.in_expression_count += 1
             result.in_expression_selectivity += incoming_selectivity
@@ -199,12 +176,12 @@ class QueryPlan:
         elif expression["expression"] in ("in", "like", "startswith"):
             return 0.01
         elif expression["expression"] == "not":
-            return 1.0 - QueryPlan._get_expression_selectivity(expression["input"])
+            return 1.0 - PlanParser._get_expression_selectivity(expression["input"])
         elif expression["expression"] == "and":
-            selectivities = [QueryPlan._get_expression_selectivity(e) for e in expression["input"]]
+            selectivities = [PlanParser._get_expression_selectivity(e) for e in expression["input"]]
             return math.prod(selectivities)
         elif expression["expression"] == "or":
-            selectivities = [QueryPlan._get_expression_selectivity(e) for e in expression["input"]]
+            selectivities = [PlanParser._get_expression_selectivity(e) for e in expression["input"]]
             return min([sum(selectivities), 1.0])
         assert False, "could not find selectivity for expression"
 
@@ -215,70 +192,154 @@ class QueryPlan:
         selectivities = [self._get_expression_selectivity(e) for e in expressions]
         return expressions, selectivities
 
-    def _parse_expressions(self, op: dict, operator_type: OperatorType) -> Expressions:
+    def _featurize_scan_expressions(self, op: dict) -> Expressions:
         result = Expressions()
-        if operator_type == OperatorType.TableScan:
-            expressions, selectivities = self._list_expressions(op)
-            current_selectivity = 1.0
-            for expression, selectivity in zip(expressions, selectivities):
-                self._featurize_expression(expression, result, current_selectivity, selectivity)
-                current_selectivity *= selectivity
-
+        expressions, selectivities = self._list_expressions(op)
+        current_selectivity = 1.0
+        for expression, selectivity in zip(expressions, selectivities):
+            self._featurize_expression(expression, result, current_selectivity, selectivity)
+            current_selectivity *= selectivity
         return result
 
-    def _parse_operator(self, op: dict, parent: list[Operator]):
-        assert len(parent) <= 1
-        operator_type = parse_operator_type(op)
-        output_cardinality = self._get_output_cardinality(op, self.predicted_cardinalities)
-        input_cardinality = self._get_input_cardinality(op, operator_type, self.predicted_cardinalities)
-        right_cardinality = self._get_right_cardinality(op, operator_type, self.predicted_cardinalities)
-        output_tuple_size = self._get_tuple_size(op)
+    def _parse_expressions(self, op: dict, operator_type: OperatorType) -> Expressions:
+        if operator_type != OperatorType.TableScan:
+            return Expressions()
+        cache = get_expression_cache()
+        if cache is None or (len(op["restrictions"]) == 0 and len(op["residuals"]) == 0):
+            return self._featurize_scan_expressions(op)
+        return cache.get(op["restrictions"] + op["residuals"], lambda: self._featurize_scan_expressions(op))
 
-        expressions = self._parse_expressions(op, operator_type)
+    # the operator graph, shared by QueryPlan (Operator) and PlanFeatureExtractor (PlanOperator). Subclasses keep
+    # their operators by id in self.operators and create them in _create_operator
 
-        current_op = Operator(
-            operator_type,
-            op["operator"],
-            op["operatorId"],
-            output_cardinality,
-            input_cardinality,
-            right_cardinality,
-            output_tuple_size,
-            expressions,
-            parent,
-            None,
-            None,
-            op,
-        )
-
-        if current_op.op_id in self.operators:
-            self.operators[current_op.op_id].parents.extend(parent)
-            return
+    @abstractmethod
+    def _create_operator(self, op: dict, operator_type: OperatorType, parents: list) -> Any:
+        pass
 
+    @staticmethod
+    def _get_child_plans(op: dict, operator_type: OperatorType) -> list[dict]:
         if operator_type.is_join_type():
-            self._parse_operator(op["left"], [current_op])
-            self._parse_operator(op["right"], [current_op])
+            return [op["left"], op["right"]]
         elif operator_type == OperatorType.MultiWayJoin:
-            for input in op["inputs"]:
-                self._parse_operator(input["op"], [current_op])
+            return [input["op"] for input in op["inputs"]]
         elif operator_type == OperatorType.PipelineBreakerScan:
             # only one of the scanners will include the input
-            if "pipelineBreaker" in op:
-                self._parse_operator(op["pipelineBreaker"], [current_op])
+            return [op["pipelineBreaker"]] if "pipelineBreaker" in op else []
         elif operator_type in (OperatorType.TableScan, OperatorType.InlineTable):
-            pass
+            return []
         elif operator_type == OperatorType.SetOperation:
-            for a in op["arguments"]:
-                self._parse_operator(a["input"], [current_op])
-        else:
-            self._parse_operator(op["input"], [current_op])
+            return [a["input"] for a in op["arguments"]]
+        return [op["input"]]
 
-        for p in parent:
-            self._annotate_child(p, current_op)
+    @staticmethod
+    def _annotate_child(parent, child):
+        if parent.type.is_join_type():
+            if parent.json["left"] == child.json:
+                parent.input_op = child
+            elif parent.json["right"] == child.json:
+                parent.right_input_op = child
+            else:
+                assert False, "unhandeld join child"
+        elif parent.type == OperatorType.SetOperation:
+            parent.input_op = child
+        elif parent.type == OperatorType.PipelineBreakerScan:
+            if "pipelineBreaker" in parent.json:
+                assert parent.json["pipelineBreaker"] == child.json
+            parent.input_op = child
+        elif parent.type == OperatorType.MultiWayJoin:
+            parent.input_op = child
+        elif "input" in parent.json and parent.json["input"] == child.json:
+            parent.input_op = child
+        else:
+            assert False, "unknown child"
 
+    def _parse_operator(self, op: dict, parent: Optional[Any]):
+        """
+        adds the operator and its inputs to self.operators, operators shared by several parents are parsed once
+        """
+        parents = [parent] if parent is not None else []
+        if op["operatorId"] in self.operators:
+            self.operators[op["operatorId"]].parents.extend(parents)
+            return
+        operator_type = parse_operator_type(op)
+        current_op = self._create_operator(op, operator_type, parents)
+        for child in self._get_child_plans(op, operator_type):
+            self._parse_operator(child, current_op)
+        if parent is not None:
+            self._annotate_child(parent, current_op)
         assert current_op.op_id not in self.operators
         self.operators[current_op.op_id] = current_op
 
+    def _get_pipeline_operators(self, pipelines: list[dict]) -> list[list]:
+        """
+        the operators of every pipeline of analyzePlanPipelines, producers before consumers
+        """
+        operator_dict = {op.json["analyzePlanId"]: op for op in self.operators.values()}
+        order = get_topological_order(self.operators.values())
+        result = []
+        for pipeline in pipelines:
+            if pipeline["operators"] == [0] and 0 not in operator_dict and pipeline["duration"] == 0:
+                assert False, "could not assign operators to pipelines"
+            result.append(
+                sorted((operator_dict[op_id] for op_id in pipeline["operators"]), key=lambda op: order[id(op)])
+            )
+        return result
+
+    def _fix_union_all(self, pipelines: list[list], copy_phase: Callable[[Any, float, int], Any]) -> list[int]:
+        """
+        union-all pipelines are completely wrong, we need to identify the target pipeline that runs on the resulting
+        data of the union all operator.
+        All operators of this pipline will be appended to all pipelines that end with the union_all operator.
+        pipelines are the phases (operator, stage, fraction) of every pipeline, copy_phase(phase, fraction, i) copies a
+        phase of the target pipeline for pipeline i with its fraction multiplied by fraction
+        returns the indices of the target pipelines, which are emptied
+        """
+        result = []
+        for op in self.operators.values():
+            if op.type == OperatorType.SetOperation and op.json["operation"] == "unionall":
+                tail = next(i for i, phases in enumerate(pipelines) if len(phases) > 0 and phases[0].operator is op)
+                tail_phases = pipelines[tail]
+                tail_phases[0].stage = OperatorStage.PassThrough
+                union_cardinality = tail_phases[0].operator.output_cardinality
+                if union_cardinality < 1:
+                    union_cardinality = 1
+                for i, phases in enumerate(pipelines):
+                    if len(phases) > 0 and phases[-1].operator is op:
+                        fraction = phases[-2].operator.output_cardinality / union_cardinality
+                        phases[-1].stage = OperatorStage.PassThrough
+                        phases += [copy_phase(phase, fraction, i) for phase in tail_phases[1:]]
+                tail_phases.clear()
+                result.append(tail)
+        return result
+
+
+class QueryPlan(PlanParser):
+    operators: dict[int, Operator]
+    execution_phases: list[ExecutionPhase]
+    pipelines: list[Pipeline]
+
+    def __init__(self, plan: dict, db: Database, predicted_cardinalities: bool):
+        super().__init__(plan, db, predicted_cardinalities)
+        self.json_plan = plan["plan"]
+        self.operators = {}
+        self._parse_operator(self.json_plan, None)
+
+    def _create_operator(self, op: dict, operator_type: OperatorType, parents: list[Operator]) -> Operator:
+        return Operator(
+            operator_type,
+            op["operator"],
+            op["operatorId"],
+            self._get_output_cardinality(op, self.predicted_cardinalities),
+            self._get_input_cardinality(op, operator_type, self.predicted_cardinalities),
+            self._get_right_cardinality(op, operator_type, self.predicted_cardinalities),
+            self._get_tuple_size(op),
+            self._parse_expressions(op, operator_type),
+            parents,
+            None,
+            None,
+            op,
+        )
+
     def _get_operator_pipelines(self) -> dict[frozenset[int], Pipeline]:
         result = {}
         for pipeline in self.pipelines:
@@ -353,53 +414,25 @@ class QueryPlan:
 
     def fix_union_all(self):
         """
-        union-all pipelines are completely wrong, we need to identify the target pipeline that runs on the resulting
-        data of the union all operator.
-        All operators of this pipline will be appended to all pipelines that end with the union_all operator.
+        see PlanParser._fix_union_all, the target pipelines take no time
         """
-        for op in self.operators.values():
-            if op.type == OperatorType.SetOperation and op.json["operation"] == "unionall":
-                tail_pipeline: Optional[Pipeline] = None
-                for pipeline in self.pipelines:
-                    if len(pipeline.operators) == 0:
-                        continue
-                    if pipeline.operators[0].operator == op:
-                        tail_pipeline = pipeline
-                        break
-                tail_pipeline.start = 0
-                tail_pipeline.stop = 0
-                tail_pipeline.operators[0].stage = OperatorStage.PassThrough
-                union_cardinality = tail_pipeline.operators[0].operator.output_cardinality
-                if union_cardinality < 1:
-                    union_cardinality = 1
-                for pipeline in self.pipelines:
-                    if len(pipeline.operators) == 0:
-                        continue
-                    if pipeline.operators[-1].operator == op:
-                        fraction = pipeline.operators[-2].operator.output_cardinality / union_cardinality
-                        # assert pipeline.operators[-1].stage == OperatorStage.PassThrough
-                        pipeline.operators[-1].stage = OperatorStage.PassThrough
-                        append_ops = [op.copy() for op in tail_pipeline.operators[1:]]
-                        for append_op in append_ops:
-                            append_op.fraction *= fraction
-                            append_op.pipeline = pipeline
-                        pipeline.operators += append_ops
-                tail_pipeline.operators = []
-                # return
+        pipelines = [pipeline.operators for pipeline in self.pipelines]
+        for tail in self._fix_union_all(pipelines, self._copy_phase):
+            self.pipelines[tail].start = 0
+            self.pipelines[tail].stop = 0
+
+    def _copy_phase(self, phase: ExecutionPhase, fraction: float, pipeline: int) -> ExecutionPhase:
+        return ExecutionPhase(phase.operator, phase.stage, self.pipelines[pipeline], phase.fraction * fraction)
 
     def build_pipelines(self, pipelines: list[dict]):
         """
         build pipelines using only the json plan
         """
-        operator_dict: dict[int, Operator] = {op.json["analyzePlanId"]: op for op in self.operators.values()}
-        result = []
-        for pipeline in pipelines:
-            if pipeline["operators"] == [0] and 0 not in operator_dict and pipeline["duration"] == 0:
-                assert False, "could not assign operators to pipelines"
-            ops = [operator_dict[op_id] for op_id in pipeline["operators"]]
-            ops.sort(key=cmp_to_key(lambda b, a: a.precedes(b)))
-            start = float(pipeline["start"])
-            stop = float(pipeline["stop"])
-            result.append(build_pipeline(ops, start, stop))
-        self.pipelines = result
+        self.pipelines = [
+            build_pipeline(ops, float(pipeline["start"]), float(pipeline["stop"]))
+            for ops, pipeline in zip(self._get_pipeline_operators(pipelines), pipelines)
+        ]
         self.fix_union_all()
+        # the operators of the pipelines are final now
+        for pipeline in self.pipelines:
+            pipeline.index_operators()
@@ -0,0 +1 @@
+# Resident prediction server that keeps the model and schemata warm.
@@ -0,0 +1,179 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from src.features import FeatureMapper
+from src.model import Model, get_model_hash
+
+# total estimate and pipeline estimates of a query
+CachedPrediction = tuple[float, list[float]]
+
+
+def round_significant(values: np.ndarray, digits: int) -> np.ndarray:
+    """
+    round to the given number of significant digits, so plans that only differ in noise of their cardinalities share
+    a cache entry
+    """
+    values = np.asarray(values, dtype=np.float64)
+    magnitude = np.floor(np.log10(np.abs(values), out=np.zeros_like(values), where=values != 0))
+    scale = np.power(10.0, digits - 1 - magnitude)
+    return np.round(values * scale) / scale
+
+
+def get_prediction_key(x: np.ndarray, scan_sizes, significant_digits: Optional[int] = None) -> bytes:
+    """
+    canonical fingerprint of the pipeline feature matrix and the scan sizes of a query
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    scan_sizes = np.ascontiguousarray(scan_sizes, dtype=np.float64)
+    if significant_digits is not None:
+        x = round_significant(x, significant_digits)
+        scan_sizes = round_significant(scan_sizes, significant_digits)
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(np.array(x.shape, dtype=np.int64).tobytes())
+    fingerprint.update(x.tobytes())
+    fingerprint.update(scan_sizes.tobytes())
+    return fingerprint.digest()
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of query predictions with an optional time to live.
+    Entries belong to one model version, the first lookup with a different version drops all of them.
+    """
+
+    def __init__(
+        self, max_entries: int = 100_000, ttl: Optional[float] = None, significant_digits: Optional[int] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl  # in seconds
+        self.significant_digits = significant_digits
+        self.version: Optional[str] = None
+        self._entries: OrderedDict[bytes, tuple[float, CachedPrediction]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_key(self, x: np.ndarray, scan_sizes) -> bytes:
+        return get_prediction_key(x, scan_sizes, self.significant_digits)
+
+    def _check_version(self, version: str):
+        if version != self.version:
+            if self.version is not None:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+
+    def get(self, version: str, key: bytes) -> Optional[CachedPrediction]:
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            inserted, prediction = entry
+            if self.ttl is not None and time.monotonic() - inserted > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prediction
+
+    def put(self, version: str, key: bytes, prediction: CachedPrediction):
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (time.monotonic(), prediction)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+class CachedModel(Model):
+    """
+    Puts a PredictionCache in front of a model. The cache is keyed by the model hash, so replacing the booster of the
+    wrapped model or training it further in place invalidates all cached predictions.
+    """
+
+    def __init__(self, model: Model, cache: PredictionCache):
+        self.model = model
+        self.cache = cache
+        self._tree = model.tree
+        self._iteration = model.tree.current_iteration()
+        self.version = get_model_hash(model.tree)
+
+    @property
+    def tree(self):
+        return self.model.tree
+
+    def _get_version(self) -> str:
+        # hashing the model takes milliseconds, it is only hashed again when the booster was replaced or boosted (or
+        # rolled back) in place, which changes its iteration
+        tree = self.model.tree
+        if tree is not self._tree or tree.current_iteration() != self._iteration:
+            self._tree = tree
+            self._iteration = tree.current_iteration()
+            self.version = get_model_hash(tree)
+        return self.version
+
+    def _get_key(self, query: "BenchmarkedQuery") -> bytes:
+        x = query.get_feature_matrix(self.get_feature_mapper())
+        return self.cache.get_key(x, FeatureMapper.get_pipeline_scan_sizes(query.query_plan))
+
+    def estimate_runtime(self, query: "BenchmarkedQuery") -> float:
+        return sum(self.estimate_pipeline_runtime(query))
+
+    def estimate_pipeline_runtime(self, query: "BenchmarkedQuery") -> list[float]:
+        version = self._get_version()
+        key = self._get_key(query)
+        prediction = self.cache.get(version, key)
+        if prediction is None:
+            pipelines = [float(e) for e in self.model.estimate_pipeline_runtime(query)]
+            prediction = (sum(pipelines), pipelines)
+            self.cache.put(version, key, prediction)
+        return list(prediction[1])
+
+    def estimate_batch(self, queries: list["BenchmarkedQuery"]) -> tuple[np.ndarray, list[np.ndarray]]:
+        """
+        only the queries without a cached prediction are estimated, together in one batch
+        """
+        version = self._get_version()
+        keys = [self._get_key(q) for q in queries]
+        predictions = [self.cache.get(version, key) for key in keys]
+        missing = [i for i, p in enumerate(predictions) if p is None]
+        if len(missing) > 0:
+            totals, pipelines = self.model.estimate_batch([queries[i] for i in missing])
+            for i, total, pipeline in zip(missing, totals, pipelines):
+                predictions[i] = (float(total), pipeline.tolist())
+                self.cache.put(version, keys[i], predictions[i])
+        totals = np.array([p[0] for p in predictions], dtype=np.float64)
+        return totals, [np.array(p[1], dtype=np.float64) for p in predictions]
+
+    def get_feature_mapper(self) -> FeatureMapper:
+        return self.model.get_feature_mapper()
@@ -0,0 +1,55 @@
+import time
+from collections import deque
+
+import numpy as np
+
+
+class PredictionMetrics:
+    """
+    Latency and throughput statistics of the prediction server, the percentiles cover the most recent requests
+    """
+
+    def __init__(self, window: int = 10_000):
+        self.start = time.perf_counter()
+        self.latencies: deque[float] = deque(maxlen=window)  # in seconds
+        self.request_times: deque[float] = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_batches = 0
+        self.n_batched_queries = 0
+
+    def record_request(self, latency: float, error: bool = False):
+        self.n_requests += 1
+        if error:
+            self.n_errors += 1
+        self.latencies.append(latency)
+        self.request_times.append(time.perf_counter())
+
+    def record_batch(self, size: int):
+        self.n_batches += 1
+        self.n_batched_queries += size
+
+    def report(self) -> dict:
+        now = time.perf_counter()
+        uptime = now - self.start
+        result = {
+            "uptime_s": uptime,
+            "requests": self.n_requests,
+            "errors": self.n_errors,
+            "batches": self.n_batches,
+            "avg_batch_size": self.n_batched_queries / self.n_batches if self.n_batches > 0 else 0.0,
+            "throughput_rps": self.n_requests / uptime if uptime > 0 else 0.0,
+        }
+        if len(self.request_times) > 1 and now > self.request_times[0]:
+            result["recent_throughput_rps"] = len(self.request_times) / (now - self.request_times[0])
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies) * 1000
+            result["latency_ms"] = {
+                "p50": float(np.quantile(latencies, 0.5)),
+                "p90": float(np.quantile(latencies, 0.9)),
+                "p99": float(np.quantile(latencies, 0.99)),
+                "p999": float(np.quantile(latencies, 0.999)),
+                "max": float(np.max(latencies)),
+                "avg": float(np.average(latencies)),
+            }
+        return result
@@ -0,0 +1,56 @@
+import copy
+
+from src.database import Database
+from src.memo_cache import memo_cache
+from src.optimizer import BenchmarkedQuery, QueryCategory
+from src.query_plan import QueryPlan
+
+
+def get_plan_wrapper(plan: dict) -> dict:
+    """
+    accepts a benchmark file, an optimizer step of planVerboseAnalyze or the plan wrapper itself
+    and returns the wrapper containing "plan", "ius" and "analyzePlanPipelines"
+    """
+    while "analyzePlanPipelines" not in plan:
+        plan = plan["plan"]
+    return plan
+
+
+# same fallback as predict_from_pg, scan nodes carry their own cardinality
+PG_FALLBACK_TABLE_SIZE = 1_000_000
+
+
+@memo_cache(max_entries=64)
+def get_pg_database(db: Database) -> Database:
+    """
+    the database with PG_FALLBACK_TABLE_SIZE for every table without a size, a copy if any size is missing
+    the schemata of DatabaseManager are shared by all requests and are not modified
+    """
+    if all(table.size is not None for table in db.schema.tables.values()):
+        return db
+    result = copy.deepcopy(db)
+    for table in result.schema.tables.values():
+        if table.size is None:
+            table.size = PG_FALLBACK_TABLE_SIZE
+    return result
+
+
+def umbra_plan_to_query(plan: dict, db: Database, predicted_cardinalities: bool, name: str = "") -> BenchmarkedQuery:
+    plan_wrapper = get_plan_wrapper(plan)
+    query_plan = QueryPlan(plan_wrapper, db, predicted_cardinalities)
+    query_plan.build_pipelines(plan_wrapper["analyzePlanPipelines"])
+    return BenchmarkedQuery(query_plan, [0.0], name, "", QueryCategory.fixed)
+
+
+def pg_plan_to_query(
+    pg_data: dict | list, db: Database, predicted_cardinalities: bool, name: str = ""
+) -> BenchmarkedQuery:
+    """
+    requires the postgres patches (src.postgres.pg_patches) to be applied
+    """
+    from src.postgres.pg_to_umbra import pg_explain_to_umbra
+
+    converted = pg_explain_to_umbra(pg_data, use_actual_card=not predicted_cardinalities)
+    query_plan = QueryPlan(converted, get_pg_database(db), predicted_cardinalities)
+    query_plan.build_pipelines(converted["analyzePlanPipelines"])
+    return BenchmarkedQuery(query_plan, [0.0], name, "", QueryCategory.fixed)
@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import lightgbm as lgb
+
+from src.feature_layout import FeatureLayoutMismatch, check_feature_layout, load_model, save_model
+from src.features import get_feature_signature
+from src.model import (
+    PerTupleTreeModel,
+    build_per_tuple_tree_model,
+    get_model_hash,
+    get_quantile_model_path,
+    load_quantile_models,
+)
+
+MODEL_REGISTRY_PATH = Path("model_registry")
+
+
+@dataclass(frozen=True)
+class RegisteredModel:
+    version: str
+    model: PerTupleTreeModel
+
+
+class ModelRegistry:
+    """
+    Stores boosters by content hash together with their feature signature.
+    The active model is replaced by a single reference assignment, predictions that already picked up the previous
+    model finish with it.
+    """
+
+    def __init__(self, path: Path = MODEL_REGISTRY_PATH, backend: str = "lightgbm"):
+        self.path = path
+        self.backend = backend
+        self.active: Optional[RegisteredModel] = None
+        self._lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._index_file = self.path / "index.json"
+        self._index: dict[str, dict] = {}
+        if self._index_file.exists():
+            with open(self._index_file, "r") as fd:
+                self._index = json.load(fd)
+
+    def _write_index(self):
+        tmp_file = self._index_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as fd:
+            json.dump(self._index, fd, indent=2)
+        os.replace(tmp_file, self._index_file)
+
+    def _get_model_file(self, version: str) -> Path:
+        return self.path / f"{version}.txt"
+
+    def get_versions(self) -> dict[str, dict]:
+        return dict(self._index)
+
+    def _save_booster(self, booster: lgb.Booster, model_file: Path):
+        tmp_file = model_file.with_suffix(".tmp")
+        save_model(booster, tmp_file)
+        os.replace(tmp_file, model_file)
+
+    def register_booster(
+        self, booster: lgb.Booster, source: str = "", quantile_boosters: Optional[dict[float, lgb.Booster]] = None
+    ) -> str:
+        """
+        quantile boosters are stored next to the version (see get_quantile_model_path) and attached to its model on
+        activation, registering a known version with quantile boosters replaces its quantile boosters
+        """
+        check_feature_layout(booster)
+        for quantile_booster in (quantile_boosters or {}).values():
+            check_feature_layout(quantile_booster)
+        version = get_model_hash(booster)
+        with self._lock:
+            model_file = self._get_model_file(version)
+            if version not in self._index:
+                self._save_booster(booster, model_file)
+                self._index[version] = {
+                    "features": get_feature_signature(booster.feature_name()),
+                    "source": source,
+                    "registered": time.time(),
+                }
+            elif not quantile_boosters:
+                return version
+            if quantile_boosters:
+                for quantile, quantile_booster in quantile_boosters.items():
+                    self._save_booster(quantile_booster, get_quantile_model_path(model_file, quantile))
+                self._index[version]["quantiles"] = sorted(quantile_boosters)
+            self._write_index()
+        return version
+
+    def register_file(self, model_file: Path) -> str:
+        return self.register_booster(load_model(model_file), str(model_file), self._load_quantile_boosters(model_file))
+
+    @staticmethod
+    def _load_quantile_boosters(model_file: Path) -> dict[float, lgb.Booster]:
+        """
+        the quantile boosters saved next to a model file by training (model_q90.txt next to model.txt)
+        """
+        result = {}
+        for quantile_file in model_file.parent.glob(f"{model_file.stem}_q*{model_file.suffix}"):
+            percentile = quantile_file.stem[len(model_file.stem) + 2 :]
+            if percentile.isdigit() and 0 < int(percentile) < 100:
+                result[int(percentile) / 100] = load_model(quantile_file)
+        return result
+
+    def _build_model(self, version: str, booster: lgb.Booster) -> PerTupleTreeModel:
+        model = build_per_tuple_tree_model(booster, self.backend)
+        quantiles = self._index.get(version, {}).get("quantiles", [])
+        return load_quantile_models(model, self._get_model_file(version), quantiles, self.backend)
+
+    def _activate_booster(self, version: str, booster: lgb.Booster) -> RegisteredModel:
+        # build (and compile) the new model before swapping so the active model never blocks
+        registered = RegisteredModel(version, self._build_model(version, booster))
+        with self._lock:
+            self.active = registered
+        return registered
+
+    def activate(self, version: str) -> RegisteredModel:
+        if version not in self._index:
+            raise KeyError(f"unknown model version {version}")
+        booster = load_model(self._get_model_file(version))
+        return self._activate_booster(version, booster)
+
+    def load_and_activate(self, model_file: Path) -> RegisteredModel:
+        booster = load_model(model_file)
+        version = self.register_booster(booster, str(model_file), self._load_quantile_boosters(model_file))
+        return self._activate_booster(version, booster)
@@ -0,0 +1,466 @@
+"""
+Resident T3 prediction server.
+
+Keeps the booster, the database schemata and the feature layout warm and answers prediction requests over HTTP
+(TCP or Unix socket). Requests arriving within a short window are estimated together in one batched prediction.
+Models are kept in a registry by content hash and can be swapped without restarting the server.
+Predictions of recurring plans can be answered from an LRU cache (--cache-size), which is bound to the active model.
+Featurized scan predicates are memoized by shape, --expression-cache shares them with other processes on disk.
+Estimates can be explained by per feature and per operator contributions, inline ("explain": true) or for a sampled
+fraction of all predictions (--explain-rate) that is kept for GET /explanations.
+
+Usage (from T3 project root):
+  python -m src.serving.server --model model.txt --port 8090
+  python -m src.serving.server --model model_pg.txt --postgres --unix /tmp/t3.sock
+  python -m src.serving.server --model model.txt --watch  # reload model.txt whenever it is rewritten
+  python -m src.serving.server --model model.txt --cache-size 100000 --cache-ttl 600 --cache-digits 3
+  python -m src.serving.server --model model.txt --expression-cache data/expression_cache.sqlite
+  python -m src.serving.server --model model.txt --explain-rate 0.01
+
+Endpoints:
+  POST /predict  {"db": "tpchSf1", "plan": <plan json>, "format": "umbra" | "postgres", "predicted_cardinalities": false}
+                 -> {"total": seconds, "pipelines": [seconds, ...], "model": version}
+                 with "explain": true the response has an "explanation" (QueryExplanation.to_dict)
+  GET  /explanations  the most recent sampled explanations (--explain-rate)
+  GET  /metrics  latency percentiles, throughput, batching and cache statistics
+  GET  /models   registered model versions and the active one
+  POST /models   {"path": "model.txt"} registers and activates a model file
+  POST /models/activate  {"version": hash} activates a registered model (e.g. rollback)
+  GET  /health
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+
+import lightgbm as lgb
+
+from src.database_manager import DatabaseManager
+from src.expression_cache import EXPRESSION_CACHE_PATH, ExpressionCache, get_expression_cache, set_expression_cache
+from src.features import FeatureMapper
+from src.json_decoding import JsonDecoder
+from src.model import PER_TUPLE_BACKENDS
+from src.optimizer import BenchmarkedQuery
+from src.serving.cache import PredictionCache
+from src.serving.metrics import PredictionMetrics
+from src.serving.plans import umbra_plan_to_query, pg_plan_to_query
+from src.serving.registry import ModelRegistry, FeatureLayoutMismatch, MODEL_REGISTRY_PATH, RegisteredModel
+
+
+class BadRequest(Exception):
+    pass
+
+
+class MicroBatcher:
+    """
+    Collects queries for at most `window` seconds (or until `max_batch_size` queries are waiting)
+    and estimates them with a single call to Model.estimate_batch
+    """
+
+    def __init__(self, server: "PredictionServer", window: float, max_batch_size: int):
+        self.server = server
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queue: asyncio.Queue[tuple[BenchmarkedQuery, asyncio.Future]] = asyncio.Queue()
+        # featurizing and predicting a batch takes milliseconds, on the event loop it would stall all other connections
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="t3-batch")
+
+    async def submit(self, query: BenchmarkedQuery) -> tuple[float, list[float], str]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, future))
+        return await future
+
+    async def _collect(self) -> list[tuple[BenchmarkedQuery, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @staticmethod
+    def _estimate_each(
+        active: RegisteredModel, queries: list[BenchmarkedQuery]
+    ) -> list[Union[tuple[float, list[float]], Exception]]:
+        """
+        estimate the queries one at a time, a query that cannot be estimated gets its exception
+        """
+        result = []
+        for query in queries:
+            try:
+                totals, pipelines = active.model.estimate_batch([query])
+                result.append((float(totals[0]), pipelines[0].tolist()))
+            except Exception as e:
+                result.append(e)
+        return result
+
+    def _estimate(
+        self, queries: list[BenchmarkedQuery]
+    ) -> tuple[list[Union[tuple[float, list[float]], Exception]], str]:
+        """
+        runs on the batch thread, the futures are resolved on the event loop
+        if the batch fails, its queries are estimated one at a time so only the requests whose query fails get an error
+        """
+        # the whole batch uses the model that is active now, even if a reload swaps it meanwhile
+        active = self.server.registry.active
+        try:
+            totals, pipelines = active.model.estimate_batch(queries)
+            results = [(float(total), pipeline.tolist()) for total, pipeline in zip(totals, pipelines)]
+        except Exception:
+            if len(queries) == 1:
+                raise
+            results = self._estimate_each(active, queries)
+        if self.server.explain_rate > 0:
+            estimated = [q for q, r in zip(queries, results) if not isinstance(r, Exception)]
+            self.server.sample_explanations(estimated, active)
+        return results, active.version
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            self.server.metrics.record_batch(len(batch))
+            # queries arriving meanwhile are collected into the next batch
+            try:
+                results, version = await loop.run_in_executor(self._pool, self._estimate, [q for q, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result((*result, version))
+
+
+class PredictionServer:
+    def __init__(
+        self,
+        registry: ModelRegistry,
+        batch_window: float = 0.001,
+        max_batch_size: int = 256,
+        postgres: bool = False,
+        cache: Optional[PredictionCache] = None,
+        explain_rate: float = 0.0,
+        max_explanations: int = 1000,
+    ):
+        assert registry.active is not None, "activate a model before starting the server"
+        self.registry = registry
+        self.postgres = postgres
+        self.metrics = PredictionMetrics()
+        self.cache = cache
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._batcher: Optional[MicroBatcher] = None
+        # plans are most of the request body, orjson or msgspec decode them faster when they are installed
+        self.json_decoder = JsonDecoder()
+        # fraction of the batched predictions that is explained after the fact. pred_contrib costs about 80 times a
+        # prediction, so the sampled queries of a batch are explained together on a separate thread and samples are
+        # skipped while the previous ones are still being explained
+        self.explain_rate = explain_rate
+        self.explanations: deque[dict] = deque(maxlen=max_explanations)
+        self.n_explained = 0
+        self.n_explain_skipped = 0
+        self._explain_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="t3-explain")
+        self._explain_future: Optional[Future] = None
+        # parse all schemata once at startup instead of per request
+        DatabaseManager.get_all_databases()
+
+    def parse_query(self, request: dict) -> BenchmarkedQuery:
+        if "plan" not in request:
+            raise BadRequest("missing plan")
+        plan_format = request.get("format", "umbra")
+        try:
+            db = DatabaseManager.get_database(request.get("db", "job" if plan_format == "postgres" else "tpchSf1"))
+        except KeyError as e:
+            raise BadRequest(f"unknown database {e}")
+        predicted_cardinalities = bool(request.get("predicted_cardinalities", False))
+        name = request.get("name", "")
+        if plan_format == "umbra":
+            return umbra_plan_to_query(request["plan"], db, predicted_cardinalities, name)
+        elif plan_format == "postgres":
+            if not self.postgres:
+                raise BadRequest("server was not started with --postgres")
+            return pg_plan_to_query(request["plan"], db, predicted_cardinalities, name)
+        raise BadRequest(f"unknown plan format {plan_format}")
+
+    def explain(self, queries: list[BenchmarkedQuery], active: RegisteredModel) -> list[dict]:
+        return [{"model": active.version, **explanation.to_dict()} for explanation in active.model.explain(queries)]
+
+    def _explain_sampled(self, queries: list[BenchmarkedQuery], active: RegisteredModel):
+        try:
+            self.explanations.extend(self.explain(queries, active))
+        except Exception as e:
+            # the estimates are already answered, a failing explanation must not affect them
+            print(f"Could not explain sampled predictions: {e!r}")
+            return
+        self.n_explained += len(queries)
+
+    def sample_explanations(self, queries: list[BenchmarkedQuery], active: RegisteredModel):
+        sampled = [q for q in queries if random.random() < self.explain_rate]
+        if len(sampled) == 0:
+            return
+        if self._explain_future is not None and not self._explain_future.done():
+            self.n_explain_skipped += len(sampled)
+            return
+        self._explain_future = self._explain_pool.submit(self._explain_sampled, sampled, active)
+
+    def get_cache_key(self, query: BenchmarkedQuery, active: RegisteredModel) -> bytes:
+        return self.cache.get_key(
+            query.get_feature_matrix(active.model.get_feature_mapper()),
+            FeatureMapper.get_pipeline_scan_sizes(query.query_plan),
+        )
+
+    async def predict(self, body: bytes) -> dict:
+        try:
+            request = self.json_decoder.loads(body)
+        except self.json_decoder.errors as e:
+            raise BadRequest(f"invalid json: {e}")
+        if not isinstance(request, dict):
+            raise BadRequest("request must be a json object")
+        try:
+            query = self.parse_query(request)
+        except BadRequest:
+            raise
+        except (KeyError, AssertionError, TypeError, ValueError) as e:
+            raise BadRequest(f"could not parse plan: {e!r}")
+        if request.get("explain", False):
+            # explanations are computed for this request alone, outside the batcher and the cache
+            active = self.registry.active
+            (explanation,) = await asyncio.get_running_loop().run_in_executor(None, self.explain, [query], active)
+            total = explanation["estimate"]
+            pipelines = [p["estimate"] for p in explanation["pipelines"]]
+            return {"total": total, "pipelines": pipelines, "model": active.version, "explanation": explanation}
+        if self.cache is None:
+            total, pipelines, version = await self._batcher.submit(query)
+            return {"total": total, "pipelines": pipelines, "model": version}
+        active = self.registry.active
+        # the key needs the features of the query, they are computed next to the event loop like a batch
+        key = await asyncio.get_running_loop().run_in_executor(None, self.get_cache_key, query, active)
+        cached = self.cache.get(active.version, key)
+        if cached is not None:
+            total, pipelines = cached
+            return {"total": total, "pipelines": pipelines, "model": active.version, "cached": True}
+        total, pipelines, version = await self._batcher.submit(query)
+        self.cache.put(version, key, (total, pipelines))
+        return {"total": total, "pipelines": pipelines, "model": version}
+
+    async def reload(self, model_file: Path) -> str:
+        """
+        parsing and compiling a booster takes seconds, so it runs next to the event loop
+        """
+        loop = asyncio.get_running_loop()
+        registered = await loop.run_in_executor(None, self.registry.load_and_activate, model_file)
+        print(f"Activated model {registered.version} from {model_file}")
+        return registered.version
+
+    async def manage_models(self, path: str, body: bytes) -> dict:
+        try:
+            request = json.loads(body)
+        except json.JSONDecodeError as e:
+            raise BadRequest(f"invalid json: {e}")
+        loop = asyncio.get_running_loop()
+        try:
+            if path == "/models":
+                version = await self.reload(Path(request["path"]))
+            else:
+                version = (await loop.run_in_executor(None, self.registry.activate, request["version"])).version
+        except (KeyError, FeatureLayoutMismatch, lgb.basic.LightGBMError) as e:
+            raise BadRequest(str(e))
+        return {"active": version}
+
+    async def watch(self, model_file: Path, interval: float):
+        """
+        reload the model whenever the file is rewritten (e.g. by optimize_all)
+        """
+        last_mtime = model_file.stat().st_mtime
+        while True:
+            await asyncio.sleep(interval)
+            if not model_file.exists() or model_file.stat().st_mtime == last_mtime:
+                continue
+            mtime = model_file.stat().st_mtime
+            try:
+                await self.reload(model_file)
+            except lgb.basic.LightGBMError as e:
+                # the file might still be written, retry on the next poll
+                print(f"Could not load {model_file}: {e}")
+                continue
+            except FeatureLayoutMismatch as e:
+                print(f"Rejected {model_file}: {e}")
+            last_mtime = mtime
+
+    async def route(self, method: str, path: str, body: bytes) -> tuple[str, dict]:
+        if method == "POST" and path == "/predict":
+            start = time.perf_counter()
+            try:
+                result = await self.predict(body)
+            except BadRequest as e:
+                self.metrics.record_request(time.perf_counter() - start, error=True)
+                return "400 Bad Request", {"error": str(e)}
+            except Exception as e:
+                self.metrics.record_request(time.perf_counter() - start, error=True)
+                return "500 Internal Server Error", {"error": repr(e)}
+            self.metrics.record_request(time.perf_counter() - start)
+            return "200 OK", result
+        elif method == "GET" and path == "/metrics":
+            report = self.metrics.report()
+            if self.cache is not None:
+                report["cache"] = self.cache.stats()
+            if get_expression_cache() is not None:
+                report["expression_cache"] = get_expression_cache().stats()
+            if self.explain_rate > 0:
+                report["explanations"] = {
+                    "rate": self.explain_rate,
+                    "explained": self.n_explained,
+                    "skipped": self.n_explain_skipped,
+                }
+            return "200 OK", report
+        elif method == "GET" and path == "/explanations":
+            return "200 OK", {"rate": self.explain_rate, "explanations": list(self.explanations)}
+        elif method == "GET" and path == "/models":
+            return "200 OK", {"active": self.registry.active.version, "versions": self.registry.get_versions()}
+        elif method == "POST" and path in ("/models", "/models/activate"):
+            try:
+                return "200 OK", await self.manage_models(path, body)
+            except BadRequest as e:
+                return "400 Bad Request", {"error": str(e)}
+        elif method == "GET" and path == "/health":
+            return "200 OK", {"status": "ok"}
+        return "404 Not Found", {"error": f"no route for {method} {path}"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self.route(method, path, body)
+                payload = json.dumps(response).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8090,
+        unix_socket: Optional[Path] = None,
+        watch_file: Optional[Path] = None,
+        watch_interval: float = 5.0,
+    ):
+        self._batcher = MicroBatcher(self, self.batch_window, self.max_batch_size)
+        tasks = [asyncio.create_task(self._batcher.run())]
+        if watch_file is not None:
+            tasks.append(asyncio.create_task(self.watch(watch_file, watch_interval)))
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=str(unix_socket))
+            print(f"Serving predictions on {unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f"Serving predictions on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Resident T3 prediction server")
+    parser.add_argument("--model", type=Path, default=Path("model.txt"), help="Path to T3 model (default: model.txt)")
+    parser.add_argument(
+        "--backend", choices=PER_TUPLE_BACKENDS, default="lightgbm", help="Tree evaluation backend (default: lightgbm)"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--unix", type=Path, metavar="PATH", help="Serve on a Unix socket instead of TCP")
+    parser.add_argument(
+        "--batch-window-ms", type=float, default=1.0, help="Time to wait for further requests of a batch (default: 1)"
+    )
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--postgres", action="store_true", help="Accept PostgreSQL EXPLAIN plans (applies pg patches)")
+    parser.add_argument("--registry", type=Path, default=MODEL_REGISTRY_PATH, help="Directory of registered models")
+    parser.add_argument("--watch", action="store_true", help="Reload the model file whenever it changes")
+    parser.add_argument("--watch-interval", type=float, default=5.0, help="Seconds between checks of the model file")
+    parser.add_argument("--cache-size", type=int, default=0, help="Cached query predictions, 0 disables the cache")
+    parser.add_argument("--cache-ttl", type=float, help="Seconds a cached prediction stays valid (default: forever)")
+    parser.add_argument(
+        "--cache-digits", type=int, help="Round features and scan sizes to this many significant digits for the key"
+    )
+    parser.add_argument(
+        "--expression-cache",
+        type=Path,
+        nargs="?",
+        const=EXPRESSION_CACHE_PATH,
+        metavar="PATH",
+        help=f"Persistent expression cache shared with other processes (default path: {EXPRESSION_CACHE_PATH})",
+    )
+    parser.add_argument(
+        "--explain-rate", type=float, default=0.0, help="Fraction of the predictions to explain (default: 0, e.g. 0.01)"
+    )
+    parser.add_argument("--max-explanations", type=int, default=1000, help="Sampled explanations kept in memory")
+    args = parser.parse_args()
+
+    if args.expression_cache is not None:
+        set_expression_cache(ExpressionCache(path=args.expression_cache))
+    if args.postgres:
+        from src.postgres import pg_patches
+
+        pg_patches.apply_patches()
+
+    registry = ModelRegistry(args.registry, backend=args.backend)
+    registry.load_and_activate(args.model)
+    server = PredictionServer(
+        registry,
+        batch_window=args.batch_window_ms / 1000,
+        max_batch_size=args.max_batch_size,
+        postgres=args.postgres,
+        cache=PredictionCache(args.cache_size, args.cache_ttl, args.cache_digits) if args.cache_size > 0 else None,
+        explain_rate=args.explain_rate,
+        max_explanations=args.max_explanations,
+    )
+    asyncio.run(server.serve(args.host, args.port, args.unix, args.model if args.watch else None, args.watch_interval))
+
+
+if __name__ == "__main__":
+    main()
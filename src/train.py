@@ -1,10 +1,23 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
 from src.data_collection import DataCollector
 from src.database_manager import DatabaseManager
-from src.model import Model
-from src.optimizer import optimize_per_tuple_tree_model
+from src.model import Model, PerTupleTreeModel, get_model_hash
+from src.feature_store import FeatureStore
+from src.optimizer import (
+    BenchmarkedQuery,
+    optimize_per_tuple_tree_model,
+    refresh_per_tuple_tree_model,
+    train_per_tuple_tree_model,
+)
 
 
-def optimize_all(predicted_cardinalities: bool = False) -> Model:
+def optimize_all(
+    predicted_cardinalities: bool = False, use_feature_store: bool = False, feature_dtype: np.dtype = np.float64
+) -> Model:
     excluded_from_train = [
         # QueryCategory.fixed,
         # QueryCategory.select,
@@ -22,7 +35,38 @@ def optimize_all(predicted_cardinalities: bool = False) -> Model:
         # QueryCategory.complex_select_join_agg,
         # QueryCategory.complex_select_join_simple_agg,
     ]
+    if use_feature_store:
+        # the featurized benchmarks are stored under data/feature_cache, later runs do not parse any plan
+        # a float32 store halves the memory of the training matrix
+        x, y = FeatureStore(dtype=feature_dtype).get_per_tuple_training_data(
+            DatabaseManager.get_train_databases(), predicted_cardinalities, exclude_query_category=excluded_from_train
+        )
+        return train_per_tuple_tree_model(x, y)
     benchmarks = DataCollector.collect_benchmarks(
         DatabaseManager.get_train_databases(), predicted_cardinalities, exclude_query_category=excluded_from_train
     )
     return optimize_per_tuple_tree_model(benchmarks)
+
+
+def refresh_model(
+    model: PerTupleTreeModel,
+    new_benchmarks: list[BenchmarkedQuery],
+    replay_benchmarks: Optional[list[BenchmarkedQuery]] = None,
+    registry_path: Optional[Path] = None,
+    rounds: int = 50,
+) -> tuple[PerTupleTreeModel, str]:
+    """
+    adapt the model to new benchmark results (e.g. after a hardware change) and store it as a new model version
+    the refreshed quantile boosters are stored with the version and attached to its model when it is activated
+    registry_path defaults to MODEL_REGISTRY_PATH
+    """
+    # the registry pulls in the serving stack and lightgbm, importing src.train does not need them
+    from src.serving.registry import ModelRegistry, MODEL_REGISTRY_PATH
+
+    refreshed = refresh_per_tuple_tree_model(model, new_benchmarks, replay_benchmarks, rounds=rounds)
+    version = ModelRegistry(registry_path or MODEL_REGISTRY_PATH).register_booster(
+        refreshed.tree,
+        f"refresh of {get_model_hash(model.tree)}",
+        {quantile: quantile_model.tree for quantile, quantile_model in refreshed.quantile_models.items()},
+    )
+    return refreshed, version
@@ -1,3 +1,5 @@
+import gc
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
 
@@ -18,27 +20,19 @@ def filter_unique_unhashable(original_list: list) -> list:
     return unique_list
 
 
-def fifo_cache(func):
-    cache = []
-    limit = 100
-
-    def wrapper(*args, **kwargs):
-        nonlocal cache
-        key = (args, frozenset(kwargs.items()))
-
-        for c in cache:
-            if key == c[0]:
-                return c[1]
-
-        result = func(*args, **kwargs)
-        cache.append((key, result))
-        if len(cache) > limit:
-            cache = cache[1:]
-            print(f"Evicting cache for {func.__name__}")
-
-        return result
-
-    return wrapper
+@contextmanager
+def paused_gc():
+    """
+    disable the cyclic garbage collector while building large object graphs (parsed plans), they only contain
+    references that are still alive, but would trigger many full collections that traverse everything built so far
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 
 def get_lines(file: Path) -> list[str]:
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Compare the latency of the tree evaluation backends of PerTupleTreeModel (LightGBM, lleaves, NumPy) across batch sizes.
+
+Pipeline feature vectors are taken from the bundled PostgreSQL JOB plans (src/postgres/pg_explain_job) and repeated
+to fill each batch, so no benchmark data download is needed.
+
+Usage:
+  python -m testing.benchmark_backends
+  python -m testing.benchmark_backends --model model.txt --batch-sizes 1 10 100 --backends lightgbm numpy
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+
+import lightgbm as lgb
+import numpy as np
+from tabulate import tabulate
+
+from src.model import PER_TUPLE_BACKENDS, build_per_tuple_tree_model
+
+
+def load_pipeline_vectors() -> np.ndarray:
+    """Feature vectors of all pipelines of the bundled PG JOB plans."""
+    from src.postgres import pg_patches
+
+    pg_patches.apply_patches()
+
+    from src.database_manager import DatabaseManager
+    from src.features import FeatureMapper
+    from src.serving.plans import pg_plan_to_query
+    from src.postgres.pg_to_umbra import load_pg_json
+    from src.postgres.training import PG_EXPLAIN_JOB_DIR
+
+    db = DatabaseManager.get_database("job")
+    mapper = FeatureMapper()
+    vectors = []
+    for path in sorted(PG_EXPLAIN_JOB_DIR.glob("*.json")):
+        query = pg_plan_to_query(load_pg_json(path), db, False, path.stem)
+        vectors.append(query.get_feature_matrix(mapper))
+    return np.vstack(vectors)
+
+
+def get_batch(vectors: np.ndarray, batch_size: int) -> np.ndarray:
+    indices = np.arange(batch_size) % len(vectors)
+    return np.ascontiguousarray(vectors[indices])
+
+
+def time_call(function, x: np.ndarray, min_time: float) -> float:
+    """Average seconds per call, repeated for at least min_time seconds."""
+    function(x)
+    n = 0
+    start = time.perf_counter()
+    while True:
+        function(x)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / n
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Latency of the tree evaluation backends across batch sizes.")
+    parser.add_argument("--model", type=Path, default=Path("model_pg.txt"), help="Model file (default: model_pg.txt)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 3, 10, 100, 1000, 10000])
+    parser.add_argument("--backends", nargs="+", choices=PER_TUPLE_BACKENDS, default=list(PER_TUPLE_BACKENDS))
+    parser.add_argument("--min-time", type=float, default=0.5, help="Seconds to repeat each measurement")
+    args = parser.parse_args()
+
+    booster = lgb.Booster(model_file=str(args.model))
+    vectors = load_pipeline_vectors()
+    models = {backend: build_per_tuple_tree_model(booster, backend) for backend in args.backends}
+
+    reference = models[args.backends[0]].predict_tree(vectors)
+    for backend, model in models.items():
+        deviation = np.max(np.abs(model.predict_tree(vectors) - reference))
+        print(f"{backend}: max deviation from {args.backends[0]} {deviation:.2e}")
+
+    table = []
+    for batch_size in args.batch_sizes:
+        x = get_batch(vectors, batch_size)
+        row = [batch_size]
+        for model in models.values():
+            latency = time_call(model.predict_tree, x, args.min_time)
+            row.append(f"{latency * 1e6:.1f} ({latency * 1e6 / batch_size:.2f})")
+        table.append(row)
+    headers = ["rows"] + [f"{b} us/call (us/row)" for b in models]
+    print(tabulate(table, headers, tablefmt="github"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Load time of the benchmark corpus (data/<db>/**/*.json, or data/archives/<db>.t3pa if the database is packed) against
+the number of loader processes of DataCollector.read_analyzed_plans. Every worker count reads all files of the given
+databases, the speedup is relative to reading them in this process. The parsed queries of every worker count are checked against the serial ones
+(names, runtimes and pipeline feature matrices), exits with 1 if any differ.
+
+Usage:
+  python -m testing.benchmark_corpus_loading
+  python -m testing.benchmark_corpus_loading --dbs tpchSf1 job --workers 1 2 4 8 --chunk-size 32
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from tabulate import tabulate
+
+from src.data_collection import DataCollector
+from src.database import Database
+from src.database_manager import DatabaseManager
+from src.features import FeatureMapper
+from src.optimizer import BenchmarkedQuery
+
+
+def load(
+    sources: list[tuple[Database, list[Path], Optional[Path]]], predicted_cardinalities: bool, n_workers: int
+) -> tuple[list[BenchmarkedQuery], float]:
+    start = time.perf_counter()
+    result = []
+    for db, files, archive in sources:
+        result += DataCollector.read_analyzed_plans(files, db, predicted_cardinalities, n_workers, archive)
+    return result, time.perf_counter() - start
+
+
+def is_identical(a: list[BenchmarkedQuery], b: list[BenchmarkedQuery], mapper: FeatureMapper) -> bool:
+    return len(a) == len(b) and all(
+        x.name == y.name
+        and x.total_runtimes == y.total_runtimes
+        and np.array_equal(
+            mapper.get_pipeline_estimation_matrix(x.query_plan),
+            mapper.get_pipeline_estimation_matrix(y.query_plan),
+            equal_nan=True,
+        )
+        for x, y in zip(a, b)
+    )
+
+
+def main() -> None:
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1 << i for i in range(cores.bit_length()) if 1 << i <= cores} | {cores})
+    parser = argparse.ArgumentParser(description="Load time of the benchmark corpus against the number of processes.")
+    parser.add_argument(
+        "--dbs", nargs="+", help="Databases to load (default: training databases)", default=None, metavar="DB"
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=worker_counts, help="Loader process counts")
+    parser.add_argument("--chunk-size", type=int, default=DataCollector.load_chunk_size, help="Files per task")
+    parser.add_argument("--predicted-cardinalities", action="store_true", help="Use estimated instead of exact cards")
+    args = parser.parse_args()
+
+    dbs = DatabaseManager.get_databases(args.dbs) if args.dbs else DatabaseManager.get_train_databases()
+    sources = [(db, *DataCollector.get_benchmark_files(db)) for db in dbs]
+    n_files = sum(len(files) for _, files, _ in sources)
+    if n_files == 0:
+        print("no benchmark files found, download the benchmark data first")
+        sys.exit(1)
+    DataCollector.load_chunk_size = args.chunk_size
+
+    mapper = FeatureMapper()
+    expected, base = load(sources, args.predicted_cardinalities, 1)
+    table = [[1, f"{base:.2f}", f"{n_files / base:.0f}", "1.00", "yes"]]
+    mismatches = []
+    for n_workers in args.workers:
+        if n_workers <= 1:
+            continue
+        queries, elapsed = load(sources, args.predicted_cardinalities, n_workers)
+        identical = is_identical(expected, queries, mapper)
+        if not identical:
+            mismatches.append(n_workers)
+        table.append(
+            [
+                n_workers,
+                f"{elapsed:.2f}",
+                f"{n_files / elapsed:.0f}",
+                f"{base / elapsed:.2f}",
+                "yes" if identical else "no",
+            ]
+        )
+    print(f"{n_files} files of {len(dbs)} databases, {cores} cores")
+    print(tabulate(table, ["workers", "s", "files/s", "speedup", "identical"], tablefmt="github"))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Time per benchmark file of every available JSON decoder (src/json_decoding.py), with and without projection, on the
+benchmark files in data/ of the given databases. Every decoder must return the same (projected) documents as the json
+module, exits with 1 if any differ.
+
+Usage:
+  python -m testing.benchmark_json_decoding
+  python -m testing.benchmark_json_decoding --dbs tpchSf1 job --limit 1000
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from tabulate import tabulate
+
+from src.database_manager import DatabaseManager
+from src.json_decoding import JsonDecoder, get_available_decoders
+from src.util import paused_gc
+
+
+def decode_all(decoder: JsonDecoder, contents: list[bytes], runs: int) -> tuple[list, float]:
+    """the documents and the fastest of runs decodes, with the garbage collector paused as in DataCollector"""
+    durations = []
+    for _ in range(runs):
+        with paused_gc():
+            start = time.perf_counter()
+            result = [decoder.loads(c) for c in contents]
+            durations.append(time.perf_counter() - start)
+    return result, min(durations)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Decode time of the benchmark files per JSON decoder.")
+    parser.add_argument("--dbs", nargs="+", default=None, metavar="DB", help="Databases (default: training databases)")
+    parser.add_argument("--limit", type=int, default=0, help="Decode at most this many files (default: all)")
+    parser.add_argument("--runs", type=int, default=3, help="Decodes per decoder, the fastest is reported")
+    args = parser.parse_args()
+
+    dbs = DatabaseManager.get_databases(args.dbs) if args.dbs else DatabaseManager.get_train_databases()
+    files = [f for db in dbs for f in sorted(Path(f"data/{db.get_path()}").rglob("*.json"))]
+    if args.limit > 0:
+        files = files[: args.limit]
+    if len(files) == 0:
+        print("no benchmark files found, download the benchmark data first")
+        sys.exit(1)
+    contents = [f.read_bytes() for f in files]
+    megabytes = sum(len(c) for c in contents) / 2**20
+
+    table = []
+    mismatches = []
+    for projection in (False, True):
+        expected, base = decode_all(JsonDecoder("json", projection), contents, args.runs)
+        for name in get_available_decoders():
+            result, elapsed = decode_all(JsonDecoder(name, projection), contents, args.runs)
+            identical = result == expected
+            if not identical:
+                mismatches.append(f"{name} (projection: {projection})")
+            table.append(
+                [
+                    name,
+                    "yes" if projection else "no",
+                    f"{elapsed / len(files) * 1e6:.0f}",
+                    f"{megabytes / elapsed:.0f}",
+                    f"{base / elapsed:.2f}x",
+                    "yes" if identical else "no",
+                ]
+            )
+    print(f"{len(files)} files, {megabytes:.1f} MB")
+    print(tabulate(table, ["decoder", "projection", "us/file", "MB/s", "vs json", "identical"], tablefmt="github"))
+    for mismatch in mismatches:
+        print(f"mismatch: {mismatch}")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Single query latency of PerTupleTreeModel: the low latency predict_pipelines path against the batch predict path
+for queries with a typical number of pipelines.
+
+Usage:
+  python -m testing.benchmark_latency
+  python -m testing.benchmark_latency --model model_pg.txt --pipelines 1 3 10 50 --backends lightgbm lleaves
+"""
+
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+
+import lightgbm as lgb
+import numpy as np
+from tabulate import tabulate
+
+from src.model import PER_TUPLE_BACKENDS, build_per_tuple_tree_model
+from testing.benchmark_backends import load_pipeline_vectors, get_batch, time_call
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Single query latency of the per tuple model prediction paths.")
+    parser.add_argument("--model", type=Path, default=Path("model_pg.txt"), help="Model file (default: model_pg.txt)")
+    parser.add_argument("--pipelines", type=int, nargs="+", default=[1, 3, 10, 50])
+    parser.add_argument("--backends", nargs="+", choices=PER_TUPLE_BACKENDS, default=list(PER_TUPLE_BACKENDS))
+    parser.add_argument("--min-time", type=float, default=0.5, help="Seconds to repeat each measurement")
+    args = parser.parse_args()
+
+    booster = lgb.Booster(model_file=str(args.model))
+    vectors = load_pipeline_vectors()
+    rng = np.random.default_rng(0)
+
+    table = []
+    for backend in args.backends:
+        model = build_per_tuple_tree_model(booster, backend)
+        for n in args.pipelines:
+            x = get_batch(vectors, n)
+            scan_sizes = rng.integers(0, 10_000_000, n).astype(float).tolist()
+            deviation = np.max(
+                np.abs(np.array(model.predict_pipelines(x, scan_sizes)) - model.predict(x, np.array(scan_sizes)))
+            )
+            batch = time_call(lambda v: model.predict(v, np.array(scan_sizes)), x, args.min_time)
+            fast = time_call(lambda v: model.predict_pipelines(v, scan_sizes), x, args.min_time)
+            table.append(
+                [backend, n, f"{batch * 1e6:.1f}", f"{fast * 1e6:.1f}", f"{batch / fast:.2f}", f"{deviation:.1e}"]
+            )
+    headers = ["backend", "pipelines", "predict us", "predict_pipelines us", "speedup", "max deviation"]
+    print(tabulate(table, headers, tablefmt="github"))
+
+
+if __name__ == "__main__":
+    main()
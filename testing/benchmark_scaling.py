@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Scaling of PerTupleTreeModel.predict with the number of pipelines and the number of prediction threads.
+
+The first part mirrors benchmarkModelLatencyScaling of dp/DP.cpp: for every batch size from 1 to --limit pipelines
+the minimum latency in ms over --runs runs with freshly sampled pipelines is written as {"<pipelines>": ms, ...} to
+<out>/latencyScalingPython_<backend>_<threads>T.json. The second part prints the throughput of one large batch
+(--rows pipelines) for 1, 2, 4, ... threads up to the number of cores.
+
+Usage:
+  python -m testing.benchmark_scaling
+  python -m testing.benchmark_scaling --backends lleaves --threads 1 8 --limit 200 --rows 1000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import lightgbm as lgb
+import numpy as np
+from tabulate import tabulate
+
+from src.model import PER_TUPLE_BACKENDS, PerTupleTreeModel, build_per_tuple_tree_model
+from testing.benchmark_backends import load_pipeline_vectors
+
+
+def latency_scaling(
+    model: PerTupleTreeModel, vectors: np.ndarray, n_threads: int, limit: int, runs: int, step: int
+) -> dict[str, float]:
+    rng = np.random.default_rng()
+    result = {}
+    for n_pipelines in range(1, limit + 1, step):
+        durations = []
+        for _ in range(runs):
+            x = np.ascontiguousarray(vectors[rng.integers(0, len(vectors), n_pipelines)])
+            scan_sizes = rng.uniform(0, 1000, n_pipelines)
+            start = time.perf_counter()
+            model.predict(x, scan_sizes, n_threads)
+            durations.append((time.perf_counter() - start) * 1000)
+        result[str(n_pipelines)] = min(durations)
+    return result
+
+
+def thread_scaling(model: PerTupleTreeModel, vectors: np.ndarray, thread_counts: list[int], rows: int) -> list[list]:
+    rng = np.random.default_rng(0)
+    x = np.ascontiguousarray(vectors[rng.integers(0, len(vectors), rows)])
+    scan_sizes = rng.uniform(0, 1000, rows)
+    table = []
+    base = None
+    for n_threads in thread_counts:
+        model.predict(x, scan_sizes, n_threads)
+        start = time.perf_counter()
+        model.predict(x, scan_sizes, n_threads)
+        elapsed = time.perf_counter() - start
+        base = base or elapsed
+        table.append([n_threads, f"{elapsed * 1000:.1f}", f"{rows / elapsed / 1e6:.2f}", f"{base / elapsed:.2f}"])
+    return table
+
+
+def main() -> None:
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Prediction latency and throughput scaling of the per tuple model.")
+    parser.add_argument("--model", type=Path, default=Path("model_pg.txt"), help="Model file (default: model_pg.txt)")
+    parser.add_argument("--backends", nargs="+", choices=PER_TUPLE_BACKENDS, default=list(PER_TUPLE_BACKENDS))
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, cores], help="Thread counts of the latency runs")
+    parser.add_argument("--limit", type=int, default=1000, help="Largest number of pipelines (default: 1000)")
+    parser.add_argument("--step", type=int, default=1, help="Step between pipeline counts (default: 1)")
+    parser.add_argument("--runs", type=int, default=20, help="Runs per pipeline count, the minimum is reported")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Pipelines of the throughput batch")
+    parser.add_argument("--out", type=Path, default=Path("dp"), help="Directory of the latency json files")
+    args = parser.parse_args()
+
+    booster = lgb.Booster(model_file=str(args.model))
+    vectors = load_pipeline_vectors()
+    thread_counts = sorted({1 << i for i in range(cores.bit_length()) if 1 << i <= cores} | {cores})
+    args.out.mkdir(parents=True, exist_ok=True)
+
+    for backend in args.backends:
+        model = build_per_tuple_tree_model(booster, backend)
+        for n_threads in args.threads:
+            out_file = args.out / f"latencyScalingPython_{backend}_{n_threads}T.json"
+            with open(out_file, "w") as fd:
+                json.dump(latency_scaling(model, vectors, n_threads, args.limit, args.runs, args.step), fd)
+            print(f"Wrote {out_file}")
+        print(f"\n{backend}: {args.rows} pipelines")
+        table = thread_scaling(model, vectors, thread_counts, args.rows)
+        print(tabulate(table, ["threads", "ms", "M pipelines/s", "speedup"], tablefmt="github"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Cold start of T3: import time of the entry modules (python -X importtime) and the time to the first prediction of a
+fresh interpreter (imports, loading the model, featurizing one bundled PostgreSQL JOB plan and predicting it).
+
+Every measurement runs in a new interpreter and the minimum over --runs is reported. --save writes the results as
+JSON, --baseline compares against such a file and exits with 1 if a measurement got slower by more than --tolerance.
+
+Usage:
+  python -m testing.benchmark_startup
+  python -m testing.benchmark_startup --runs 5 --save startup.json
+  python -m testing.benchmark_startup --baseline startup.json --tolerance 0.25
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from tabulate import tabulate
+
+REPO = Path(__file__).resolve().parent.parent
+
+MODULES = [
+    "src.features",
+    "src.model",
+    "src.optimizer",
+    "src.train",
+    "src.serving.server",
+    "src.postgres.predict_from_pg",
+]
+
+FIRST_PREDICTION = """
+import json, time
+from pathlib import Path
+start = time.perf_counter()
+from src.postgres import pg_patches
+pg_patches.apply_patches()
+from src.database_manager import DatabaseManager
+from src.feature_layout import load_model
+from src.model import build_per_tuple_tree_model
+from src.postgres.pg_to_umbra import load_pg_json
+from src.serving.plans import pg_plan_to_query
+imported = time.perf_counter()
+model = build_per_tuple_tree_model(load_model(Path({model!r})), {backend!r})
+loaded = time.perf_counter()
+query = pg_plan_to_query(load_pg_json(Path({plan!r})), DatabaseManager.get_database("job"), False, "startup")
+model.estimate_runtime(query)
+predicted = time.perf_counter()
+print(json.dumps({{"import": imported - start, "load model": loaded - imported, "first prediction": predicted - loaded}}))
+"""
+
+
+def parse_importtime(stderr: str) -> list[tuple[int, int, int, str]]:
+    """(depth, self us, cumulative us, module) for every line of the -X importtime output"""
+    result = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        result.append((depth, int(self_us), int(cumulative_us), name.strip()))
+    return result
+
+
+def get_package_import_time(imports: list[tuple[int, int, int, str]], module: str) -> float:
+    """seconds spent importing the package of the module (top level entries of the package and its subpackages)"""
+    root = module.split(".")[0]
+    return sum(c for d, _, c, name in imports if d == 0 and (name == root or name.startswith(root + "."))) / 1e6
+
+
+def run(code: str) -> tuple[float, str, str]:
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], cwd=REPO, capture_output=True, text=True, check=True
+    )
+    return time.perf_counter() - start, process.stdout, process.stderr
+
+
+def measure_import(module: str, runs: int) -> float:
+    return min(get_package_import_time(parse_importtime(run(f"import {module}")[2]), module) for _ in range(runs))
+
+
+def measure_first_prediction(model: Path, backend: str, plan: Path, runs: int) -> tuple[dict[str, float], list]:
+    code = FIRST_PREDICTION.format(model=str(model), backend=backend, plan=str(plan))
+    best = None
+    for _ in range(runs):
+        wall, stdout, stderr = run(code)
+        phases = json.loads(stdout.strip().splitlines()[-1])
+        phases["process"] = wall
+        if best is None or wall < best[0]["process"]:
+            best = (phases, parse_importtime(stderr))
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import time and time to the first prediction of a fresh process.")
+    parser.add_argument("--model", type=Path, default=REPO / "model_pg.txt", help="Model file (default: model_pg.txt)")
+    parser.add_argument("--backend", default="lightgbm", help="Per tuple backend used for the prediction")
+    parser.add_argument(
+        "--plan", type=Path, default=REPO / "src/postgres/pg_explain_job/1a.json", help="PG EXPLAIN JSON to predict"
+    )
+    parser.add_argument("--modules", nargs="+", default=MODULES, help="Modules whose import time is measured")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters per measurement (minimum is kept)")
+    parser.add_argument("--top", type=int, default=10, help="Show the slowest imports of the prediction process")
+    parser.add_argument("--save", type=Path, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="Compare against results written with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = {f"import {m}": measure_import(m, args.runs) for m in args.modules}
+    phases, imports = measure_first_prediction(args.model.resolve(), args.backend, args.plan.resolve(), args.runs)
+    results.update({f"first prediction: {k}": v for k, v in phases.items()})
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fd:
+            baseline = json.load(fd)
+    table = []
+    regressions = []
+    for name, seconds in results.items():
+        row = [name, f"{seconds * 1e3:.1f}"]
+        if name in baseline:
+            change = seconds / baseline[name] - 1 if baseline[name] > 0 else 0.0
+            row += [f"{baseline[name] * 1e3:.1f}", f"{change * 100:+.0f}%"]
+            if change > args.tolerance:
+                regressions.append(name)
+        table.append(row)
+    headers = ["measurement", "ms"] + (["baseline ms", "change"] if baseline else [])
+    print(tabulate(table, headers, tablefmt="github"))
+
+    slowest = sorted(imports, key=lambda i: i[1], reverse=True)[: args.top]
+    print("\nslowest imports of the prediction process (self time)")
+    print(
+        tabulate(
+            [[name, f"{s / 1e3:.1f}", f"{c / 1e3:.1f}"] for _, s, c, name in slowest],
+            ["module", "self ms", "cumulative ms"],
+            tablefmt="github",
+        )
+    )
+
+    if args.save is not None:
+        with open(args.save, "w") as fd:
+            json.dump(results, fd, indent=2)
+    if regressions:
+        print(f"\nslower than the baseline by more than {args.tolerance * 100:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Check Model.estimate_batch on batches with queries without pipelines: every model (TreeModel, FlatTreeModel and
+PerTupleTreeModel with every backend) estimates the bundled PostgreSQL JOB plans once as they are and once with a query
+without pipelines first, between every pair of queries and last. The empty queries must get no pipeline estimates and
+the estimate of an empty feature matrix (0, 1e-6 for TreeModel, which clips, and the clipped estimate of the all-zero
+query vector for FlatTreeModel), the other estimates must not change.
+sum_segments is also checked against a plain loop for random segments, including empty first, middle and last ones.
+No benchmark data is needed. Exits with 1 if any check fails.
+
+Usage:
+  python -m testing.check_estimate_batch
+  python -m testing.check_estimate_batch --model model_pg.txt --backends lightgbm numpy
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+import sys
+from pathlib import Path
+
+import numpy as np
+from tabulate import tabulate
+
+from src.feature_layout import load_model
+from src.model import PER_TUPLE_BACKENDS, FlatTreeModel, TreeModel, build_per_tuple_tree_model, sum_segments
+from src.optimizer import BenchmarkedQuery
+
+
+def load_pg_queries() -> list[BenchmarkedQuery]:
+    from src.postgres import pg_patches
+
+    pg_patches.apply_patches()
+
+    from src.database_manager import DatabaseManager
+    from src.postgres.pg_to_umbra import load_pg_json
+    from src.postgres.training import PG_EXPLAIN_JOB_DIR
+    from src.serving.plans import pg_plan_to_query
+
+    db = DatabaseManager.get_database("job")
+    return [
+        pg_plan_to_query(load_pg_json(path), db, False, path.stem) for path in sorted(PG_EXPLAIN_JOB_DIR.glob("*.json"))
+    ]
+
+
+def get_empty_query(query: BenchmarkedQuery) -> BenchmarkedQuery:
+    empty = copy.copy(query)
+    empty.query_plan = copy.copy(query.query_plan)
+    empty.query_plan.pipelines = []
+    empty.feature_matrix = None
+    return empty
+
+
+def check_sum_segments(n_checks: int = 100, seed: int = 0) -> bool:
+    rng = np.random.default_rng(seed)
+    for i in range(n_checks):
+        lengths = rng.integers(0, 4, rng.integers(1, 10))
+        # the first, a middle and the last segment are empty in turn
+        lengths[i % 3 * (len(lengths) - 1) // 2] = 0
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        x = rng.random((offsets[-1], 3))
+        expected = np.array([x[start:end].sum(axis=0) for start, end in zip(offsets[:-1], offsets[1:])])
+        if not np.allclose(sum_segments(x, offsets), expected.reshape(len(lengths), 3), rtol=1e-12, atol=0):
+            return False
+    return True
+
+
+def check_model(model, queries: list[BenchmarkedQuery], empty_total: float) -> tuple[bool, bool]:
+    """whether the empty queries are estimated correctly and whether the other estimates are unchanged"""
+    totals, pipelines = model.estimate_batch(queries)
+    empty = get_empty_query(queries[0])
+    batch = [q for query in queries for q in (empty, query)] + [empty]
+    batch_totals, batch_pipelines = model.estimate_batch(batch)
+    empty_ok = len(batch_totals) == len(batch) and np.all(batch_totals[0::2] == empty_total)
+    # the flat model has no pipeline estimates, its single entry per query is the query estimate
+    if not isinstance(model, FlatTreeModel):
+        empty_ok = empty_ok and all(len(p) == 0 for p in batch_pipelines[0::2])
+    unchanged = np.array_equal(batch_totals[1::2], totals) and all(
+        np.array_equal(a, b) for a, b in zip(batch_pipelines[1::2], pipelines)
+    )
+    return bool(empty_ok), bool(unchanged)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check estimate_batch on batches with queries without pipelines.")
+    parser.add_argument("--model", type=Path, default=Path("model_pg.txt"), help="Model file (default: model_pg.txt)")
+    parser.add_argument("--backends", nargs="+", choices=PER_TUPLE_BACKENDS, default=list(PER_TUPLE_BACKENDS))
+    args = parser.parse_args()
+
+    queries = load_pg_queries()
+    booster = load_model(args.model)
+    # the flat model predicts the sum of the pipeline vectors of a query, which is 0 for an empty one
+    flat_empty_total = max(1e-6, float(booster.predict(np.zeros((1, booster.num_feature())))[0]))
+    models = [("TreeModel", TreeModel(booster), 1e-6), ("FlatTreeModel", FlatTreeModel(booster), flat_empty_total)]
+    models += [
+        (f"PerTupleTreeModel ({backend})", build_per_tuple_tree_model(booster, backend), 0.0)
+        for backend in args.backends
+    ]
+    segments_ok = check_sum_segments()
+    failed = not segments_ok
+    table = []
+    for name, model, empty_total in models:
+        empty_ok, unchanged = check_model(model, queries, empty_total)
+        failed |= not (empty_ok and unchanged)
+        table.append([name, "ok" if empty_ok else "wrong", "yes" if unchanged else "no"])
+    print(f"{len(queries)} queries, sum_segments {'ok' if segments_ok else 'differs from a plain loop'}")
+    print(tabulate(table, ["model", "empty queries", "other estimates unchanged"], tablefmt="github"))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
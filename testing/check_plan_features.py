@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Check that the single pass extractor (src/plan_features.py) produces exactly the pipeline feature matrix and the scan
+sizes of QueryPlan + FeatureMapper, and compare the time both take per plan.
+
+All benchmark files in data/ of the given databases are checked, --pg checks the bundled PostgreSQL JOB plans
+(src/postgres/pg_explain_job) instead, which needs no benchmark data. Exits with 1 if any plan differs.
+
+Usage:
+  python -m testing.check_plan_features
+  python -m testing.check_plan_features --dbs tpchSf1 job --predicted-cardinalities
+  python -m testing.check_plan_features --pg
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from tabulate import tabulate
+
+from src.database import Database
+from src.database_manager import DatabaseManager, get_database_dict
+from src.features import FeatureMapper
+from src.plan_features import PlanFeatureExtractor
+from src.query_plan import QueryPlan
+
+
+def read_umbra_plans(db: Database) -> list[tuple[str, dict]]:
+    """the plan json of every benchmark file of the database, as read by DataCollector.read_analyzed_plan"""
+    result = []
+    for file in sorted(Path(f"data/{db.get_path()}").rglob("*.json")):
+        with open(file, "r") as fd:
+            result.append((str(file), json.load(fd)["plan"]["plan"]))
+    return result
+
+
+def read_pg_plans() -> list[tuple[str, dict]]:
+    from src.postgres import pg_patches
+
+    pg_patches.apply_patches()
+
+    from src.postgres.pg_to_umbra import load_pg_json, pg_explain_to_umbra
+    from src.postgres.training import PG_EXPLAIN_JOB_DIR
+
+    return [
+        (str(path), pg_explain_to_umbra(load_pg_json(path), use_actual_card=True))
+        for path in sorted(PG_EXPLAIN_JOB_DIR.glob("*.json"))
+    ]
+
+
+def featurize_query_plan(plan: dict, db: Database, predicted_cardinalities: bool, mapper: FeatureMapper):
+    query_plan = QueryPlan(plan, db, predicted_cardinalities)
+    query_plan.build_pipelines(plan["analyzePlanPipelines"])
+    return mapper.get_pipeline_estimation_matrix(query_plan), mapper.get_pipeline_scan_sizes(query_plan)
+
+
+def featurize_extractor(plan: dict, db: Database, predicted_cardinalities: bool, mapper: FeatureMapper):
+    extractor = PlanFeatureExtractor(plan, db, predicted_cardinalities, mapper)
+    return extractor.get_feature_matrix(), extractor.get_scan_sizes()
+
+
+def check(
+    plans: list[tuple[str, dict]], db: Database, predicted_cardinalities: bool, mapper: FeatureMapper
+) -> tuple[list[str], float, float]:
+    """names of the plans with differing features, seconds per plan of the query plan and of the extractor"""
+    mismatches = []
+    query_plan_time = 0.0
+    extractor_time = 0.0
+    for name, plan in plans:
+        start = time.perf_counter()
+        expected_x, expected_scans = featurize_query_plan(plan, db, predicted_cardinalities, mapper)
+        query_plan_time += time.perf_counter() - start
+        start = time.perf_counter()
+        x, scans = featurize_extractor(plan, db, predicted_cardinalities, mapper)
+        extractor_time += time.perf_counter() - start
+        # bit identical, not just close
+        if not (
+            x.shape == expected_x.shape
+            and np.array_equal(x, expected_x, equal_nan=True)
+            and np.array_equal(scans, expected_scans, equal_nan=True)
+        ):
+            mismatches.append(name)
+    n = max(len(plans), 1)
+    return mismatches, query_plan_time / n, extractor_time / n
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Parity of the single pass plan feature extractor.")
+    parser.add_argument("--dbs", nargs="+", default=list(get_database_dict()), help="Databases whose data/ is checked")
+    parser.add_argument("--predicted-cardinalities", action="store_true", help="Use estimated instead of exact cards")
+    parser.add_argument("--pg", action="store_true", help="Check the bundled PostgreSQL JOB plans instead of data/")
+    args = parser.parse_args()
+
+    mapper = FeatureMapper()
+    if args.pg:
+        from src.serving.plans import get_pg_database
+
+        # the plans are converted as the server converts them, with its fallback for tables without a size
+        sources = [(get_pg_database(DatabaseManager.get_database("job")), read_pg_plans())]
+    else:
+        sources = [(db, read_umbra_plans(db)) for db in DatabaseManager.get_databases(args.dbs)]
+
+    table = []
+    mismatches = []
+    for db, plans in sources:
+        if len(plans) == 0:
+            continue
+        failed, query_plan_time, extractor_time = check(plans, db, args.predicted_cardinalities, mapper)
+        mismatches += failed
+        table.append(
+            [
+                db.get_path(),
+                len(plans),
+                len(failed),
+                f"{query_plan_time * 1e6:.0f}",
+                f"{extractor_time * 1e6:.0f}",
+                f"{query_plan_time / max(extractor_time, 1e-12):.2f}x",
+            ]
+        )
+    print(tabulate(table, ["database", "plans", "mismatches", "QueryPlan us", "extractor us", "speedup"], "github"))
+    for name in mismatches:
+        print(f"mismatch: {name}")
+    if len(table) == 0:
+        print("no plans found, download the benchmark data or use --pg")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Accuracy of the opt-in float32 feature path against float64: the same booster predicts the TPC-DS test set
+(DatabaseManager.get_test_databases) once from float64 and once from float32 feature matrices. Reports the q-errors of
+both against the measured runtimes, how many pipeline predictions changed, the largest relative change and the memory
+of the stacked feature matrix.
+
+--pg uses the bundled PostgreSQL JOB plans instead (no benchmark data needed, but no runtimes, so only the prediction
+changes are reported). Exits with 1 if a q-error percentile differs by more than --tolerance (relative).
+
+Usage:
+  python -m testing.float32_parity --model model.txt
+  python -m testing.float32_parity --model model.txt --backend numpy --predicted-cardinalities
+  python -m testing.float32_parity --pg
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from tabulate import tabulate
+
+from src.feature_layout import load_model
+from src.metrics import q_error
+from src.model import PER_TUPLE_BACKENDS, PerTupleTreeModel, build_per_tuple_tree_model, stack_feature_matrices
+from src.optimizer import BenchmarkedQuery
+
+PERCENTILES = [50, 90, 95, 99, 100]
+
+
+def load_test_queries(predicted_cardinalities: bool) -> list[BenchmarkedQuery]:
+    from src.data_collection import DataCollector
+    from src.database_manager import DatabaseManager
+
+    return DataCollector.collect_benchmarks(DatabaseManager.get_test_databases(), predicted_cardinalities)
+
+
+def load_pg_queries(predicted_cardinalities: bool) -> list[BenchmarkedQuery]:
+    from src.postgres import pg_patches
+
+    pg_patches.apply_patches()
+
+    from src.database_manager import DatabaseManager
+    from src.postgres.pg_to_umbra import load_pg_json
+    from src.postgres.training import PG_EXPLAIN_JOB_DIR
+    from src.serving.plans import pg_plan_to_query
+
+    db = DatabaseManager.get_database("job")
+    return [
+        pg_plan_to_query(load_pg_json(path), db, predicted_cardinalities, path.stem)
+        for path in sorted(PG_EXPLAIN_JOB_DIR.glob("*.json"))
+    ]
+
+
+def predict(model: PerTupleTreeModel, queries: list[BenchmarkedQuery]) -> tuple[np.ndarray, np.ndarray, float, int]:
+    """query estimates, pipeline estimates, seconds of the prediction and bytes of the feature matrix"""
+    x, offsets = stack_feature_matrices(queries, model.get_feature_mapper())
+    start = time.perf_counter()
+    totals, pipelines = model.estimate_batch(queries)
+    elapsed = time.perf_counter() - start
+    return totals, np.concatenate(pipelines + [np.zeros(0)]), elapsed, x.nbytes
+
+
+def get_q_errors(queries: list[BenchmarkedQuery], totals: np.ndarray) -> np.ndarray:
+    return np.array([q_error(q.get_total_runtime(), float(e)) for q, e in zip(queries, totals)])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Accuracy of float32 against float64 feature matrices.")
+    parser.add_argument("--model", type=Path, default=Path("model.txt"), help="Model file (default: model.txt)")
+    parser.add_argument("--backend", choices=PER_TUPLE_BACKENDS, default="lightgbm", help="Per tuple backend")
+    parser.add_argument("--predicted-cardinalities", action="store_true", help="Use estimated instead of exact cards")
+    parser.add_argument("--pg", action="store_true", help="Use the bundled PostgreSQL JOB plans (no runtimes)")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Allowed relative change of a q-error percentile")
+    args = parser.parse_args()
+
+    if args.pg:
+        queries = load_pg_queries(args.predicted_cardinalities)
+    else:
+        queries = load_test_queries(args.predicted_cardinalities)
+    if len(queries) == 0:
+        print("no queries found, download the benchmark data or use --pg")
+        sys.exit(1)
+    booster = load_model(args.model)
+    results = {
+        dtype: predict(build_per_tuple_tree_model(booster, args.backend, dtype), queries)
+        for dtype in (np.float64, np.float32)
+    }
+    totals_64, pipelines_64, time_64, bytes_64 = results[np.float64]
+    totals_32, pipelines_32, time_32, bytes_32 = results[np.float32]
+
+    relative = np.abs(pipelines_32 - pipelines_64) / np.maximum(np.abs(pipelines_64), 1e-12)
+    table = [
+        ["queries", len(queries), len(queries)],
+        ["pipelines", len(pipelines_64), len(pipelines_32)],
+        ["feature matrix MB", f"{bytes_64 / 2**20:.2f}", f"{bytes_32 / 2**20:.2f}"],
+        ["prediction ms", f"{time_64 * 1e3:.1f}", f"{time_32 * 1e3:.1f}"],
+        ["changed pipeline estimates", "", f"{np.count_nonzero(pipelines_32 != pipelines_64)}"],
+        ["max relative change", "", f"{relative.max(initial=0.0):.2e}"],
+    ]
+    regressions = []
+    if not args.pg:
+        q_errors_64 = get_q_errors(queries, totals_64)
+        q_errors_32 = get_q_errors(queries, totals_32)
+        for percentile in PERCENTILES:
+            a = np.percentile(q_errors_64, percentile)
+            b = np.percentile(q_errors_32, percentile)
+            table.append([f"q-error p{percentile}", f"{a:.4f}", f"{b:.4f}"])
+            if abs(b / a - 1) > args.tolerance:
+                regressions.append(f"p{percentile}")
+    print(tabulate(table, ["", "float64", "float32"], tablefmt="github"))
+    if regressions:
+        print(f"q-error changed by more than {args.tolerance * 100:.1f}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()